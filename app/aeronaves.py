@@ -0,0 +1,71 @@
+# app/aeronaves.py
+# Distribución de asientos (filas x columnas) por tipo de aeronave
+import json
+import os
+from typing import NamedTuple
+
+
+class LayoutAsientos(NamedTuple):
+    filas: int
+    columnas: str  # letras de columna, ej: "ABCDE"
+
+    @property
+    def total(self) -> int:
+        return self.filas * len(self.columnas)
+
+
+TIPO_AERONAVE_POR_DEFECTO = "estandar"
+
+# Columnas permitidas por el CHECK de asiento.columna; además caben en vuelo.mapa_columnas (VARCHAR(10))
+COLUMNAS_PERMITIDAS = "ABCDE"
+# Largo de vuelo.tipo_aeronave
+TIPO_AERONAVE_MAX = 20
+
+LAYOUTS_AERONAVE = {
+    "estandar": LayoutAsientos(filas=20, columnas="ABCDE"),  # 100 asientos (layout histórico)
+    "regional": LayoutAsientos(filas=18, columnas="ABCD"),
+    "turbohelice": LayoutAsientos(filas=12, columnas="ABCD"),
+    "fuselaje_largo": LayoutAsientos(filas=36, columnas="ABCDE"),
+}
+
+def _validar_layout(tipo, filas, columnas) -> LayoutAsientos:
+    """
+    Layout de AERONAVE_LAYOUTS, o ValueError con el motivo. Las columnas van en orden alfabético
+    y sin repetir: es el orden de los bits del mapa de asientos (string_agg de la reconciliación).
+    """
+    if not isinstance(tipo, str) or not 0 < len(tipo) <= TIPO_AERONAVE_MAX:
+        raise ValueError(f"AERONAVE_LAYOUTS inválido: el tipo {tipo!r} debe tener entre 1 y {TIPO_AERONAVE_MAX} caracteres")
+    if isinstance(filas, bool) or not isinstance(filas, int) or filas <= 0:
+        raise ValueError(f"AERONAVE_LAYOUTS inválido: {tipo}: filas debe ser un entero mayor que 0 (llegó {filas!r})")
+    if not isinstance(columnas, str) or not columnas:
+        raise ValueError(f"AERONAVE_LAYOUTS inválido: {tipo}: columnas debe ser un texto no vacío (llegó {columnas!r})")
+    if set(columnas) - set(COLUMNAS_PERMITIDAS):
+        raise ValueError(f"AERONAVE_LAYOUTS inválido: {tipo}: columnas {columnas!r} fuera de {COLUMNAS_PERMITIDAS}")
+    if list(columnas) != sorted(set(columnas)):
+        raise ValueError(f"AERONAVE_LAYOUTS inválido: {tipo}: columnas {columnas!r} repetidas o fuera de orden (ej: 'ABCD')")
+    return LayoutAsientos(filas=filas, columnas=columnas)
+
+
+def _leer_layouts(valor: str) -> dict:
+    try:
+        layouts = json.loads(valor)
+    except json.JSONDecodeError as exc:
+        raise ValueError(f"AERONAVE_LAYOUTS inválido: no es JSON ({exc})") from None
+    if not isinstance(layouts, dict):
+        raise ValueError('AERONAVE_LAYOUTS inválido: se espera un objeto, ej: {"E190": [25, "ABCD"]}')
+    leidos = {}
+    for tipo, layout in layouts.items():
+        if not isinstance(layout, list) or len(layout) != 2:
+            raise ValueError(f"AERONAVE_LAYOUTS inválido: {tipo}: se espera [filas, columnas] (llegó {layout!r})")
+        leidos[tipo] = _validar_layout(tipo, *layout)
+    return leidos
+
+
+# Permite añadir o sobreescribir layouts sin tocar código, ej:
+# AERONAVE_LAYOUTS='{"E190": [25, "ABCD"]}'
+# Se valida al importar: un layout inválido impide arrancar en vez de fallar al crear vuelos.
+LAYOUTS_AERONAVE.update(_leer_layouts(os.getenv("AERONAVE_LAYOUTS", "{}")))
+
+
+def get_layout(tipo_aeronave: str = None) -> LayoutAsientos:
+    return LAYOUTS_AERONAVE.get(tipo_aeronave or TIPO_AERONAVE_POR_DEFECTO)
@@ -0,0 +1,252 @@
+# app/asientos_en_vivo.py
+# Mapa de asientos en vivo por vuelo (GET /v1/vuelos/{id_vuelo}/asientos/stream, server-sent events).
+# Cada vuelo con suscriptores guarda su mapa en memoria: se lee una sola vez de la BD, se envía
+# completo al suscribirse y después solo viajan los cambios (id_asiento, disponible), serializados
+# una vez por cambio y repartidos a la cola de cada suscriptor.
+# Entre workers los cambios viajan por LISTEN/NOTIFY de Postgres: cada worker publica con NOTIFY
+# y todos (incluido él mismo) los aplican al recibirlos. Sin esa conexión se reparten en el proceso.
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+
+from app.utils.respuestas import dumps, loads
+
+ASIENTOS_STREAM_NOTIFY = os.getenv("ASIENTOS_STREAM_NOTIFY", "true").lower() in ("1", "true", "si", "yes")
+ASIENTOS_STREAM_COLA = int(os.getenv("ASIENTOS_STREAM_COLA", "64"))
+ASIENTOS_STREAM_KEEPALIVE_SEGUNDOS = float(os.getenv("ASIENTOS_STREAM_KEEPALIVE_SEGUNDOS", "15"))
+ASIENTOS_STREAM_REINTENTO_SEGUNDOS = 5.0
+
+CANAL_NOTIFY = "flyblue_asientos"
+CAMBIOS_POR_NOTIFY = 300  # el payload de NOTIFY no puede pasar de 8000 bytes
+
+PING = b": ping\n\n"
+
+
+def _evento(tipo: str, version: int, datos: dict) -> bytes:
+    return b"event: " + tipo.encode() + b"\nid: " + str(version).encode() + b"\ndata: " + dumps(datos) + b"\n\n"
+
+
+class _Canal:
+    __slots__ = ("suscriptores", "cargar", "mapa", "version", "serializado", "carga", "pendientes")
+
+    def __init__(self, cargar: Callable[[], Awaitable[list]]):
+        self.suscriptores: set[asyncio.Queue] = set()
+        self.cargar = cargar
+        self.mapa: Optional[dict] = None  # id_asiento -> fila del mapa (dict)
+        self.version = 0
+        self.serializado: Optional[bytes] = None  # evento "mapa" listo para enviar
+        self.carga: Optional[asyncio.Task] = None
+        self.pendientes: list = []  # cambios recibidos mientras se lee el mapa
+
+
+class DifusorAsientos:
+    def __init__(self):
+        self._canales: dict[int, _Canal] = {}
+        self._conexion = None  # conexión asyncpg con LISTEN activo
+        self._bloqueo = asyncio.Lock()  # asyncpg no admite dos operaciones a la vez en la misma conexión
+        self.publicados = 0
+        self.difundidos = 0
+        self.resincronizaciones = 0
+
+    # --- Suscripción ---
+
+    async def suscribir(self, id_vuelo: int, cargar: Callable[[], Awaitable[list]]) -> Optional[asyncio.Queue]:
+        """
+        Devuelve la cola de eventos del suscriptor (el primero es el mapa completo) o None si el
+        vuelo no tiene asientos. `cargar()` devuelve las filas del mapa como dicts; solo se llama
+        si el vuelo no tiene ya su mapa en memoria, y una sola vez aunque lleguen muchos a la vez.
+        """
+        canal = self._canales.get(id_vuelo)
+        if canal is None:
+            canal = self._canales[id_vuelo] = _Canal(cargar)
+        cola = asyncio.Queue(maxsize=ASIENTOS_STREAM_COLA)
+        canal.suscriptores.add(cola)
+
+        if canal.mapa is not None:
+            cola.put_nowait(self._evento_mapa(canal))
+            return cola
+
+        # Quien llega durante la lectura recibe el mapa cuando esta termina
+        try:
+            await asyncio.shield(self._iniciar_carga(id_vuelo, canal))
+        except BaseException:
+            self.desuscribir(id_vuelo, cola)
+            raise
+        if not canal.mapa:
+            self.desuscribir(id_vuelo, cola)
+            return None
+        return cola
+
+    def desuscribir(self, id_vuelo: int, cola: asyncio.Queue):
+        canal = self._canales.get(id_vuelo)
+        if canal is None:
+            return
+        canal.suscriptores.discard(cola)
+        if not canal.suscriptores and canal.carga is None:
+            del self._canales[id_vuelo]
+
+    async def eventos(self, id_vuelo: int, cola: asyncio.Queue):
+        """Cuerpo de la respuesta SSE: eventos de la cola y un comentario de keep-alive si no hay cambios."""
+        try:
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=ASIENTOS_STREAM_KEEPALIVE_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    evento = PING
+                if evento is None:  # el canal se cerró: el cliente vuelve a conectarse
+                    return
+                yield evento
+        finally:
+            self.desuscribir(id_vuelo, cola)
+
+    # --- Carga del mapa ---
+
+    def _iniciar_carga(self, id_vuelo: int, canal: _Canal) -> asyncio.Task:
+        if canal.carga is None:
+            canal.carga = asyncio.ensure_future(self._cargar(id_vuelo, canal))
+        return canal.carga
+
+    async def _cargar(self, id_vuelo: int, canal: _Canal):
+        try:
+            filas = await canal.cargar()
+        except Exception:
+            self._cerrar(canal)
+            raise
+        finally:
+            canal.carga = None
+            if not canal.suscriptores:
+                self._canales.pop(id_vuelo, None)
+
+        canal.mapa = {fila["id_asiento"]: fila for fila in filas}
+        for id_asiento, disponible in canal.pendientes:
+            if id_asiento in canal.mapa:
+                canal.mapa[id_asiento]["disponible"] = disponible
+        canal.pendientes = []
+        canal.version += 1
+        canal.serializado = None
+        if not canal.mapa:
+            self._cerrar(canal)
+            return
+        evento = self._evento_mapa(canal)
+        for cola in canal.suscriptores:
+            self._vaciar(cola)
+            cola.put_nowait(evento)
+
+    def _evento_mapa(self, canal: _Canal) -> bytes:
+        if canal.serializado is None:
+            canal.serializado = _evento("mapa", canal.version, {"version": canal.version, "asientos": list(canal.mapa.values())})
+        return canal.serializado
+
+    @staticmethod
+    def _vaciar(cola: asyncio.Queue):
+        while not cola.empty():
+            cola.get_nowait()
+
+    def _cerrar(self, canal: _Canal):
+        for cola in canal.suscriptores:
+            self._vaciar(cola)
+            cola.put_nowait(None)
+
+    # --- Cambios ---
+
+    def _aplicar(self, id_vuelo: int, cambios: list):
+        canal = self._canales.get(id_vuelo)
+        if canal is None:
+            return
+        if canal.mapa is None:
+            canal.pendientes.extend(cambios)
+            return
+
+        # Los cambios son estados absolutos: aplicar dos veces el mismo no genera evento
+        efectivos = []
+        for id_asiento, disponible in cambios:
+            asiento = canal.mapa.get(id_asiento)
+            if asiento is not None and asiento["disponible"] != disponible:
+                asiento["disponible"] = disponible
+                efectivos.append({"id_asiento": id_asiento, "disponible": disponible})
+        if not efectivos:
+            return
+
+        canal.version += 1
+        canal.serializado = None
+        evento = _evento("cambios", canal.version, {"version": canal.version, "asientos": efectivos})
+        self.difundidos += 1
+        for cola in canal.suscriptores:
+            try:
+                cola.put_nowait(evento)
+            except asyncio.QueueFull:
+                # Suscriptor lento: en vez de acumular cambios le mandamos el mapa actual
+                self.resincronizaciones += 1
+                self._vaciar(cola)
+                cola.put_nowait(self._evento_mapa(canal))
+
+    async def publicar(self, id_vuelo: int, cambios: list):
+        """Publica cambios [(id_asiento, disponible), ...] ya confirmados en la BD."""
+        if not cambios:
+            return
+        self.publicados += 1
+        conexion = self._conexion
+        if conexion is not None:
+            try:
+                async with self._bloqueo:
+                    for inicio in range(0, len(cambios), CAMBIOS_POR_NOTIFY):
+                        payload = dumps({"v": id_vuelo, "c": cambios[inicio:inicio + CAMBIOS_POR_NOTIFY]})
+                        await conexion.execute("SELECT pg_notify($1, $2)", CANAL_NOTIFY, payload.decode())
+                return
+            except Exception as exc:
+                print(f"NOTIFY de asientos falló, se reparte solo en este proceso: {exc!r}")
+        self._aplicar(id_vuelo, [tuple(c) for c in cambios])
+
+    def _al_notificar(self, conexion, pid, canal, payload):
+        datos = loads(payload)
+        self._aplicar(datos["v"], [tuple(c) for c in datos["c"]])
+
+    # --- LISTEN/NOTIFY ---
+
+    async def escuchar(self, conectar: Callable[[], Awaitable]):
+        """
+        Mantiene la conexión con LISTEN (reconecta si se cae). Mientras no hay conexión los cambios
+        de otros workers se pierden, así que al reconectar se vuelven a leer los mapas en memoria.
+        """
+        while True:
+            conexion = None
+            try:
+                conexion = await conectar()
+                await conexion.add_listener(CANAL_NOTIFY, self._al_notificar)
+                self._conexion = conexion
+                self._recargar_mapas()
+                while True:
+                    await asyncio.sleep(ASIENTOS_STREAM_KEEPALIVE_SEGUNDOS)
+                    async with self._bloqueo:
+                        await conexion.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"LISTEN de asientos caído, reintentando en {ASIENTOS_STREAM_REINTENTO_SEGUNDOS}s: {exc!r}")
+            finally:
+                self._conexion = None
+                if conexion is not None and not conexion.is_closed():
+                    conexion.terminate()
+            await asyncio.sleep(ASIENTOS_STREAM_REINTENTO_SEGUNDOS)
+
+    def _recargar_mapas(self):
+        for id_vuelo, canal in list(self._canales.items()):
+            if canal.mapa is not None and canal.carga is None:
+                canal.mapa = None
+                # si la lectura falla _cargar cierra los streams y los clientes se reconectan
+                self._iniciar_carga(id_vuelo, canal).add_done_callback(
+                    lambda tarea: tarea.cancelled() or tarea.exception()
+                )
+
+    def stats(self) -> dict:
+        return {
+            "vuelos": len(self._canales),
+            "suscriptores": sum(len(c.suscriptores) for c in self._canales.values()),
+            "notify_activo": int(self._conexion is not None),
+            "publicados": self.publicados,
+            "difundidos": self.difundidos,
+            "resincronizaciones": self.resincronizaciones,
+        }
+
+
+difusor_asientos = DifusorAsientos()
@@ -0,0 +1,12 @@
+from .catalogos import catalogos, etag_coincide
+from .busquedas import busquedas_cache
+from .calendario import calendario_cache
+
+
+async def invalidar_disponibilidad(id_origen: int, id_destino: int, fecha_salida):
+    """Cambió la disponibilidad de un vuelo: invalida las búsquedas y el calendario de su ruta y día."""
+    await busquedas_cache.invalidar_ruta(id_origen, id_destino, fecha_salida)
+    calendario_cache.invalidar_dia(id_origen, id_destino, fecha_salida)
+
+
+__all__ = ["catalogos", "etag_coincide", "busquedas_cache", "calendario_cache", "invalidar_disponibilidad"]
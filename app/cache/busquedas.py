@@ -0,0 +1,240 @@
+# app/cache/busquedas.py
+# Caché de resultados de búsqueda de vuelos (GET /v1/vuelos)
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from itertools import product
+from typing import Optional
+
+from app.cache.compartida import segmento_compartido
+from app.utils.respuestas import dumps, loads
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # dependencia opcional, solo para el backend "redis"
+    redis = None
+
+# compartida | memoria | redis | local | off
+BUSQUEDA_CACHE_BACKEND = os.getenv("BUSQUEDA_CACHE_BACKEND", "compartida")
+BUSQUEDA_CACHE_TTL = int(os.getenv("BUSQUEDA_CACHE_TTL", "60"))
+BUSQUEDA_CACHE_MAX = int(os.getenv("BUSQUEDA_CACHE_MAX", "10000"))
+BUSQUEDA_CACHE_URL = os.getenv("BUSQUEDA_CACHE_URL", "redis://localhost:6379/0")
+
+COMODIN = "*"
+
+
+class MemoriaLRUBackend:
+    """LRU con TTL dentro del proceso."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._datos: "OrderedDict[str, tuple[bytes, float]]" = OrderedDict()
+        self._contadores: dict[str, int] = {}
+        self.evictions = 0
+
+    async def get(self, clave: str) -> Optional[bytes]:
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        valor, expira = entrada
+        if expira < time.monotonic():
+            del self._datos[clave]
+            return None
+        self._datos.move_to_end(clave)
+        return valor
+
+    async def set(self, clave: str, valor: bytes, ttl: int):
+        self._datos[clave] = (valor, time.monotonic() + ttl)
+        self._datos.move_to_end(clave)
+        while len(self._datos) > self.maxsize:
+            self._datos.popitem(last=False)
+            self.evictions += 1
+
+    async def get_contador(self, clave: str) -> int:
+        return self._contadores.get(clave, 0)
+
+    async def incr(self, clave: str) -> int:
+        self._contadores[clave] = self._contadores.get(clave, 0) + 1
+        return self._contadores[clave]
+
+    def tamano(self) -> int:
+        return len(self._datos)
+
+
+class KVLocal:
+    """
+    Sustituto en memoria de un almacén clave-valor externo (subconjunto de la API
+    de redis.asyncio: get, set con ex, incr). Sirve para desarrollo y pruebas.
+    """
+
+    def __init__(self):
+        self._datos: dict[str, tuple[bytes, Optional[float]]] = {}
+
+    async def get(self, clave: str):
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        valor, expira = entrada
+        if expira is not None and expira < time.monotonic():
+            del self._datos[clave]
+            return None
+        return valor
+
+    async def set(self, clave: str, valor, ex: Optional[int] = None):
+        self._datos[clave] = (valor, time.monotonic() + ex if ex else None)
+
+    async def incr(self, clave: str) -> int:
+        actual = int((await self.get(clave)) or 0) + 1
+        self._datos[clave] = (str(actual).encode(), None)
+        return actual
+
+    async def dbsize(self) -> int:
+        return len(self._datos)
+
+
+class KVExternoBackend:
+    """Almacén clave-valor compartido entre procesos (Redis o KVLocal)."""
+
+    def __init__(self, cliente):
+        self.cliente = cliente
+        self.evictions = 0  # las gestiona el almacén externo
+
+    async def get(self, clave: str) -> Optional[bytes]:
+        return await self.cliente.get(clave)
+
+    async def set(self, clave: str, valor: bytes, ttl: int):
+        await self.cliente.set(clave, valor, ex=ttl)
+
+    async def get_contador(self, clave: str) -> int:
+        return int((await self.cliente.get(clave)) or 0)
+
+    async def incr(self, clave: str) -> int:
+        return await self.cliente.incr(clave)
+
+    def tamano(self) -> Optional[int]:
+        return None
+
+
+class MemoriaCompartidaBackend:
+    """Entradas en el segmento compartido por los workers (app/cache/compartida.py)."""
+
+    def __init__(self, segmento):
+        self.segmento = segmento
+
+    async def get(self, clave: str) -> Optional[bytes]:
+        return self.segmento.get(clave)
+
+    async def set(self, clave: str, valor: bytes, ttl: int):
+        self.segmento.set(clave, valor, ttl)
+
+    async def get_contador(self, clave: str) -> int:
+        return self.segmento.get_contador(clave)
+
+    async def incr(self, clave: str) -> int:
+        return self.segmento.incr(clave)
+
+    @property
+    def evictions(self) -> int:
+        return self.segmento.desalojos
+
+    def tamano(self) -> int:
+        return self.segmento.ocupadas()
+
+
+def crear_backend(nombre: str):
+    if nombre == "off":
+        return None
+    if nombre == "compartida":
+        segmento = segmento_compartido()
+        if segmento is not None:
+            return MemoriaCompartidaBackend(segmento)
+        # CACHE_COMPARTIDA_MB=0: caché por proceso
+    if nombre == "local":
+        return KVExternoBackend(KVLocal())
+    if nombre == "redis":
+        if redis is None:
+            raise RuntimeError("BUSQUEDA_CACHE_BACKEND=redis requiere el paquete 'redis'")
+        return KVExternoBackend(redis.from_url(BUSQUEDA_CACHE_URL))
+    return MemoriaLRUBackend(BUSQUEDA_CACHE_MAX)
+
+
+def _normalizar(valor) -> str:
+    if valor is None:
+        return COMODIN
+    if isinstance(valor, datetime):
+        return valor.date().isoformat()  # las búsquedas son por día
+    return str(valor)
+
+
+class BusquedaCache:
+    """
+    Cachea páginas de resultados de búsqueda por (origen, destino, día).
+
+    Cada combinación de filtros tiene un contador de generación que forma parte
+    de la clave; invalidar una ruta/día incrementa los contadores de todas las
+    búsquedas que podrían incluir ese vuelo (filtros exactos o comodín), de modo
+    que las entradas viejas dejan de leerse sin tener que recorrerlas.
+    """
+
+    def __init__(self, backend, ttl: int):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidaciones = 0
+
+    @property
+    def activa(self) -> bool:
+        return self.backend is not None
+
+    def _bucket(self, origen, destino, fecha) -> str:
+        return f"{_normalizar(origen)}:{_normalizar(destino)}:{_normalizar(fecha)}"
+
+    async def _clave(self, origen, destino, fecha, limite, cursor) -> str:
+        bucket = self._bucket(origen, destino, fecha)
+        generacion = await self.backend.get_contador(f"busqueda:gen:{bucket}")
+        return f"busqueda:{bucket}:g{generacion}:{limite}:{cursor or ''}"
+
+    async def obtener(self, origen, destino, fecha, limite, cursor, refrescar: bool = False) -> tuple[Optional[dict], Optional[str]]:
+        """
+        Devuelve (resultado o None, clave para guardar el resultado si hubo miss).
+        Con `refrescar` no lee la entrada: se recarga y se guarda encima.
+        """
+        if not self.activa:
+            return None, None
+        clave = await self._clave(origen, destino, fecha, limite, cursor)
+        valor = None if refrescar else await self.backend.get(clave)
+        if valor is None:
+            self.misses += 1
+            return None, clave
+        self.hits += 1
+        return loads(valor), clave
+
+    async def guardar(self, clave: Optional[str], resultado: dict):
+        if self.activa and clave:
+            await self.backend.set(clave, dumps(resultado), self.ttl)
+
+    async def invalidar_ruta(self, origen: int, destino: int, fecha: datetime):
+        """Invalida las búsquedas que pueden contener un vuelo de esa ruta y día."""
+        if not self.activa:
+            return
+        for o, d, f in product((origen, None), (destino, None), (fecha, None)):
+            await self.backend.incr(f"busqueda:gen:{self._bucket(o, d, f)}")
+        self.invalidaciones += 1
+
+    def stats(self) -> dict:
+        consultas = self.hits + self.misses
+        return {
+            "backend": BUSQUEDA_CACHE_BACKEND,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / consultas if consultas else 0.0,
+            "evictions": self.backend.evictions if self.activa else 0,
+            "invalidaciones": self.invalidaciones,
+            "entradas": self.backend.tamano() if self.activa else 0,
+        }
+
+
+busquedas_cache = BusquedaCache(crear_backend(BUSQUEDA_CACHE_BACKEND), BUSQUEDA_CACHE_TTL)
@@ -0,0 +1,120 @@
+# app/cache/calendario.py
+# Caché del calendario de tarifas (GET /v1/vuelos/calendario)
+import os
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from app.cache.compartida import segmento_compartido
+
+CALENDARIO_CACHE_TTL = int(os.getenv("CALENDARIO_CACHE_TTL", "300"))
+CALENDARIO_CACHE_MAX_RUTAS = int(os.getenv("CALENDARIO_CACHE_MAX_RUTAS", "5000"))
+
+
+class DiaCalendario(NamedTuple):
+    fecha: date
+    precio_minimo: Optional[float]  # None si no hay vuelos con asientos ese día
+    vuelos: int
+    asientos_disponibles: int
+
+
+class CalendarioCache:
+    """
+    Guarda los agregados por (origen, destino) y día. Una consulta de rango solo va a la BD
+    por el tramo de días que falta o expiró (una única consulta agregada que cubre del primer
+    al último día faltante); crear un vuelo o reservar un asiento descarta solo ese día.
+
+    Los días se guardan en cada proceso, pero cada uno recuerda la generación de su día en el
+    segmento compartido (como las claves de la caché de búsquedas): invalidar_dia la incrementa,
+    así un cambio hecho en un worker descarta el día en todos. Sin segmento (CACHE_COMPARTIDA_MB=0)
+    la invalidación solo llega al propio proceso y los demás esperan al TTL.
+    """
+
+    def __init__(self, ttl: int, max_rutas: int, segmento=None):
+        self.ttl = ttl
+        self.max_rutas = max_rutas
+        self.segmento = segmento
+        self._rutas: "OrderedDict[tuple, dict[date, tuple[DiaCalendario, float, int]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _generaciones(self, origen: int, destino: int, desde: date, hasta: date) -> list:
+        dias = (hasta - desde).days + 1
+        if self.segmento is None:
+            return [0] * dias
+        return self.segmento.get_contadores([
+            f"calendario:gen:{origen}:{destino}:{desde + timedelta(days=i)}" for i in range(dias)
+        ])
+
+    def _dias_faltantes(self, dias: dict, desde: date, generaciones: list) -> list:
+        ahora = time.monotonic()
+        faltantes = []
+        for i, generacion in enumerate(generaciones):
+            dia = desde + timedelta(days=i)
+            entrada = dias.get(dia)
+            if entrada is None or entrada[1] < ahora or entrada[2] != generacion:
+                faltantes.append(dia)
+        return faltantes
+
+    async def obtener(
+        self,
+        origen: int,
+        destino: int,
+        desde: date,
+        hasta: date,
+        cargar: Callable[[date, date], Awaitable[list]],
+        refrescar: bool = False,
+    ) -> list:
+        """
+        `cargar(desde, hasta)` devuelve filas (fecha, precio_minimo, vuelos, asientos) de los días con vuelos.
+        Con `refrescar` se recarga todo el rango aunque esté en la caché.
+        """
+        clave = (origen, destino)
+        dias = self._rutas.get(clave)
+        if dias is None:
+            dias = self._rutas[clave] = {}
+        self._rutas.move_to_end(clave)
+
+        # Las generaciones se leen antes de cargar: una invalidación durante la carga deja el día viejo
+        generaciones = self._generaciones(origen, destino, desde, hasta)
+        faltantes = [desde, hasta] if refrescar else self._dias_faltantes(dias, desde, generaciones)
+        if faltantes:
+            self.misses += 1
+            inicio, fin = faltantes[0], faltantes[-1]
+            filas = {fila[0]: fila for fila in await cargar(inicio, fin)}
+            expira = time.monotonic() + self.ttl
+            dia = inicio
+            while dia <= fin:
+                fila = filas.get(dia)
+                generacion = generaciones[(dia - desde).days]
+                dias[dia] = (DiaCalendario(dia, fila[1], fila[2], fila[3]) if fila else DiaCalendario(dia, None, 0, 0),
+                             expira, generacion)
+                dia += timedelta(days=1)
+            while len(self._rutas) > self.max_rutas:
+                self._rutas.popitem(last=False)
+        else:
+            self.hits += 1
+
+        return [dias[desde + timedelta(days=i)][0] for i in range((hasta - desde).days + 1)]
+
+    def invalidar_dia(self, origen: int, destino: int, fecha: datetime):
+        dia = fecha.date() if isinstance(fecha, datetime) else fecha
+        if self.segmento is not None:
+            self.segmento.incr(f"calendario:gen:{origen}:{destino}:{dia}")
+        dias = self._rutas.get((origen, destino))
+        if dias:
+            dias.pop(dia, None)
+
+    def stats(self) -> dict:
+        consultas = self.hits + self.misses
+        return {
+            "ttl": self.ttl,
+            "rutas": len(self._rutas),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / consultas if consultas else 0.0,
+        }
+
+
+calendario_cache = CalendarioCache(CALENDARIO_CACHE_TTL, CALENDARIO_CACHE_MAX_RUTAS, segmento_compartido())
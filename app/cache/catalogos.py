@@ -0,0 +1,83 @@
+# app/cache/catalogos.py
+# Caché en memoria de catálogos de referencia (ciudades, equipajes)
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud
+from app.cache.compartida import segmento_compartido
+from app.schemas import CiudadResponse, EquipajeResponse
+
+# Cada cuánto se consulta catalogo_version para detectar cambios hechos por otros procesos
+CATALOGO_VERIFICACION_SEGUNDOS = float(os.getenv("CATALOGO_VERIFICACION_SEGUNDOS", "5"))
+# Las entradas del segmento llevan la versión en la clave, así que nunca quedan viejas
+CATALOGO_COMPARTIDO_TTL = 24 * 3600
+
+
+class CatalogoCache:
+    """
+    Guarda un catálogo ya serializado junto con su ETag.
+    La validez se comprueba contra la fila de catalogo_version (una lectura por PK)
+    como máximo cada `intervalo` segundos; la tabla completa solo se relee cuando
+    la versión cambia. Las escrituras del propio proceso invalidan al instante.
+    Con el segmento compartido, el catálogo serializado de cada versión lo carga un solo
+    worker y los demás lo toman de ahí.
+    """
+
+    def __init__(self, nombre: str, cargar, esquema, intervalo: float, segmento=None):
+        self.nombre = nombre
+        self._segmento = segmento
+        self._cargar = cargar
+        self._esquema = esquema
+        self.intervalo = intervalo
+        self._version: Optional[int] = None
+        self._datos: Optional[list] = None
+        self._etag: Optional[str] = None
+        self._verificado_en = 0.0
+
+    async def obtener(self, db: AsyncSession) -> tuple[list, str]:
+        ahora = time.monotonic()
+        if self._datos is not None and ahora - self._verificado_en < self.intervalo:
+            return self._datos, self._etag
+
+        version = await crud.get_catalogo_version(db, self.nombre)
+        if self._datos is None or version != self._version:
+            clave = f"catalogo:{self.nombre}:v{version}"
+            cuerpo = self._segmento.get(clave) if self._segmento is not None else None
+            if cuerpo is not None:
+                datos = json.loads(cuerpo)
+            else:
+                filas = await self._cargar(db)
+                datos = [self._esquema.model_validate(fila).model_dump(mode="json") for fila in filas]
+                cuerpo = json.dumps(datos, separators=(",", ":"), sort_keys=True).encode()
+                if self._segmento is not None:
+                    self._segmento.set(clave, cuerpo, CATALOGO_COMPARTIDO_TTL)
+            self._datos = datos
+            self._etag = f'"{self.nombre}-{version}-{hashlib.sha256(cuerpo).hexdigest()[:16]}"'
+            self._version = version
+        self._verificado_en = ahora
+        return self._datos, self._etag
+
+    def invalidar(self):
+        self._datos = None
+        self._version = None
+
+
+catalogos = {
+    "ciudades": CatalogoCache("ciudades", crud.get_all_ciudades, CiudadResponse, CATALOGO_VERIFICACION_SEGUNDOS, segmento_compartido()),
+    "equipajes": CatalogoCache("equipajes", crud.get_all_equipajes, EquipajeResponse, CATALOGO_VERIFICACION_SEGUNDOS, segmento_compartido()),
+}
+
+
+def etag_coincide(if_none_match: Optional[str], etag: str) -> bool:
+    """Comparación débil de If-None-Match (RFC 9110), admite listas y '*'."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidatos = [c.strip().removeprefix("W/") for c in if_none_match.split(",")]
+    return etag in candidatos
@@ -0,0 +1,181 @@
+# app/cache/compartida.py
+# Segmento de memoria compartida entre los workers para las cachés calientes (resultados de
+# búsqueda, catálogos y generaciones del calendario). Es un mmap anónimo MAP_SHARED que se
+# crea al importar la app: con preload_app (gunicorn.conf.py) eso pasa en el proceso maestro antes del fork, así que todos
+# los workers ven la misma memoria y N workers no guardan N copias ni calientan N veces.
+# Sin fork previo (uvicorn solo, o uvicorn --workers) cada proceso tiene su propio segmento.
+#
+# Formato: cabecera | contadores | índice | anillo de datos
+#   - contadores: enteros de 64 bits que nunca se desalojan (generaciones de invalidación);
+#     dos claves que caen en el mismo contador solo provocan invalidaciones de más.
+#   - índice: una entrada por hash de clave (asociatividad directa, una colisión desaloja)
+#     con el digest de la clave, la posición absoluta del valor en el anillo, tamaño, crc y expiración.
+#   - anillo: los valores se escriben uno detrás de otro; al dar la vuelta pisan los más viejos,
+#     y una entrada vale mientras su posición no haya quedado a más de una vuelta del cursor.
+# Cada operación toma un lock de registro POSIX (fcntl.lockf) sobre un archivo temporal: es por
+# proceso y el kernel lo suelta si el worker muere, así que un worker matado a medias no deja
+# a los demás bloqueados. Dentro del lock solo se copian unos KB.
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin fork no hay nada que compartir, basta el lock del proceso
+    fcntl = None
+
+# Tamaño del anillo de datos; 0 desactiva el segmento (las cachés quedan por proceso)
+CACHE_COMPARTIDA_MB = int(os.getenv("CACHE_COMPARTIDA_MB", "64"))
+CACHE_COMPARTIDA_ENTRADAS = int(os.getenv("CACHE_COMPARTIDA_ENTRADAS", "32768"))
+CACHE_COMPARTIDA_CONTADORES = 65536
+
+_CABECERA = struct.Struct("<QQ")  # cursor absoluto del anillo, desalojos
+_CONTADOR = struct.Struct("<q")
+_ENTRADA = struct.Struct("<16sQIId")  # digest, posición, tamaño, crc32, expira (monotonic)
+
+
+def _digest(clave: str) -> bytes:
+    return hashlib.blake2b(clave.encode(), digest_size=16).digest()
+
+
+class SegmentoCompartido:
+    def __init__(self, megas: int, entradas: int, contadores: int = CACHE_COMPARTIDA_CONTADORES):
+        self.tam_anillo = megas * 1024 * 1024
+        self.entradas = entradas
+        self.contadores = contadores
+        self._inicio_contadores = _CABECERA.size
+        self._inicio_indice = self._inicio_contadores + contadores * _CONTADOR.size
+        self._inicio_anillo = self._inicio_indice + entradas * _ENTRADA.size
+        # Las páginas se asignan al escribirlas: el tamaño configurado es un máximo
+        self._mem = mmap.mmap(-1, self._inicio_anillo + self.tam_anillo)
+        self._archivo_lock = tempfile.TemporaryFile() if fcntl else None
+        self._lock_hilos = threading.Lock()
+        self.demasiado_grandes = 0
+
+    def _bloquear(self):
+        self._lock_hilos.acquire()
+        if self._archivo_lock is not None:
+            fcntl.lockf(self._archivo_lock, fcntl.LOCK_EX)
+
+    def _desbloquear(self):
+        if self._archivo_lock is not None:
+            fcntl.lockf(self._archivo_lock, fcntl.LOCK_UN)
+        self._lock_hilos.release()
+
+    def _posicion_entrada(self, digest: bytes) -> int:
+        return self._inicio_indice + int.from_bytes(digest[:8], "little") % self.entradas * _ENTRADA.size
+
+    def _posicion_contador(self, clave: str) -> int:
+        return self._inicio_contadores + int.from_bytes(_digest(clave)[:8], "little") % self.contadores * _CONTADOR.size
+
+    def get(self, clave: str) -> Optional[bytes]:
+        digest = _digest(clave)
+        posicion = self._posicion_entrada(digest)
+        self._bloquear()
+        try:
+            guardado, inicio, tam, crc, expira = _ENTRADA.unpack_from(self._mem, posicion)
+            if guardado != digest or expira < time.monotonic():
+                return None
+            cursor, _ = _CABECERA.unpack_from(self._mem, 0)
+            if inicio < cursor - self.tam_anillo:
+                return None  # el anillo ya pasó por encima
+            desde = self._inicio_anillo + inicio % self.tam_anillo
+            valor = self._mem[desde:desde + tam]
+        finally:
+            self._desbloquear()
+        return valor if zlib.crc32(valor) == crc else None
+
+    def set(self, clave: str, valor: bytes, ttl: float):
+        tam = len(valor)
+        if tam > self.tam_anillo // 8:
+            self.demasiado_grandes += 1
+            return
+        digest = _digest(clave)
+        posicion = self._posicion_entrada(digest)
+        crc = zlib.crc32(valor)
+        ahora = time.monotonic()
+        self._bloquear()
+        try:
+            cursor, desalojos = _CABECERA.unpack_from(self._mem, 0)
+            if cursor % self.tam_anillo + tam > self.tam_anillo:
+                cursor += self.tam_anillo - cursor % self.tam_anillo  # no cabe al final: vuelta al inicio
+            previo, inicio_previo, _, _, expira_previa = _ENTRADA.unpack_from(self._mem, posicion)
+            if previo != digest and expira_previa > ahora and inicio_previo >= cursor - self.tam_anillo:
+                desalojos += 1
+            # Primero se reserva el espacio: si el proceso muere a mitad de la copia, el índice
+            # sigue apuntando a datos válidos y lo siguiente se escribe más adelante
+            _CABECERA.pack_into(self._mem, 0, cursor + tam, desalojos)
+            desde = self._inicio_anillo + cursor % self.tam_anillo
+            self._mem[desde:desde + tam] = valor
+            _ENTRADA.pack_into(self._mem, posicion, digest, cursor, tam, crc, ahora + ttl)
+        finally:
+            self._desbloquear()
+
+    def get_contador(self, clave: str) -> int:
+        posicion = self._posicion_contador(clave)
+        self._bloquear()
+        try:
+            return _CONTADOR.unpack_from(self._mem, posicion)[0]
+        finally:
+            self._desbloquear()
+
+    def get_contadores(self, claves: list) -> list:
+        """Varios contadores bajo un solo lock (ej: las generaciones de un rango de días)."""
+        posiciones = [self._posicion_contador(clave) for clave in claves]
+        self._bloquear()
+        try:
+            return [_CONTADOR.unpack_from(self._mem, posicion)[0] for posicion in posiciones]
+        finally:
+            self._desbloquear()
+
+    def incr(self, clave: str) -> int:
+        posicion = self._posicion_contador(clave)
+        self._bloquear()
+        try:
+            valor = _CONTADOR.unpack_from(self._mem, posicion)[0] + 1
+            _CONTADOR.pack_into(self._mem, posicion, valor)
+            return valor
+        finally:
+            self._desbloquear()
+
+    @property
+    def desalojos(self) -> int:
+        return _CABECERA.unpack_from(self._mem, 0)[1]
+
+    def ocupadas(self) -> int:
+        """Entradas vigentes; recorre el índice sin lock (solo para métricas)."""
+        ahora = time.monotonic()
+        cursor, _ = _CABECERA.unpack_from(self._mem, 0)
+        vigentes = 0
+        for posicion in range(self._inicio_indice, self._inicio_anillo, _ENTRADA.size):
+            _, inicio, tam, _, expira = _ENTRADA.unpack_from(self._mem, posicion)
+            if tam and expira > ahora and inicio >= cursor - self.tam_anillo:
+                vigentes += 1
+        return vigentes
+
+    def stats(self) -> dict:
+        return {
+            "megas": self.tam_anillo // (1024 * 1024),
+            "entradas_max": self.entradas,
+            "entradas": self.ocupadas(),
+            "bytes_escritos": _CABECERA.unpack_from(self._mem, 0)[0],
+            "desalojos": self.desalojos,
+            "demasiado_grandes": self.demasiado_grandes,
+        }
+
+
+_segmento: Optional[SegmentoCompartido] = None
+
+
+def segmento_compartido() -> Optional[SegmentoCompartido]:
+    """El segmento del proceso (o del maestro, si se importó antes del fork). None si está desactivado."""
+    global _segmento
+    if _segmento is None and CACHE_COMPARTIDA_MB > 0:
+        _segmento = SegmentoCompartido(CACHE_COMPARTIDA_MB, CACHE_COMPARTIDA_ENTRADAS)
+    return _segmento
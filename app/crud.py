@@ -1,27 +1,55 @@
 # app/crud.py
+from asyncpg import BitString
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import selectinload
+from sqlalchemy import update, insert, delete, exists, literal, literal_column, true, bindparam, tuple_, cast, case, distinct, type_coerce, Date, Float, Integer, String
+from sqlalchemy.dialects.postgresql import ARRAY, BIT, aggregate_order_by, insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, aliased
 from sqlalchemy.sql import func
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from typing import Optional
 
 # Imports correctos (absolutos)
 from app import models, schemas
-from app.utils.security import hash_password
+from app.aeronaves import get_layout
+from app.metricas import presupuesto_consultas
+from app.utils.security import hash_password_async
 
 # --- Funciones de Auth ---
 
+@presupuesto_consultas(1)
 async def get_user_by_email(db: AsyncSession, email: str):
     result = await db.execute(select(models.Usuario).filter(models.Usuario.correo == email))
     return result.scalar_one_or_none()
 
+@presupuesto_consultas(1)
 async def get_user_by_id(db: AsyncSession, user_id: int):
     result = await db.execute(select(models.Usuario).filter(models.Usuario.id_usuario == user_id))
     return result.scalar_one_or_none()
 
+@presupuesto_consultas(1)
+async def get_token_version(db: AsyncSession, user_id: int):
+    result = await db.execute(select(models.Usuario.token_version).filter(models.Usuario.id_usuario == user_id))
+    return result.scalar_one_or_none()
+
+@presupuesto_consultas(1)
+async def revoke_user_tokens(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        update(models.Usuario)
+        .where(models.Usuario.id_usuario == user_id)
+        .values(token_version=models.Usuario.token_version + 1)
+        .returning(models.Usuario.token_version)
+    )
+    nueva_version = result.scalar_one_or_none()
+    await db.commit()
+    return nueva_version
+
 async def create_user(db: AsyncSession, usuario: schemas.UsuarioCreate):
-    hashed_password = hash_password(usuario.contraseña)
+    # El hash va antes de tocar la BD: la sesión no debe tener una transacción abierta
+    # (conexión tomada del pool) mientras espera a bcrypt
+    hashed_password = await hash_password_async(usuario.contraseña)
     nuevo_usuario = models.Usuario(
         nombre=usuario.nombre,
         correo=usuario.correo,
@@ -33,11 +61,29 @@ async def create_user(db: AsyncSession, usuario: schemas.UsuarioCreate):
     await db.refresh(nuevo_usuario)
     return nuevo_usuario
 
+# --- Versión de catálogos (invalidación de cachés) ---
+
+async def get_catalogo_version(db: AsyncSession, nombre: str):
+    result = await db.execute(
+        select(models.CatalogoVersion.version).filter(models.CatalogoVersion.nombre == nombre)
+    )
+    return result.scalar_one_or_none() or 0
+
+async def bump_catalogo_version(db: AsyncSession, nombre: str):
+    # Sin commit: debe ir en la misma transacción que el cambio del catálogo
+    stmt = pg_insert(models.CatalogoVersion).values(nombre=nombre, version=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.CatalogoVersion.nombre],
+        set_={"version": models.CatalogoVersion.version + 1},
+    )
+    await db.execute(stmt)
+
 # --- Funciones de Admin ---
 
 async def create_ciudad(db: AsyncSession, ciudad: schemas.CiudadCreate):
     nueva_ciudad = models.Ciudad(**ciudad.dict())
     db.add(nueva_ciudad)
+    await bump_catalogo_version(db, "ciudades")
     await db.commit()
     await db.refresh(nueva_ciudad)
     return nueva_ciudad
@@ -45,6 +91,7 @@ async def create_ciudad(db: AsyncSession, ciudad: schemas.CiudadCreate):
 async def create_equipaje(db: AsyncSession, equipaje: schemas.EquipajeCreate):
     nuevo_equipaje = models.Equipaje(**equipaje.dict())
     db.add(nuevo_equipaje)
+    await bump_catalogo_version(db, "equipajes")
     await db.commit()
     await db.refresh(nuevo_equipaje)
     return nuevo_equipaje
@@ -53,6 +100,63 @@ async def get_ciudad_by_id(db: AsyncSession, ciudad_id: int):
     result = await db.execute(select(models.Ciudad).filter(models.Ciudad.id_ciudad == ciudad_id))
     return result.scalar_one_or_none()
 
+async def get_ciudades_by_ids(db: AsyncSession, ciudad_ids):
+    result = await db.execute(select(models.Ciudad).filter(models.Ciudad.id_ciudad.in_(set(ciudad_ids))))
+    return {ciudad.id_ciudad: ciudad for ciudad in result.scalars().all()}
+
+async def create_vuelos_con_asientos(db: AsyncSession, vuelos: list[dict]):
+    """
+    Inserta varios vuelos y genera sus asientos con SQL por conjuntos:
+    un INSERT multi-fila para los vuelos y un INSERT ... SELECT con generate_series
+    por cada layout de aeronave, en lugar de un objeto ORM por asiento.
+
+    Cada dict de `vuelos` trae las columnas de models.Vuelo (codigo, ciudades, fechas,
+    precio_base y tipo_aeronave). Devuelve las filas creadas en el mismo orden.
+    """
+    filas_vuelo = []
+    for vuelo in vuelos:
+        layout = get_layout(vuelo.get("tipo_aeronave"))
+        filas_vuelo.append({
+            **vuelo,
+            "asientos_totales": layout.total,
+            "asientos_disponibles": layout.total,
+            "mapa_asientos": BitString("1" * layout.total),  # todos disponibles
+            "mapa_columnas": layout.columnas,
+        })
+
+    result = await db.execute(
+        insert(models.Vuelo).returning(
+            models.Vuelo.id_vuelo,
+            models.Vuelo.codigo,
+            models.Vuelo.precio_base,
+            models.Vuelo.asientos_totales,
+            models.Vuelo.tipo_aeronave,
+            sort_by_parameter_order=True,
+        ),
+        filas_vuelo,
+    )
+    creados = result.all()
+
+    # Un INSERT ... SELECT por layout: ids x generate_series(filas) x columnas
+    ids_por_layout = defaultdict(list)
+    for vuelo in creados:
+        ids_por_layout[get_layout(vuelo.tipo_aeronave)].append(vuelo.id_vuelo)
+
+    for layout, ids_vuelo in ids_por_layout.items():
+        vuelos_sel = func.unnest(bindparam("ids_vuelo", ids_vuelo, type_=ARRAY(Integer))).table_valued("id_vuelo").render_derived("v")
+        filas_sel = func.generate_series(1, layout.filas).table_valued("fila").render_derived("f")
+        columnas_sel = func.unnest(bindparam("columnas", list(layout.columnas), type_=ARRAY(String))).table_valued("columna").render_derived("c")
+        await db.execute(
+            insert(models.Asiento).from_select(
+                ["id_vuelo", "fila", "columna", "disponible"],
+                select(vuelos_sel.c.id_vuelo, filas_sel.c.fila, columnas_sel.c.columna, true())
+                .select_from(vuelos_sel.join(filas_sel, true()).join(columnas_sel, true()))
+            )
+        )
+
+    await db.commit()
+    return creados
+
 async def create_vuelo(db: AsyncSession, vuelo: schemas.VueloCreate):
     # Nota: El router ya procesa el objeto Vuelo con el código generado,
     # así que aquí simplemente lo guardamos si viene como dict o como objeto.
@@ -69,10 +173,12 @@ async def create_vuelo(db: AsyncSession, vuelo: schemas.VueloCreate):
 
 # --- Funciones de Cliente/Públicas ---
 
+@presupuesto_consultas(1)
 async def get_vuelo_by_id(db: AsyncSession, vuelo_id: int):
+    # joinedload: vuelo + ciudades en una sola consulta
     result = await db.execute(
         select(models.Vuelo)
-        .options(selectinload(models.Vuelo.origen), selectinload(models.Vuelo.destino))
+        .options(joinedload(models.Vuelo.origen), joinedload(models.Vuelo.destino))
         .filter(models.Vuelo.id_vuelo == vuelo_id)
     )
     return result.scalar_one_or_none()
@@ -85,13 +191,54 @@ async def count_total_asientos(db: AsyncSession, id_vuelo: int):
     )
     return result.scalar_one()
 
-async def get_asientos(db: AsyncSession):
-   
-    result = await db.execute(
-        select(models.Asiento)
+# Columnas de los listados grandes: se devuelven como filas planas (sin hidratar objetos ORM)
+COLUMNAS_ASIENTO = (
+    models.Asiento.id_asiento,
+    models.Asiento.id_vuelo,
+    models.Asiento.fila,
+    models.Asiento.columna,
+    models.Asiento.disponible,
+)
+COLUMNAS_VUELO_BUSQUEDA = (
+    models.Vuelo.id_vuelo,
+    models.Vuelo.codigo,
+    models.Vuelo.fecha_salida,
+    models.Vuelo.fecha_llegada,
+    cast(models.Vuelo.precio_base, Float).label("precio_base"),
+)
+
+@presupuesto_consultas(1)
+async def get_asientos(db: AsyncSession, limite: Optional[int] = None, despues_de: Optional[int] = None):
+    # Paginación keyset por id_asiento (orden estable, usa la PK); filas de columnas, sin ORM
+    stmt = select(*COLUMNAS_ASIENTO).order_by(models.Asiento.id_asiento)
+
+    if despues_de is not None:
+        stmt = stmt.filter(models.Asiento.id_asiento > despues_de)
+
+    if limite is not None:
+        stmt = stmt.limit(limite)
+
+    result = await db.execute(stmt)
+    return result.all()
+
+async def stream_asientos(db: AsyncSession, tamano_lote: int = 1000):
+    """
+    Recorre todos los asientos con un cursor del lado del servidor,
+    entregando lotes de filas (columnas planas, sin entidades ORM).
+    """
+    result = await db.stream(
+        select(
+            models.Asiento.id_asiento,
+            models.Asiento.id_vuelo,
+            models.Asiento.fila,
+            models.Asiento.columna,
+            models.Asiento.disponible,
+        )
+        .order_by(models.Asiento.id_asiento)
+        .execution_options(yield_per=tamano_lote)
     )
-    
-    return result.scalars().all()
+    async for lote in result.partitions(tamano_lote):
+        yield lote
 # --- CORRECCIÓN AQUÍ: Cambiado 'vuelo_id' por 'id_vuelo' ---
 async def count_asientos_disponibles(db: AsyncSession, id_vuelo: int):
     result = await db.execute(
@@ -100,25 +247,35 @@ async def count_asientos_disponibles(db: AsyncSession, id_vuelo: int):
     )
     return result.scalar_one()
 
+@presupuesto_consultas(1)
 async def get_asientos_by_vuelo_id(db: AsyncSession, vuelo_id: int):
-    result = await db.execute(select(models.Asiento).filter(models.Asiento.id_vuelo == vuelo_id))
-    return result.scalars().all()
+    result = await db.execute(
+        select(*COLUMNAS_ASIENTO)
+        .filter(models.Asiento.id_vuelo == vuelo_id)
+        .order_by(models.Asiento.fila, models.Asiento.columna)
+    )
+    return result.all()
 
 async def get_all_equipajes(db: AsyncSession):
-    result = await db.execute(select(models.Equipaje))
+    result = await db.execute(select(models.Equipaje).order_by(models.Equipaje.id_equipaje))
     return result.scalars().all()
 
 async def get_all_ciudades(db: AsyncSession):
-    result = await db.execute(select(models.Ciudad))
+    result = await db.execute(select(models.Ciudad).order_by(models.Ciudad.id_ciudad))
     return result.scalars().all()
 
+@presupuesto_consultas(1)
 async def search_vuelos(
         db: AsyncSession,
         origen_id: Optional[int] = None,
         destino_id: Optional[int] = None,
-        fecha: Optional[datetime] = None
+        fecha: Optional[datetime] = None,
+        limite: Optional[int] = None,
+        despues_de: Optional[tuple] = None
 ):
-    stmt = select(models.Vuelo)
+    # Orden estable (fecha_salida, id_vuelo) para la paginación keyset;
+    # despues_de es la clave de la última fila de la página anterior.
+    stmt = select(*COLUMNAS_VUELO_BUSQUEDA).order_by(models.Vuelo.fecha_salida, models.Vuelo.id_vuelo)
 
     if origen_id is not None:
         stmt = stmt.filter(models.Vuelo.id_origen == origen_id)
@@ -135,8 +292,85 @@ async def search_vuelos(
             models.Vuelo.fecha_salida < fecha_fin
         )
 
+    if despues_de is not None:
+        stmt = stmt.filter(tuple_(models.Vuelo.fecha_salida, models.Vuelo.id_vuelo) > tuple_(*despues_de))
+
+    if limite is not None:
+        stmt = stmt.limit(limite)
+
     result = await db.execute(stmt)
-    return result.scalars().all()
+    return result.all()
+
+@presupuesto_consultas(1)
+async def get_calendario_tarifas(db: AsyncSession, origen_id: int, destino_id: int, desde: date, hasta: date):
+    # Un solo agregado agrupado por día (usa ix_vuelo_ruta_fecha); el precio mínimo
+    # solo considera vuelos con asientos libres
+    dia = cast(models.Vuelo.fecha_salida, Date).label("dia")
+    con_asientos = func.coalesce(models.Vuelo.asientos_disponibles, 1) > 0
+    result = await db.execute(
+        select(
+            dia,
+            func.min(models.Vuelo.precio_base).filter(con_asientos),
+            func.count(),
+            func.coalesce(func.sum(models.Vuelo.asientos_disponibles), 0),
+        )
+        .filter(
+            models.Vuelo.id_origen == origen_id,
+            models.Vuelo.id_destino == destino_id,
+            models.Vuelo.fecha_salida >= desde,
+            models.Vuelo.fecha_salida < hasta + timedelta(days=1),
+        )
+        .group_by(dia)
+        .order_by(dia)
+    )
+    return [
+        (fila[0], float(fila[1]) if fila[1] is not None else None, fila[2], int(fila[3]))
+        for fila in result.all()
+    ]
+
+@presupuesto_consultas(1)
+async def get_tramos_vuelo(db: AsyncSession, desde: datetime):
+    # Filas planas para el grafo de rutas: vuelos que aún no salen y no están agotados, con los
+    # códigos de ciudad (asientos_disponibles NULL = vuelo viejo sin contador, se deja pasar)
+    origen = aliased(models.Ciudad)
+    destino = aliased(models.Ciudad)
+    result = await db.execute(
+        select(
+            models.Vuelo.fecha_salida,
+            models.Vuelo.id_vuelo,
+            models.Vuelo.codigo,
+            models.Vuelo.id_origen,
+            models.Vuelo.id_destino,
+            models.Vuelo.fecha_llegada,
+            models.Vuelo.precio_base,
+            origen.codigo,
+            destino.codigo,
+        )
+        .join(origen, origen.id_ciudad == models.Vuelo.id_origen)
+        .join(destino, destino.id_ciudad == models.Vuelo.id_destino)
+        .filter(models.Vuelo.fecha_salida >= desde, models.Vuelo.asientos_disponibles.is_distinct_from(0))
+    )
+    return result.all()
+
+async def stream_vuelos(db: AsyncSession, tamano_lote: int = 1000):
+    """Recorre todos los vuelos con un cursor del lado del servidor, en lotes."""
+    result = await db.stream(
+        select(
+            models.Vuelo.id_vuelo,
+            models.Vuelo.codigo,
+            models.Vuelo.id_origen,
+            models.Vuelo.id_destino,
+            models.Vuelo.fecha_salida,
+            models.Vuelo.fecha_llegada,
+            models.Vuelo.precio_base,
+            models.Vuelo.asientos_totales,
+            models.Vuelo.asientos_disponibles,
+        )
+        .order_by(models.Vuelo.fecha_salida, models.Vuelo.id_vuelo)
+        .execution_options(yield_per=tamano_lote)
+    )
+    async for lote in result.partitions(tamano_lote):
+        yield lote
 
 async def get_asiento_by_id(db: AsyncSession, asiento_id: int):
     result = await db.execute(select(models.Asiento).filter(models.Asiento.id_asiento == asiento_id))
@@ -146,39 +380,666 @@ async def get_equipaje_by_id(db: AsyncSession, equipaje_id: int):
     result = await db.execute(select(models.Equipaje).filter(models.Equipaje.id_equipaje == equipaje_id))
     return result.scalar_one_or_none()
 
-async def create_reserva(db: AsyncSession, reserva: schemas.ReservaRequest, total: float):
-    asiento = await get_asiento_by_id(db, reserva.id_asiento)
-    if asiento:
-        asiento.disponible = False
-        db.add(asiento)
+# --- Mapa de bits de asientos (vuelo.mapa_asientos) ---
+
+def _mascara_asientos(asientos):
+    """
+    Subconsulta correlacionada para un UPDATE de vuelo: máscara del largo del mapa del vuelo con un 1
+    en la posición de cada asiento de `asientos` (CTE con id_vuelo, fila y columna) de ese vuelo.
+    """
+    ceros = models.Vuelo.mapa_asientos.bitwise_xor(models.Vuelo.mapa_asientos)
+    posicion = (
+        (asientos.c.fila - 1) * func.length(models.Vuelo.mapa_columnas)
+        + func.strpos(models.Vuelo.mapa_columnas, asientos.c.columna) - 1
+    )
+    return type_coerce(
+        select(func.bit_or(func.set_bit(ceros, posicion, 1)))
+        .where(asientos.c.id_vuelo == models.Vuelo.id_vuelo)
+        .scalar_subquery(),
+        BIT(varying=True),
+    )
+
+def _ocupar_en_mapa(asientos) -> dict:
+    return {
+        "mapa_asientos": models.Vuelo.mapa_asientos.bitwise_and(_mascara_asientos(asientos).bitwise_not()),
+        "mapa_version": models.Vuelo.mapa_version + 1,
+        "cambiado_en": _ahora_utc(),
+    }
+
+def _liberar_en_mapa(asientos) -> dict:
+    return {
+        "mapa_asientos": models.Vuelo.mapa_asientos.bitwise_or(_mascara_asientos(asientos)),
+        "mapa_version": models.Vuelo.mapa_version + 1,
+        "cambiado_en": _ahora_utc(),
+    }
 
-    nueva_reserva = models.Reserva(
-        id_usuario=reserva.id_usuario,
-        id_vuelo=reserva.id_vuelo,
-        id_asiento=reserva.id_asiento,
-        id_equipaje=reserva.id_equipaje,
-        total=total
+@presupuesto_consultas(1)
+async def get_mapa_asientos(db: AsyncSession, vuelo_id: int):
+    """Mapa de bits, columnas y versión del vuelo (None si no existe). Una lectura por clave primaria."""
+    result = await db.execute(
+        select(models.Vuelo.mapa_asientos, models.Vuelo.mapa_columnas, models.Vuelo.mapa_version)
+        .filter(models.Vuelo.id_vuelo == vuelo_id)
     )
-    db.add(nueva_reserva)
+    return result.one_or_none()
+
+@presupuesto_consultas(1)
+async def create_reserva(db: AsyncSession, reserva: schemas.ReservaRequest, confirmar: bool = True):
+    """
+    Crea la reserva en un solo round trip:
+    valida vuelo y equipaje, reclama el asiento con un UPDATE condicional
+    (WHERE disponible) e inserta la reserva, todo en la misma sentencia.
+    Si no se indica id_asiento se toma el primer asiento libre del vuelo
+    con FOR UPDATE SKIP LOCKED, así las peticiones concurrentes no se bloquean entre sí.
+
+    Devuelve una fila con precio_base, la ruta del vuelo (id_origen, id_destino, fecha_salida),
+    equipaje_existe, id_reserva, id_asiento y total.
+    precio_base es None si el vuelo no existe; id_reserva es None si el asiento no se pudo reclamar.
+    """
+    vuelo = (
+        select(
+            models.Vuelo.id_vuelo,
+            models.Vuelo.precio_base,
+            models.Vuelo.id_origen,
+            models.Vuelo.id_destino,
+            models.Vuelo.fecha_salida,
+        )
+        .filter(models.Vuelo.id_vuelo == reserva.id_vuelo)
+        .cte("v")
+    )
+    equipaje = (
+        select(models.Equipaje.id_equipaje, models.Equipaje.precio)
+        .filter(models.Equipaje.id_equipaje == reserva.id_equipaje)
+        .cte("e")
+    )
+
+    if reserva.id_asiento is not None:
+        asiento_objetivo = models.Asiento.id_asiento == reserva.id_asiento
+    else:
+        primer_libre = (
+            select(models.Asiento.id_asiento)
+            .filter(models.Asiento.id_vuelo == reserva.id_vuelo, models.Asiento.disponible == True)
+            .order_by(models.Asiento.fila, models.Asiento.columna)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        asiento_objetivo = models.Asiento.id_asiento == primer_libre
+
+    asiento = (
+        update(models.Asiento)
+        .where(
+            asiento_objetivo,
+            models.Asiento.id_vuelo == reserva.id_vuelo,
+            models.Asiento.disponible == True,
+            exists(select(vuelo.c.id_vuelo)),
+            exists(select(equipaje.c.id_equipaje)),
+        )
+        .values(disponible=False)
+        .returning(models.Asiento.id_asiento, models.Asiento.id_vuelo, models.Asiento.fila, models.Asiento.columna)
+        .cte("a")
+    )
+
+    # Contador y mapa de bits del vuelo: solo cambian si el asiento se reclamó
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == reserva.id_vuelo, exists(select(asiento.c.id_asiento)))
+        .values(asientos_disponibles=models.Vuelo.asientos_disponibles - 1, **_ocupar_en_mapa(asiento))
+        .returning(models.Vuelo.id_vuelo)
+        .cte("c")
+    )
+
+    nueva_reserva = (
+        insert(models.Reserva)
+        .from_select(
+            ["id_usuario", "id_vuelo", "id_asiento", "id_equipaje", "total"],
+            select(
+                literal(reserva.id_usuario),
+                vuelo.c.id_vuelo,
+                asiento.c.id_asiento,
+                equipaje.c.id_equipaje,
+                vuelo.c.precio_base + equipaje.c.precio,
+            ).select_from(asiento.join(vuelo, true()).join(equipaje, true()))
+        )
+        .returning(models.Reserva.id_reserva, models.Reserva.id_asiento, models.Reserva.total)
+        .cte("r")
+    )
+
+    result = await db.execute(
+        select(
+            select(vuelo.c.precio_base).scalar_subquery().label("precio_base"),
+            select(vuelo.c.id_origen).scalar_subquery().label("id_origen"),
+            select(vuelo.c.id_destino).scalar_subquery().label("id_destino"),
+            select(vuelo.c.fecha_salida).scalar_subquery().label("fecha_salida"),
+            exists(select(equipaje.c.id_equipaje)).label("equipaje_existe"),
+            select(nueva_reserva.c.id_reserva).scalar_subquery().label("id_reserva"),
+            select(nueva_reserva.c.id_asiento).scalar_subquery().label("id_asiento"),
+            select(nueva_reserva.c.total).scalar_subquery().label("total"),
+            exists(select(contador.c.id_vuelo)).label("contador_actualizado"),
+        )
+    )
+    resultado = result.one()
+    if confirmar:
+        await db.commit()
+    return resultado
+
+@presupuesto_consultas(1)
+async def create_reservas_lote(db: AsyncSession, lote: schemas.ReservaLoteRequest, confirmar: bool = True):
+    """
+    Reserva varios asientos de un mismo vuelo en una sola sentencia, todo o nada.
+
+    Los asientos pedidos se bloquean con FOR UPDATE y los "cualquier asiento" se toman con
+    FOR UPDATE SKIP LOCKED; el UPDATE de asientos, el contador del vuelo y el INSERT de
+    todas las reservas solo ocurren si se consiguieron todos los asientos, existe el vuelo
+    y existen todos los equipajes (leídos en una única consulta).
+
+    Devuelve una fila con los datos del vuelo, equipajes_ok, asientos_bloqueados (los pedidos
+    que siguen libres), ok y los arrays id_reserva / id_asiento / id_equipaje / total de las
+    reservas creadas (vacíos si no se creó ninguna).
+    """
+    explicitos = [p for p in lote.pasajeros if p.id_asiento is not None]
+    automaticos = [p for p in lote.pasajeros if p.id_asiento is None]
+    ids_explicitos = [p.id_asiento for p in explicitos]
+    ids_equipaje = sorted({p.id_equipaje for p in lote.pasajeros})
+
+    vuelo = (
+        select(
+            models.Vuelo.id_vuelo,
+            models.Vuelo.precio_base,
+            models.Vuelo.id_origen,
+            models.Vuelo.id_destino,
+            models.Vuelo.fecha_salida,
+        )
+        .filter(models.Vuelo.id_vuelo == lote.id_vuelo)
+        .cte("v")
+    )
+    equipajes = (
+        select(models.Equipaje.id_equipaje, models.Equipaje.precio)
+        .filter(models.Equipaje.id_equipaje == func.any(bindparam("ids_equipaje", ids_equipaje, type_=ARRAY(Integer))))
+        .cte("e")
+    )
+
+    # Asientos pedidos: se espera a que se liberen los bloqueos (puede que otro los tome)
+    pedidos = (
+        select(models.Asiento.id_asiento)
+        .filter(
+            models.Asiento.id_vuelo == lote.id_vuelo,
+            models.Asiento.disponible == True,
+            models.Asiento.id_asiento == func.any(bindparam("ids_asiento", ids_explicitos, type_=ARRAY(Integer))),
+        )
+        .with_for_update()
+        .cte("l1")
+    )
+    # Asientos libres para los pasajeros sin asiento elegido (sin esperar a otras transacciones)
+    libres = (
+        select(models.Asiento.id_asiento)
+        .filter(
+            models.Asiento.id_vuelo == lote.id_vuelo,
+            models.Asiento.disponible == True,
+            models.Asiento.id_asiento != func.all(bindparam("ids_asiento", ids_explicitos, type_=ARRAY(Integer))),
+        )
+        .order_by(models.Asiento.fila, models.Asiento.columna)
+        .limit(len(automaticos))
+        .with_for_update(skip_locked=True)
+        .cte("l2")
+    )
+    libres_numerados = select(
+        libres.c.id_asiento, func.row_number().over(order_by=libres.c.id_asiento).label("n")
+    ).cte("l2n")
+
+    ok = (
+        (select(func.count()).select_from(pedidos).scalar_subquery() == len(explicitos))
+        & (select(func.count()).select_from(libres).scalar_subquery() == len(automaticos))
+        & (select(func.count()).select_from(equipajes).scalar_subquery() == len(ids_equipaje))
+        & exists(select(vuelo.c.id_vuelo))
+    )
+
+    reclamados = (
+        update(models.Asiento)
+        .where(
+            models.Asiento.id_asiento.in_(select(pedidos.c.id_asiento).union_all(select(libres.c.id_asiento))),
+            ok,
+        )
+        .values(disponible=False)
+        .returning(models.Asiento.id_asiento, models.Asiento.id_vuelo, models.Asiento.fila, models.Asiento.columna)
+        .cte("a")
+    )
+
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == lote.id_vuelo, exists(select(reclamados.c.id_asiento)))
+        .values(
+            asientos_disponibles=models.Vuelo.asientos_disponibles - select(func.count()).select_from(reclamados).scalar_subquery(),
+            **_ocupar_en_mapa(reclamados),
+        )
+        .returning(models.Vuelo.id_vuelo)
+        .cte("c")
+    )
+
+    # Asiento -> equipaje de cada pasajero: los pedidos por id, los automáticos por orden
+    asignacion_pedidos = func.unnest(
+        bindparam("asig_asientos", ids_explicitos, type_=ARRAY(Integer)),
+        bindparam("asig_equipajes", [p.id_equipaje for p in explicitos], type_=ARRAY(Integer)),
+    ).table_valued("id_asiento", "id_equipaje").render_derived("pe")
+    equipajes_automaticos = func.unnest(
+        bindparam("auto_equipajes", [p.id_equipaje for p in automaticos], type_=ARRAY(Integer))
+    ).table_valued("id_equipaje", with_ordinality="n").render_derived("pa")
+    asignacion = (
+        select(asignacion_pedidos.c.id_asiento, asignacion_pedidos.c.id_equipaje)
+        .union_all(
+            select(libres_numerados.c.id_asiento, equipajes_automaticos.c.id_equipaje)
+            .select_from(libres_numerados.join(equipajes_automaticos, equipajes_automaticos.c.n == libres_numerados.c.n))
+        )
+        .cte("asig")
+    )
+
+    nuevas = (
+        insert(models.Reserva)
+        .from_select(
+            ["id_usuario", "id_vuelo", "id_asiento", "id_equipaje", "total"],
+            select(
+                literal(lote.id_usuario),
+                vuelo.c.id_vuelo,
+                asignacion.c.id_asiento,
+                asignacion.c.id_equipaje,
+                vuelo.c.precio_base + equipajes.c.precio,
+            ).select_from(
+                asignacion
+                .join(reclamados, reclamados.c.id_asiento == asignacion.c.id_asiento)
+                .join(vuelo, true())
+                .join(equipajes, equipajes.c.id_equipaje == asignacion.c.id_equipaje)
+            )
+        )
+        .returning(models.Reserva.id_reserva, models.Reserva.id_asiento, models.Reserva.id_equipaje, models.Reserva.total)
+        .cte("r")
+    )
+
+    def agregado(columna):
+        return select(func.array_agg(aggregate_order_by(columna, nuevas.c.id_reserva))).scalar_subquery()
+
+    result = await db.execute(
+        select(
+            select(vuelo.c.precio_base).scalar_subquery().label("precio_base"),
+            select(vuelo.c.id_origen).scalar_subquery().label("id_origen"),
+            select(vuelo.c.id_destino).scalar_subquery().label("id_destino"),
+            select(vuelo.c.fecha_salida).scalar_subquery().label("fecha_salida"),
+            (select(func.count()).select_from(equipajes).scalar_subquery() == len(ids_equipaje)).label("equipajes_ok"),
+            select(func.array_agg(pedidos.c.id_asiento)).scalar_subquery().label("asientos_bloqueados"),
+            exists(select(contador.c.id_vuelo)).label("contador_actualizado"),
+            agregado(nuevas.c.id_reserva).label("id_reserva"),
+            agregado(nuevas.c.id_asiento).label("id_asiento"),
+            agregado(nuevas.c.id_equipaje).label("id_equipaje"),
+            agregado(nuevas.c.total).label("total"),
+        )
+    )
+    resultado = result.one()
+    if confirmar:
+        await db.commit()
+    return resultado
+
+@presupuesto_consultas(1)
+async def release_asiento(db: AsyncSession, asiento_id: int):
+    """
+    Libera un asiento ocupado y devuelve el cupo al contador del vuelo en la misma sentencia.
+    Devuelve el id_vuelo afectado, o None si el asiento no existía o ya estaba libre.
+    No hace commit: se usa dentro de la transacción del llamador.
+    """
+    asiento = (
+        update(models.Asiento)
+        .where(models.Asiento.id_asiento == asiento_id, models.Asiento.disponible == False)
+        .values(disponible=True, retenido_hasta=None, retenido_por=None)
+        .returning(models.Asiento.id_vuelo, models.Asiento.fila, models.Asiento.columna)
+        .cte("a")
+    )
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == select(asiento.c.id_vuelo).scalar_subquery())
+        .values(asientos_disponibles=models.Vuelo.asientos_disponibles + 1, **_liberar_en_mapa(asiento))
+        .returning(models.Vuelo.id_vuelo)
+        .cte("c")
+    )
+    result = await db.execute(select(contador.c.id_vuelo))
+    return result.scalar_one_or_none()
+
+def _ahora_utc():
+    # timestamp sin zona en UTC, igual que los datetime.utcnow() de la aplicación
+    return func.timezone("UTC", func.now())
+
+@presupuesto_consultas(1)
+async def create_retencion(
+    db: AsyncSession, id_usuario: int, id_vuelo: int, id_asiento: Optional[int], minutos: int, max_activas: int
+):
+    """
+    Retiene un asiento (el indicado o el primer libre) durante `minutos`: lo marca no disponible,
+    guarda quién lo retiene y hasta cuándo, y descuenta el contador del vuelo, en una sola sentencia.
+    Solo si el usuario tiene menos de `max_activas` retenciones vigentes (dentro_del_limite).
+    Devuelve la ruta del vuelo (id_origen None si no existe), id_asiento y retenido_hasta
+    (None si no se pudo retener).
+    """
+    # Se cuenta con la foto de la sentencia: dos retenciones simultáneas del mismo usuario
+    # pueden pasarse del límite por una, no más
+    activas = (
+        select(func.count())
+        .select_from(models.Asiento)
+        .where(models.Asiento.retenido_por == id_usuario, models.Asiento.retenido_hasta > _ahora_utc())
+        .scalar_subquery()
+    )
+    dentro_del_limite = activas < max_activas
+    vuelo = (
+        select(models.Vuelo.id_vuelo, models.Vuelo.id_origen, models.Vuelo.id_destino, models.Vuelo.fecha_salida)
+        .filter(models.Vuelo.id_vuelo == id_vuelo)
+        .cte("v")
+    )
+    if id_asiento is not None:
+        asiento_objetivo = models.Asiento.id_asiento == id_asiento
+    else:
+        primer_libre = (
+            select(models.Asiento.id_asiento)
+            .filter(models.Asiento.id_vuelo == id_vuelo, models.Asiento.disponible == True)
+            .order_by(models.Asiento.fila, models.Asiento.columna)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        asiento_objetivo = models.Asiento.id_asiento == primer_libre
+
+    asiento = (
+        update(models.Asiento)
+        .where(
+            asiento_objetivo,
+            models.Asiento.id_vuelo == id_vuelo,
+            models.Asiento.disponible == True,
+            exists(select(vuelo.c.id_vuelo)),
+            dentro_del_limite,
+        )
+        .values(
+            disponible=False,
+            retenido_hasta=_ahora_utc() + timedelta(minutes=minutos),
+            retenido_por=id_usuario,
+        )
+        .returning(
+            models.Asiento.id_asiento,
+            models.Asiento.retenido_hasta,
+            models.Asiento.id_vuelo,
+            models.Asiento.fila,
+            models.Asiento.columna,
+        )
+        .cte("a")
+    )
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == id_vuelo, exists(select(asiento.c.id_asiento)))
+        .values(asientos_disponibles=models.Vuelo.asientos_disponibles - 1, **_ocupar_en_mapa(asiento))
+        .returning(models.Vuelo.id_vuelo)
+        .cte("c")
+    )
+    result = await db.execute(
+        select(
+            select(vuelo.c.id_origen).scalar_subquery().label("id_origen"),
+            select(vuelo.c.id_destino).scalar_subquery().label("id_destino"),
+            select(vuelo.c.fecha_salida).scalar_subquery().label("fecha_salida"),
+            select(asiento.c.id_asiento).scalar_subquery().label("id_asiento"),
+            select(asiento.c.retenido_hasta).scalar_subquery().label("retenido_hasta"),
+            dentro_del_limite.label("dentro_del_limite"),
+            exists(select(contador.c.id_vuelo)).label("contador_actualizado"),
+        )
+    )
+    resultado = result.one()
+    await db.commit()
+    return resultado
+
+@presupuesto_consultas(1)
+async def confirmar_retencion(db: AsyncSession, id_usuario: int, id_asiento: int, id_equipaje: int, confirmar: bool = True):
+    """
+    Paga una retención vigente del usuario: crea la Reserva y encola su cobro en trabajo_pago en
+    la misma sentencia. El asiento sigue retenido por el usuario pero sin vencimiento
+    (retenido_hasta NULL, el barrido no lo toca) hasta que registrar_resultados_pago lo deja
+    vendido al aprobarse el cobro o lo libera si falla.
+    Devuelve retenido_hasta (None si el asiento no está retenido por el usuario), en_pago (el cobro
+    de esa retención ya está encolado), equipaje_existe, id_reserva, total e id_trabajo
+    (None si no se confirmó).
+    """
+    equipaje = (
+        select(models.Equipaje.id_equipaje, models.Equipaje.precio)
+        .filter(models.Equipaje.id_equipaje == id_equipaje)
+        .cte("e")
+    )
+    asiento = (
+        update(models.Asiento)
+        .where(
+            models.Asiento.id_asiento == id_asiento,
+            models.Asiento.retenido_por == id_usuario,
+            models.Asiento.retenido_hasta > _ahora_utc(),
+            exists(select(equipaje.c.id_equipaje)),
+        )
+        .values(retenido_hasta=None)
+        .returning(models.Asiento.id_asiento, models.Asiento.id_vuelo)
+        .cte("a")
+    )
+    reserva = (
+        insert(models.Reserva)
+        .from_select(
+            ["id_usuario", "id_vuelo", "id_asiento", "id_equipaje", "total"],
+            select(
+                literal(id_usuario),
+                asiento.c.id_vuelo,
+                asiento.c.id_asiento,
+                equipaje.c.id_equipaje,
+                models.Vuelo.precio_base + equipaje.c.precio,
+            ).select_from(
+                asiento
+                .join(models.Vuelo, models.Vuelo.id_vuelo == asiento.c.id_vuelo)
+                .join(equipaje, true())
+            )
+        )
+        .returning(models.Reserva.id_reserva, models.Reserva.total)
+        .cte("r")
+    )
+    ahora = _ahora_utc()
+    trabajo = (
+        insert(models.TrabajoPago)
+        .from_select(
+            ["id_reserva", "id_usuario", "monto", "estado", "intentos", "disponible_en", "creado_en", "actualizado_en"],
+            select(
+                reserva.c.id_reserva, literal(id_usuario), reserva.c.total, literal("pendiente"), literal(0),
+                ahora, ahora, ahora,
+            ),
+        )
+        .returning(models.TrabajoPago.id_trabajo)
+        .cte("t")
+    )
+    retenido = (models.Asiento.id_asiento == id_asiento) & (models.Asiento.retenido_por == id_usuario)
+    result = await db.execute(
+        select(
+            select(models.Asiento.retenido_hasta).filter(retenido).scalar_subquery().label("retenido_hasta"),
+            exists(
+                select(models.Asiento.id_asiento).filter(retenido, models.Asiento.retenido_hasta.is_(None))
+            ).label("en_pago"),
+            exists(select(equipaje.c.id_equipaje)).label("equipaje_existe"),
+            select(reserva.c.id_reserva).scalar_subquery().label("id_reserva"),
+            select(reserva.c.total).scalar_subquery().label("total"),
+            select(trabajo.c.id_trabajo).scalar_subquery().label("id_trabajo"),
+        )
+    )
+    resultado = result.one()
+    if confirmar:
+        await db.commit()
+    return resultado
+
+@presupuesto_consultas(1)
+async def cancelar_retencion(db: AsyncSession, id_usuario: int, id_asiento: int):
+    """Libera una retención del usuario antes de que venza. Devuelve el vuelo (id_vuelo y su ruta) o None."""
+    asiento = (
+        update(models.Asiento)
+        .where(
+            models.Asiento.id_asiento == id_asiento,
+            models.Asiento.retenido_por == id_usuario,
+            models.Asiento.retenido_hasta.is_not(None),
+        )
+        .values(disponible=True, retenido_hasta=None, retenido_por=None)
+        .returning(models.Asiento.id_vuelo, models.Asiento.fila, models.Asiento.columna)
+        .cte("a")
+    )
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == select(asiento.c.id_vuelo).scalar_subquery())
+        .values(asientos_disponibles=models.Vuelo.asientos_disponibles + 1, **_liberar_en_mapa(asiento))
+        .returning(models.Vuelo.id_vuelo, models.Vuelo.id_origen, models.Vuelo.id_destino, models.Vuelo.fecha_salida)
+        .cte("c")
+    )
+    result = await db.execute(select(contador))
+    vuelo = result.one_or_none()
+    await db.commit()
+    return vuelo
+
+@presupuesto_consultas(1)
+async def liberar_retenciones_vencidas(db: AsyncSession, tamano_lote: int = 1000):
+    """
+    Libera hasta `tamano_lote` retenciones vencidas en una sola sentencia y devuelve los
+    asientos al contador de cada vuelo. Recorre solo ix_asiento_retenido_hasta (índice parcial)
+    y usa SKIP LOCKED para no pelear con pagos en curso. Devuelve por vuelo afectado
+    (id_vuelo, id_origen, id_destino, fecha_salida, liberados, asientos).
+    """
+    vencidas = (
+        select(models.Asiento.id_asiento)
+        .filter(models.Asiento.retenido_hasta < _ahora_utc())
+        .order_by(models.Asiento.retenido_hasta)
+        .limit(tamano_lote)
+        .with_for_update(skip_locked=True)
+        .cte("v")
+    )
+    liberados = (
+        update(models.Asiento)
+        .where(models.Asiento.id_asiento == vencidas.c.id_asiento)
+        .values(disponible=True, retenido_hasta=None, retenido_por=None)
+        .returning(models.Asiento.id_vuelo, models.Asiento.id_asiento, models.Asiento.fila, models.Asiento.columna)
+        .cte("a")
+    )
+    por_vuelo = (
+        select(
+            liberados.c.id_vuelo,
+            func.count().label("liberados"),
+            func.array_agg(liberados.c.id_asiento).label("asientos"),
+        )
+        .group_by(liberados.c.id_vuelo)
+        .cte("x")
+    )
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == por_vuelo.c.id_vuelo)
+        .values(asientos_disponibles=models.Vuelo.asientos_disponibles + por_vuelo.c.liberados, **_liberar_en_mapa(liberados))
+        .returning(
+            models.Vuelo.id_vuelo,
+            models.Vuelo.id_origen,
+            models.Vuelo.id_destino,
+            models.Vuelo.fecha_salida,
+            por_vuelo.c.liberados,
+            por_vuelo.c.asientos,
+        )
+        .cte("c")
+    )
+    result = await db.execute(select(contador))
+    vuelos = result.all()
     await db.commit()
-    await db.refresh(nueva_reserva)
-    return nueva_reserva
+    return vuelos
 
+@presupuesto_consultas(2)
+async def reconcile_contadores_vuelo(
+    db: AsyncSession, cambiados_desde: datetime | None = None, despues_de: int = 0, limite: int = 500
+):
+    """
+    Recalcula asientos_totales/asientos_disponibles y el mapa de bits de un lote de vuelos
+    (los `limite` siguientes a `despues_de` por id_vuelo; con `cambiados_desde`, solo los que
+    cambiaron desde entonces). Devuelve (último id_vuelo del lote o None si no quedan, corregidos).
+
+    Primero bloquea las filas de vuelo del lote y recién después cuenta sus asientos: una reserva
+    que ya tocó el vuelo termina antes de que se cuente, y una que todavía no lo tocó espera el
+    lock y aplica su -1 sobre el valor recalculado. Contando antes de bloquear (como en una sola
+    UPDATE ... FROM) se pisaría con un valor viejo lo que una reserva concurrente acaba de escribir.
+    """
+    candidatos = (
+        select(models.Vuelo.id_vuelo)
+        .where(models.Vuelo.id_vuelo > despues_de)
+        .order_by(models.Vuelo.id_vuelo)
+        .limit(limite)
+        .with_for_update()
+    )
+    if cambiados_desde is not None:
+        candidatos = candidatos.where(models.Vuelo.cambiado_en >= cambiados_desde)
+    ids = (await db.execute(candidatos)).scalars().all()
+    if not ids:
+        await db.commit()
+        return None, []
+
+    # En READ COMMITTED esta sentencia toma una foto nueva, posterior a los locks
+    conteo = (
+        select(
+            models.Asiento.id_vuelo.label("id_vuelo"),
+            func.count().label("totales"),
+            func.count().filter(models.Asiento.disponible == True).label("disponibles"),
+            cast(
+                func.string_agg(
+                    case((models.Asiento.disponible == True, "1"), else_="0"),
+                    aggregate_order_by(literal_column("''"), models.Asiento.fila, models.Asiento.columna),
+                ),
+                BIT(varying=True),
+            ).label("mapa"),
+            func.string_agg(
+                distinct(models.Asiento.columna), aggregate_order_by(literal_column("''"), models.Asiento.columna)
+            ).label("columnas"),
+        )
+        .where(models.Asiento.id_vuelo.in_(ids))
+        .group_by(models.Asiento.id_vuelo)
+        .subquery()
+    )
+    result = await db.execute(
+        update(models.Vuelo)
+        .where(
+            models.Vuelo.id_vuelo == conteo.c.id_vuelo,
+            (models.Vuelo.asientos_totales.is_distinct_from(conteo.c.totales))
+            | (models.Vuelo.asientos_disponibles.is_distinct_from(conteo.c.disponibles))
+            | (models.Vuelo.mapa_asientos.is_distinct_from(conteo.c.mapa))
+            | (models.Vuelo.mapa_columnas.is_distinct_from(conteo.c.columnas)),
+        )
+        .values(
+            asientos_totales=conteo.c.totales,
+            asientos_disponibles=conteo.c.disponibles,
+            mapa_asientos=conteo.c.mapa,
+            mapa_columnas=conteo.c.columnas,
+            mapa_version=models.Vuelo.mapa_version + 1,
+        )
+        .returning(models.Vuelo.id_vuelo)
+    )
+    corregidos = result.scalars().all()
+    await db.commit()
+    return ids[-1], corregidos
+
+@presupuesto_consultas(1)
 async def get_reservas_by_user_id(db: AsyncSession, usuario_id: int):
+    # Una sola consulta con los códigos de ciudad ya unidos (filas planas para el listado).
+    # Las reservas sin asiento (cobro de una retención fallido) no son reservas vigentes: no se listan.
+    origen = aliased(models.Ciudad)
+    destino = aliased(models.Ciudad)
     result = await db.execute(
-        select(models.Reserva)
-        .options(
-            selectinload(models.Reserva.vuelo).selectinload(models.Vuelo.origen),
-            selectinload(models.Reserva.vuelo).selectinload(models.Vuelo.destino)
+        select(
+            models.Reserva.id_reserva,
+            origen.codigo.label("codigo_origen"),
+            destino.codigo.label("codigo_destino"),
+            models.Vuelo.fecha_salida,
+            cast(models.Reserva.total, Float).label("total"),
         )
-        .filter(models.Reserva.id_usuario == usuario_id)
+        .join(models.Vuelo, models.Vuelo.id_vuelo == models.Reserva.id_vuelo)
+        .join(origen, origen.id_ciudad == models.Vuelo.id_origen)
+        .join(destino, destino.id_ciudad == models.Vuelo.id_destino)
+        .filter(models.Reserva.id_usuario == usuario_id, models.Reserva.id_asiento.is_not(None))
+        .order_by(models.Reserva.id_reserva)
     )
-    return result.scalars().all()
+    return result.all()
 
+@presupuesto_consultas(1)
 async def get_reserva_by_id_and_user(db: AsyncSession, reserva_id: int, usuario_id: int):
     result = await db.execute(
         select(models.Reserva)
-        .options(selectinload(models.Reserva.pago))
+        .options(joinedload(models.Reserva.pago))
         .filter(
             models.Reserva.id_reserva == reserva_id,
             models.Reserva.id_usuario == usuario_id
@@ -186,6 +1047,7 @@ async def get_reserva_by_id_and_user(db: AsyncSession, reserva_id: int, usuario_
     )
     return result.scalar_one_or_none()
 
+@presupuesto_consultas(1)
 async def create_pago(db: AsyncSession, reserva: models.Reserva):
     pago = models.Pago(
         id_reserva=reserva.id_reserva,
@@ -194,6 +1056,390 @@ async def create_pago(db: AsyncSession, reserva: models.Reserva):
         fecha=datetime.utcnow()
     )
     db.add(pago)
+    await db.commit()  # el INSERT ... RETURNING ya trae id_pago, no hace falta refresh
+    return pago
+
+# --- Cola de pagos ---
+
+_TRABAJO_ACTIVO = models.TrabajoPago.estado.in_(("pendiente", "procesando"))
+
+@presupuesto_consultas(2)  # la segunda solo si choca con otro encolado de la misma reserva
+async def encolar_pago(db: AsyncSession, reserva_id: int, usuario_id: int, confirmar: bool = True):
+    """
+    Encola el cobro de una reserva del usuario en una sola sentencia. Si la reserva ya tiene un
+    trabajo activo devuelve ese (un doble clic no encola dos cobros). Un pago 'fallido' anterior
+    se borra al encolar el nuevo intento (el trabajo fallido conserva el motivo).
+    Devuelve reserva_existe, pagada, id_trabajo y creado (False si ya estaba encolado).
+    """
+    # Una reserva sin asiento (retención cuyo cobro falló) no se vuelve a cobrar
+    reserva = (
+        select(models.Reserva.id_reserva, models.Reserva.total)
+        .filter(
+            models.Reserva.id_reserva == reserva_id,
+            models.Reserva.id_usuario == usuario_id,
+            models.Reserva.id_asiento.is_not(None),
+        )
+        .cte("r")
+    )
+    pagada = exists(
+        select(models.Pago.id_pago).filter(models.Pago.id_reserva == reserva_id, models.Pago.estado == "pagado")
+    )
+    activo = (
+        select(models.TrabajoPago.id_trabajo)
+        .filter(models.TrabajoPago.id_reserva == reserva_id, _TRABAJO_ACTIVO)
+        .cte("t")
+    )
+    ahora = _ahora_utc()
+    # insert() y no pg_insert(...).on_conflict_do_nothing(): este último no entra en la caché de
+    # sentencias compiladas y compilarlo cuesta más que la consulta. Dos encolados simultáneos de la
+    # misma reserva los frena ux_trabajo_pago_reserva_activo y el perdedor reintenta abajo.
+    nuevo = (
+        insert(models.TrabajoPago)
+        .from_select(
+            ["id_reserva", "id_usuario", "monto", "estado", "intentos", "disponible_en", "creado_en", "actualizado_en"],
+            select(
+                reserva.c.id_reserva, literal(usuario_id), reserva.c.total, literal("pendiente"), literal(0),
+                ahora, ahora, ahora,
+            ).where(~pagada, ~exists(select(activo.c.id_trabajo))),
+        )
+        .returning(models.TrabajoPago.id_trabajo)
+        .cte("n")
+    )
+    fallido = (
+        delete(models.Pago)
+        .where(
+            models.Pago.id_reserva == reserva_id,
+            models.Pago.estado == "fallido",
+            exists(select(nuevo.c.id_trabajo)),
+        )
+        .returning(models.Pago.id_pago)
+        .cte("f")
+    )
+    consulta = (
+        select(
+            exists(select(reserva.c.id_reserva)).label("reserva_existe"),
+            pagada.label("pagada"),
+            func.coalesce(
+                select(nuevo.c.id_trabajo).scalar_subquery(),
+                select(activo.c.id_trabajo).scalar_subquery(),
+            ).label("id_trabajo"),
+            exists(select(nuevo.c.id_trabajo)).label("creado"),
+            select(func.count()).select_from(fallido).scalar_subquery().label("fallidos_borrados"),
+        )
+    )
+    try:
+        result = await db.execute(consulta)
+    except IntegrityError:
+        # Otra petición encoló la misma reserva a la vez: ahora su trabajo ya es visible
+        await db.rollback()
+        result = await db.execute(consulta)
+    resultado = result.one()
+    if confirmar:
+        await db.commit()
+    return resultado
+
+@presupuesto_consultas(1)
+async def get_trabajo_pago(db: AsyncSession, id_trabajo: int, usuario_id: int):
+    result = await db.execute(
+        select(
+            models.TrabajoPago.id_trabajo,
+            models.TrabajoPago.id_reserva,
+            models.TrabajoPago.monto,
+            models.TrabajoPago.estado,
+            models.TrabajoPago.intentos,
+            models.TrabajoPago.ultimo_error,
+            models.TrabajoPago.id_pago,
+            models.TrabajoPago.creado_en,
+            models.TrabajoPago.actualizado_en,
+        )
+        .filter(models.TrabajoPago.id_trabajo == id_trabajo, models.TrabajoPago.id_usuario == usuario_id)
+    )
+    return result.one_or_none()
+
+@presupuesto_consultas(1)
+async def reclamar_trabajos_pago(db: AsyncSession, tamano_lote: int, plazo: timedelta):
+    """
+    Toma hasta `tamano_lote` trabajos disponibles (SKIP LOCKED: varios workers no se pisan),
+    los marca 'procesando' con plazo hasta now + `plazo` y suma un intento. Un trabajo
+    'procesando' cuyo plazo venció (el worker se cayó) se vuelve a tomar.
+    Devuelve (id_trabajo, id_reserva, monto, intentos) por trabajo.
+    """
+    disponibles = (
+        select(models.TrabajoPago.id_trabajo)
+        .filter(_TRABAJO_ACTIVO, models.TrabajoPago.disponible_en <= _ahora_utc())
+        .order_by(models.TrabajoPago.disponible_en)
+        .limit(tamano_lote)
+        .with_for_update(skip_locked=True)
+        .cte("d")
+    )
+    tomados = (
+        update(models.TrabajoPago)
+        .where(models.TrabajoPago.id_trabajo == disponibles.c.id_trabajo)
+        .values(
+            estado="procesando",
+            intentos=models.TrabajoPago.intentos + 1,
+            disponible_en=_ahora_utc() + plazo,
+            actualizado_en=_ahora_utc(),
+        )
+        .returning(
+            models.TrabajoPago.id_trabajo,
+            models.TrabajoPago.id_reserva,
+            models.TrabajoPago.monto,
+            models.TrabajoPago.intentos,
+        )
+        .cte("c")
+    )
+    result = await db.execute(select(tomados))
+    trabajos = result.all()
+    await db.commit()
+    return trabajos
+
+@presupuesto_consultas(1)
+async def registrar_resultados_pago(db: AsyncSession, resultados: list, max_intentos: int, espera_base: timedelta):
+    """
+    Aplica los resultados de la pasarela de un lote en una sola sentencia. `resultados` son
+    tuplas (id_trabajo, intentos, resultado, referencia, mensaje) con resultado 'aprobado',
+    'rechazado' o 'error'. Aprobado inserta el Pago 'pagado'; rechazado, o error tras
+    `max_intentos`, inserta el Pago 'fallido'; un error con intentos restantes vuelve a
+    'pendiente' con espera exponencial (espera_base * 2^(intentos-1)).
+    Si la reserva viene de una retención en pago (confirmar_retencion), el resultado definitivo
+    la cierra: aprobado deja el asiento vendido y fallido lo libera (contador y mapa del vuelo)
+    y lo quita de la reserva.
+    Solo se aplica si el trabajo sigue en el mismo intento: si el plazo venció y otro worker
+    lo retomó, el resultado viejo se descarta. Devuelve por trabajo aplicado id_trabajo, estado
+    y, si liberó un asiento, id_asiento_liberado con el vuelo (id_vuelo, id_origen, id_destino,
+    fecha_salida); esas columnas son None en los demás.
+    """
+    ids, intentos, estados, referencias, mensajes = (list(c) for c in zip(*resultados))
+    recibidos = select(
+        func.unnest(
+            bindparam("ids", ids, type_=ARRAY(Integer)),
+            bindparam("intentos", intentos, type_=ARRAY(Integer)),
+            bindparam("resultados", estados, type_=ARRAY(String)),
+            bindparam("referencias", referencias, type_=ARRAY(String)),
+            bindparam("mensajes", mensajes, type_=ARRAY(String)),
+        ).table_valued("id_trabajo", "intentos", "resultado", "referencia", "mensaje").render_derived("x")
+    ).subquery("x")
+    aprobado = recibidos.c.resultado == "aprobado"
+    definitivo = aprobado | (recibidos.c.resultado == "rechazado") | (models.TrabajoPago.intentos >= max_intentos)
+    lote = (
+        select(
+            models.TrabajoPago.id_trabajo,
+            models.TrabajoPago.id_reserva,
+            models.TrabajoPago.monto,
+            models.TrabajoPago.intentos,
+            models.Reserva.id_asiento,
+            recibidos.c.referencia,
+            recibidos.c.mensaje,
+            aprobado.label("aprobado"),
+            definitivo.label("definitivo"),
+        )
+        .join(
+            recibidos,
+            (recibidos.c.id_trabajo == models.TrabajoPago.id_trabajo) & (recibidos.c.intentos == models.TrabajoPago.intentos),
+        )
+        .join(models.Reserva, models.Reserva.id_reserva == models.TrabajoPago.id_reserva)
+        .filter(models.TrabajoPago.estado == "procesando")
+        .with_for_update(of=models.TrabajoPago)
+        .cte("l")
+    )
+    # Retenciones en pago (retenido_por sin retenido_hasta) cuyo cobro terminó
+    retenciones = (
+        update(models.Asiento)
+        .where(
+            models.Asiento.id_asiento == lote.c.id_asiento,
+            lote.c.definitivo,
+            models.Asiento.retenido_por.is_not(None),
+            models.Asiento.retenido_hasta.is_(None),
+        )
+        .values(retenido_por=None, disponible=~lote.c.aprobado)
+        .returning(
+            models.Asiento.id_asiento,
+            models.Asiento.id_vuelo,
+            models.Asiento.fila,
+            models.Asiento.columna,
+            models.Asiento.disponible,
+        )
+        .cte("a")
+    )
+    liberados = select(retenciones).where(retenciones.c.disponible).cte("x")
+    por_vuelo = (
+        select(liberados.c.id_vuelo, func.count().label("liberados"))
+        .group_by(liberados.c.id_vuelo)
+        .cte("y")
+    )
+    contador = (
+        update(models.Vuelo)
+        .where(models.Vuelo.id_vuelo == por_vuelo.c.id_vuelo)
+        .values(asientos_disponibles=models.Vuelo.asientos_disponibles + por_vuelo.c.liberados, **_liberar_en_mapa(liberados))
+        .returning(models.Vuelo.id_vuelo, models.Vuelo.id_origen, models.Vuelo.id_destino, models.Vuelo.fecha_salida)
+        .cte("v")
+    )
+    sin_asiento = (
+        update(models.Reserva)
+        .where(models.Reserva.id_reserva == lote.c.id_reserva, lote.c.id_asiento == liberados.c.id_asiento)
+        .values(id_asiento=None)
+        .returning(models.Reserva.id_reserva)
+        .cte("s")
+    )
+    pagos = (
+        insert(models.Pago)
+        .from_select(
+            ["id_reserva", "monto", "estado", "fecha"],
+            select(
+                lote.c.id_reserva,
+                lote.c.monto,
+                case((lote.c.aprobado, literal("pagado")), else_=literal("fallido")),
+                _ahora_utc(),
+            ).where(lote.c.definitivo),
+        )
+        .returning(models.Pago.id_pago, models.Pago.id_reserva)
+        .cte("p")
+    )
+    aplicados = (
+        update(models.TrabajoPago)
+        .where(models.TrabajoPago.id_trabajo == lote.c.id_trabajo)
+        .values(
+            estado=case(
+                (lote.c.aprobado, "pagado"),
+                (lote.c.definitivo, "fallido"),
+                else_="pendiente",
+            ),
+            disponible_en=case(
+                (lote.c.definitivo, _ahora_utc()),
+                else_=_ahora_utc() + espera_base * func.power(2, lote.c.intentos - 1),
+            ),
+            referencia=lote.c.referencia,
+            ultimo_error=lote.c.mensaje,
+            id_pago=select(pagos.c.id_pago).where(pagos.c.id_reserva == lote.c.id_reserva).scalar_subquery(),
+            actualizado_en=_ahora_utc(),
+        )
+        .returning(models.TrabajoPago.id_trabajo, models.TrabajoPago.id_reserva, models.TrabajoPago.estado)
+        .cte("c")
+    )
+    result = await db.execute(
+        select(
+            aplicados.c.id_trabajo,
+            aplicados.c.estado,
+            liberados.c.id_asiento.label("id_asiento_liberado"),
+            contador.c.id_vuelo,
+            contador.c.id_origen,
+            contador.c.id_destino,
+            contador.c.fecha_salida,
+        )
+        .select_from(aplicados)
+        .join(lote, lote.c.id_trabajo == aplicados.c.id_trabajo)
+        .outerjoin(liberados, liberados.c.id_asiento == lote.c.id_asiento)
+        .outerjoin(contador, contador.c.id_vuelo == liberados.c.id_vuelo)
+        .outerjoin(sin_asiento, sin_asiento.c.id_reserva == aplicados.c.id_reserva)
+    )
+    filas = result.all()
+    await db.commit()
+    return filas
+
+# --- Claves de idempotencia ---
+
+@presupuesto_consultas(1)
+async def reclamar_clave_idempotencia(db: AsyncSession, id_usuario: int, clave: str, ruta: str, huella: str,
+                                      ttl: timedelta, en_curso_max: timedelta):
+    """
+    Registra la clave como "en curso" para esta petición. Si ya existe solo se la queda cuando
+    venció o cuando quedó en curso más de `en_curso_max` (el proceso que la tomó se cayó).
+    Devuelve el creada_en del reclamo si la petición es dueña de la clave y debe ejecutarse, o None.
+    """
+    ahora = _ahora_utc()
+    stmt = pg_insert(models.ClaveIdempotencia).values(
+        id_usuario=id_usuario, clave=clave, ruta=ruta, huella=huella, creada_en=ahora, expira_en=ahora + ttl,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.ClaveIdempotencia.id_usuario, models.ClaveIdempotencia.clave],
+        set_={
+            "ruta": stmt.excluded.ruta,
+            "huella": stmt.excluded.huella,
+            "estado": None,
+            "respuesta": None,
+            "creada_en": stmt.excluded.creada_en,
+            "expira_en": stmt.excluded.expira_en,
+        },
+        where=(models.ClaveIdempotencia.expira_en < ahora)
+        | (models.ClaveIdempotencia.estado.is_(None) & (models.ClaveIdempotencia.creada_en < ahora - en_curso_max)),
+    ).returning(models.ClaveIdempotencia.creada_en)
+    result = await db.execute(stmt)
+    reclamada_en = result.scalar_one_or_none()
+    await db.commit()
+    return reclamada_en
+
+@presupuesto_consultas(1)
+async def get_clave_idempotencia(db: AsyncSession, id_usuario: int, clave: str):
+    result = await db.execute(
+        select(
+            models.ClaveIdempotencia.ruta,
+            models.ClaveIdempotencia.huella,
+            models.ClaveIdempotencia.estado,
+            models.ClaveIdempotencia.respuesta,
+        )
+        .filter(models.ClaveIdempotencia.id_usuario == id_usuario, models.ClaveIdempotencia.clave == clave)
+    )
+    fila = result.one_or_none()
+    await db.commit()  # no dejar la transacción abierta entre sondeos
+    return fila
+
+@presupuesto_consultas(1)
+async def guardar_respuesta_idempotencia(db: AsyncSession, id_usuario: int, clave: str, estado: int, respuesta: str,
+                                         reclamada_en: datetime):
+    """
+    Guarda la respuesta y hace commit (también de la operación, si va en la misma transacción).
+    Solo si la clave sigue siendo del reclamo `reclamada_en`: si otra petición la retomó por
+    abandonada devuelve False sin confirmar nada.
+    """
+    result = await db.execute(
+        update(models.ClaveIdempotencia)
+        .where(
+            models.ClaveIdempotencia.id_usuario == id_usuario,
+            models.ClaveIdempotencia.clave == clave,
+            models.ClaveIdempotencia.creada_en == reclamada_en,
+            models.ClaveIdempotencia.estado.is_(None),
+        )
+        .values(estado=estado, respuesta=respuesta)
+        .returning(models.ClaveIdempotencia.clave)
+    )
+    if result.scalar_one_or_none() is None:
+        await db.rollback()
+        return False
+    await db.commit()
+    return True
+
+@presupuesto_consultas(1)
+async def liberar_clave_idempotencia(db: AsyncSession, id_usuario: int, clave: str):
+    """La petición original falló sin respuesta que guardar: se borra para que el reintento se ejecute."""
+    await db.execute(
+        delete(models.ClaveIdempotencia)
+        .where(
+            models.ClaveIdempotencia.id_usuario == id_usuario,
+            models.ClaveIdempotencia.clave == clave,
+            models.ClaveIdempotencia.estado.is_(None),
+        )
+    )
+    await db.commit()
+
+@presupuesto_consultas(1)
+async def limpiar_claves_idempotencia(db: AsyncSession, tamano_lote: int = 5000):
+    """Borra hasta `tamano_lote` claves vencidas (por ix_clave_idempotencia_expira_en). Devuelve cuántas."""
+    vencidas = (
+        select(models.ClaveIdempotencia.id_usuario, models.ClaveIdempotencia.clave)
+        .filter(models.ClaveIdempotencia.expira_en < _ahora_utc())
+        .limit(tamano_lote)
+        .with_for_update(skip_locked=True)
+        .cte("v")
+    )
+    result = await db.execute(
+        delete(models.ClaveIdempotencia)
+        .where(
+            tuple_(models.ClaveIdempotencia.id_usuario, models.ClaveIdempotencia.clave)
+            .in_(select(vencidas.c.id_usuario, vencidas.c.clave))
+        )
+        .returning(models.ClaveIdempotencia.clave)
+    )
+    borradas = len(result.all())
     await db.commit()
-    await db.refresh(pago)
-    return pago
\ No newline at end of file
+    return borradas
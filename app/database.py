@@ -1,31 +1,137 @@
+import asyncio
 import os
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 import ssl
+from app.metricas import PoolCronometrado, instrumentar_engine
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Réplica de solo lectura para los GET pesados (opcional, ver app/replica.py)
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+# Si la réplica no acepta la conexión en este tiempo, la lectura se hace en la primaria
+REPLICA_TIMEOUT_CONEXION_SEGUNDOS = float(os.getenv("REPLICA_TIMEOUT_CONEXION_SEGUNDOS", "2"))
 
 # Función para detectar si estamos en Azure
-def is_azure_environment():
-    return DATABASE_URL and "postgres.database.azure.com" in DATABASE_URL
+def is_azure_environment(url=None):
+    url = url or DATABASE_URL
+    return url and "postgres.database.azure.com" in url
+
+# --- Perfil de ejecución de la base de datos ---
+# dev: SQL en consola y pool pequeño; test: sin logs, pool mínimo;
+# prod: sin logs, pool más grande y timeouts del lado del servidor.
+# Cada valor se puede sobreescribir con su variable DB_* correspondiente.
+PERFILES_DB = {
+    "dev": {
+        "echo": True,
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_cache_size": 100,
+        "command_timeout": 60,
+        "statement_timeout_ms": 0,
+        "idle_in_transaction_timeout_ms": 0,
+        "connect_retries": 5,
+        "connect_retry_delay": 2.0,
+    },
+    "test": {
+        "echo": False,
+        "pool_size": 2,
+        "max_overflow": 5,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": False,
+        "statement_cache_size": 100,
+        "command_timeout": 30,
+        "statement_timeout_ms": 30000,
+        "idle_in_transaction_timeout_ms": 0,
+        "connect_retries": 1,
+        "connect_retry_delay": 0.5,
+    },
+    "prod": {
+        "echo": False,
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_cache_size": 500,
+        "command_timeout": 30,
+        "statement_timeout_ms": 15000,
+        "idle_in_transaction_timeout_ms": 60000,
+        "connect_retries": 10,
+        "connect_retry_delay": 3.0,
+    },
+}
+
+DB_PROFILE = os.getenv("DB_PROFILE", "prod" if is_azure_environment() else "dev")
+
+
+def _leer_perfil(nombre: str) -> dict:
+    perfil = dict(PERFILES_DB[nombre])
+    for clave, valor in perfil.items():
+        env = os.getenv(f"DB_{clave.upper()}")
+        if env is None:
+            continue
+        if isinstance(valor, bool):
+            perfil[clave] = env.strip().lower() in ("1", "true", "yes", "si")
+        else:
+            perfil[clave] = type(valor)(env)
+    return perfil
+
+
+DB_SETTINGS = _leer_perfil(DB_PROFILE)
+
+
+def _connect_args(url=None, application_name: str = "flyblue-api") -> dict:
+    server_settings = {"application_name": application_name}
+    if DB_SETTINGS["statement_timeout_ms"]:
+        server_settings["statement_timeout"] = str(DB_SETTINGS["statement_timeout_ms"])
+    if DB_SETTINGS["idle_in_transaction_timeout_ms"]:
+        server_settings["idle_in_transaction_session_timeout"] = str(DB_SETTINGS["idle_in_transaction_timeout_ms"])
+
+    args = {
+        # caché de sentencias preparadas de asyncpg y del dialecto de SQLAlchemy
+        # (0 en ambos si hay un pgbouncer en modo transacción delante)
+        "statement_cache_size": DB_SETTINGS["statement_cache_size"],
+        "prepared_statement_cache_size": DB_SETTINGS["statement_cache_size"],
+        "command_timeout": DB_SETTINGS["command_timeout"],
+        "server_settings": server_settings,
+    }
+    if is_azure_environment(url):
+        # SSL obligatorio en Azure
+        args["ssl"] = ssl.create_default_context(cafile="/etc/ssl/certs/ca-certificates.crt")
+    return args
+
 
 if is_azure_environment():
     # Configuración para Azure PostgreSQL con SSL (Obligatorio en Azure)
-    print("MODO AZURE: Aplicando configuración SSL para la base de datos.")
-    engine = create_async_engine(
-        DATABASE_URL,
-        echo=True,
-        connect_args={
-            "ssl": ssl.create_default_context(cafile="/etc/ssl/certs/ca-certificates.crt")
-        }
-    )
+    print(f"MODO AZURE: Aplicando configuración SSL para la base de datos (perfil {DB_PROFILE}).")
 else:
     # Configuración Local (sin SSL)
-    print("MODO LOCAL: Usando conexión estándar.")
-    engine = create_async_engine(DATABASE_URL, echo=True)
+    print(f"MODO LOCAL: Usando conexión estándar (perfil {DB_PROFILE}).")
+
+def _crear_engine(url, connect_args: dict):
+    return create_async_engine(
+        url,
+        echo=DB_SETTINGS["echo"],
+        pool_size=DB_SETTINGS["pool_size"],
+        max_overflow=DB_SETTINGS["max_overflow"],
+        pool_timeout=DB_SETTINGS["pool_timeout"],
+        pool_recycle=DB_SETTINGS["pool_recycle"],
+        pool_pre_ping=DB_SETTINGS["pool_pre_ping"],
+        poolclass=PoolCronometrado,  # mide la espera por conexión (ver /metrics)
+        connect_args=connect_args,
+    )
+
+
+engine = _crear_engine(DATABASE_URL, _connect_args())
+instrumentar_engine(engine)
 
 # Creamos la fábrica de sesiones asíncronas
 AsyncSessionLocal = sessionmaker(
@@ -34,6 +140,17 @@ AsyncSessionLocal = sessionmaker(
     expire_on_commit=False
 )
 
+# Réplica: mismo perfil de pool; None si no hay DATABASE_READ_URL (todo va a la primaria)
+read_engine = None
+AsyncSessionLectura = None
+if DATABASE_READ_URL:
+    read_engine = _crear_engine(
+        DATABASE_READ_URL,
+        {**_connect_args(DATABASE_READ_URL, "flyblue-api-lectura"), "timeout": REPLICA_TIMEOUT_CONEXION_SEGUNDOS},
+    )
+    instrumentar_engine(read_engine)
+    AsyncSessionLectura = sessionmaker(bind=read_engine, class_=AsyncSession, expire_on_commit=False)
+
 Base = declarative_base()
 
 async def get_db():
@@ -47,4 +164,48 @@ async def get_db():
             await session.rollback()
             raise
         finally:
-            await session.close()
\ No newline at end of file
+            await session.close()
+
+async def wait_for_database(revisar=None):
+    """
+    Espera a que la base de datos acepte conexiones al arrancar
+    (connect_retries intentos separados por connect_retry_delay segundos).
+    `revisar(conn)` es la primera consulta (por defecto SELECT 1) y se devuelve su resultado,
+    así el arranque no gasta un viaje extra solo para comprobar la conexión.
+    """
+    intentos = max(1, DB_SETTINGS["connect_retries"])
+    for intento in range(1, intentos + 1):
+        try:
+            async with engine.connect() as conn:
+                if revisar is None:
+                    return await conn.execute(text("SELECT 1"))
+                return await revisar(conn)
+        except Exception as exc:
+            if intento == intentos:
+                raise
+            print(f"Base de datos no disponible (intento {intento}/{intentos}): {exc!r}")
+            await asyncio.sleep(DB_SETTINGS["connect_retry_delay"])
+
+async def conectar_directo(application_name: str = "flyblue-api"):
+    """
+    Conexión asyncpg propia, fuera del pool (para conexiones de larga vida como LISTEN/NOTIFY,
+    que no deben quitarle un lugar al pool de las peticiones).
+    """
+    import asyncpg
+
+    cargs, cparams = engine.dialect.create_connect_args(engine.url)
+    args = _connect_args()
+    args.pop("prepared_statement_cache_size")  # es del dialecto de SQLAlchemy, no de asyncpg
+    args["server_settings"] = {**args["server_settings"], "application_name": application_name}
+    return await asyncpg.connect(*cargs, **cparams, **args)
+
+def pool_status(engine=engine) -> dict:
+    pool = engine.pool
+    return {
+        "perfil": DB_PROFILE,
+        "tamano": pool.size(),
+        "max_overflow": DB_SETTINGS["max_overflow"],
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(0, pool.overflow()),  # conexiones abiertas por encima de pool_size
+    }
@@ -0,0 +1,145 @@
+# app/grafo_rutas.py
+# Grafo de rutas dependiente del tiempo para buscar itinerarios con escalas.
+# Cada ciudad guarda sus vuelos de salida ordenados por hora, así las conexiones
+# posibles desde una llegada se encuentran con bisect sin tocar la base de datos.
+import heapq
+import os
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+ITINERARIOS_CONEXION_MINIMA_MIN = int(os.getenv("ITINERARIOS_CONEXION_MINIMA_MIN", "45"))
+ITINERARIOS_CONEXION_MAXIMA_MIN = int(os.getenv("ITINERARIOS_CONEXION_MAXIMA_MIN", "720"))
+ITINERARIOS_MAX_ESCALAS = 2
+ITINERARIOS_PRESUPUESTO_MS = int(os.getenv("ITINERARIOS_PRESUPUESTO_MS", "50"))
+ITINERARIOS_PRESUPUESTO_MAX_MS = 500
+ITINERARIOS_MAX_EXPANSIONES = int(os.getenv("ITINERARIOS_MAX_EXPANSIONES", "200000"))
+
+
+class Tramo(NamedTuple):
+    salida: datetime  # primer campo: las listas por ciudad se ordenan por hora de salida
+    id_vuelo: int
+    codigo: str
+    id_origen: int
+    id_destino: int
+    llegada: datetime
+    precio: float
+    codigo_origen: str
+    codigo_destino: str
+
+
+class ResultadoBusqueda(NamedTuple):
+    itinerarios: list  # list[tuple[Tramo, ...]]
+    completo: bool     # False si se cortó por presupuesto de tiempo o de expansiones
+    expansiones: int
+
+
+class GrafoRutas:
+    def __init__(self):
+        self._salidas: dict[int, list[Tramo]] = {}
+        self._horas: dict[int, list[datetime]] = {}  # paralela a _salidas, para bisect
+        self._ids: set[int] = set()
+        self.cargado_en: Optional[datetime] = None
+
+    @property
+    def total_tramos(self) -> int:
+        return len(self._ids)
+
+    def cargar(self, tramos: list[Tramo]):
+        """Reemplaza el grafo completo (se construye aparte y se intercambia de una vez)."""
+        salidas: dict[int, list[Tramo]] = {}
+        for tramo in tramos:
+            salidas.setdefault(tramo.id_origen, []).append(tramo)
+        for lista in salidas.values():
+            lista.sort()
+        self._salidas = salidas
+        self._horas = {ciudad: [t.salida for t in lista] for ciudad, lista in salidas.items()}
+        self._ids = {t.id_vuelo for t in tramos}
+        self.cargado_en = datetime.utcnow()
+
+    def agregar(self, tramos: list[Tramo]):
+        """Actualización incremental tras crear vuelos en este proceso (los que ya salieron se ignoran)."""
+        ahora = datetime.utcnow()
+        for tramo in tramos:
+            if tramo.id_vuelo in self._ids or tramo.salida < ahora:
+                continue
+            lista = self._salidas.setdefault(tramo.id_origen, [])
+            horas = self._horas.setdefault(tramo.id_origen, [])
+            posicion = bisect_right(horas, tramo.salida)
+            horas.insert(posicion, tramo.salida)
+            lista.insert(posicion, tramo)
+            self._ids.add(tramo.id_vuelo)
+
+    def _salidas_entre(self, ciudad: int, desde: datetime, hasta: datetime):
+        horas = self._horas.get(ciudad)
+        if not horas:
+            return ()
+        lista = self._salidas[ciudad]
+        return lista[bisect_left(horas, desde):bisect_right(horas, hasta)]
+
+    def buscar(
+        self,
+        id_origen: int,
+        id_destino: int,
+        desde: datetime,
+        hasta: datetime,
+        max_escalas: int = ITINERARIOS_MAX_ESCALAS,
+        criterio: str = "llegada",
+        limite: int = 10,
+        conexion_minima: timedelta = timedelta(minutes=ITINERARIOS_CONEXION_MINIMA_MIN),
+        conexion_maxima: timedelta = timedelta(minutes=ITINERARIOS_CONEXION_MAXIMA_MIN),
+        presupuesto_ms: int = ITINERARIOS_PRESUPUESTO_MS,
+    ) -> ResultadoBusqueda:
+        """
+        Búsqueda best-first acotada. La clave (hora de llegada o precio acumulado) nunca baja
+        al agregar un tramo, así que los itinerarios salen del heap ya ordenados y se puede
+        parar apenas hay `limite` resultados, o al agotar el presupuesto de tiempo.
+        """
+        limite_tiempo = time.perf_counter() + presupuesto_ms / 1000
+        por_precio = criterio == "precio"
+        heap = []
+        contador = 0  # desempate estable en el heap
+
+        def clave(ruta, precio):
+            return precio if por_precio else ruta[-1].llegada.timestamp()
+
+        # El grafo se recarga cada tanto: los vuelos que salieron desde entonces siguen en él
+        for tramo in self._salidas_entre(id_origen, max(desde, datetime.utcnow()), hasta):
+            contador += 1
+            heapq.heappush(heap, (clave((tramo,), tramo.precio), contador, tramo.precio, (tramo,)))
+
+        itinerarios = []
+        expansiones = 0
+        completo = True
+        while heap:
+            if len(itinerarios) >= limite:
+                break
+            expansiones += 1
+            if expansiones > ITINERARIOS_MAX_EXPANSIONES or (expansiones % 256 == 0 and time.perf_counter() > limite_tiempo):
+                completo = False
+                break
+
+            _, _, precio, ruta = heapq.heappop(heap)
+            ultimo = ruta[-1]
+            if ultimo.id_destino == id_destino:
+                itinerarios.append(ruta)
+                continue
+            if len(ruta) > max_escalas:
+                continue
+
+            visitadas = {t.id_origen for t in ruta}
+            ultima_escala = len(ruta) == max_escalas
+            for siguiente in self._salidas_entre(ultimo.id_destino, ultimo.llegada + conexion_minima,
+                                                 ultimo.llegada + conexion_maxima):
+                if siguiente.id_destino in visitadas or (ultima_escala and siguiente.id_destino != id_destino):
+                    continue
+                contador += 1
+                nueva = ruta + (siguiente,)
+                nuevo_precio = precio + siguiente.precio
+                heapq.heappush(heap, (clave(nueva, nuevo_precio), contador, nuevo_precio, nueva))
+
+        return ResultadoBusqueda(itinerarios, completo, expansiones)
+
+
+grafo_rutas = GrafoRutas()
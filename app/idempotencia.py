@@ -0,0 +1,224 @@
+# app/idempotencia.py
+# Cabecera Idempotency-Key en los POST de reservas y pagos: un reintento con la misma clave
+# devuelve la respuesta guardada de la primera petición en vez de reservar o cobrar otra vez.
+# La clave se reclama en la BD (tabla clave_idempotencia) antes de ejecutar la operación, así
+# que dos peticiones con la misma clave en workers distintos nunca se ejecutan las dos. Delante
+# hay una LRU por proceso para los reintentos que llegan al mismo worker, y los duplicados que
+# llegan mientras la original sigue en curso en este proceso esperan su resultado sin tocar la BD.
+#
+# La operación no hace commit (llama a crud con confirmar=False): la respuesta se guarda en la misma
+# transacción que la reserva o el encolado del pago, así que o quedan las dos o ninguna. Por eso la
+# clave nunca se libera después de confirmar, y una clave "en curso" que se retoma tras una caída
+# corresponde a una operación que no llegó a confirmarse. Lo que va después del commit (invalidar
+# cachés, avisar a los suscriptores y a los workers de pagos) lo devuelve la operación aparte.
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud
+from app.utils.respuestas import dumps, loads
+
+IDEMPOTENCIA_TTL_HORAS = float(os.getenv("IDEMPOTENCIA_TTL_HORAS", "24"))
+IDEMPOTENCIA_CACHE_MAX = int(os.getenv("IDEMPOTENCIA_CACHE_MAX", "10000"))
+# Cuánto espera un duplicado a que termine la petición original en otro worker antes del 409
+IDEMPOTENCIA_ESPERA_SEGUNDOS = float(os.getenv("IDEMPOTENCIA_ESPERA_SEGUNDOS", "10"))
+# Una clave que sigue "en curso" pasado este tiempo se da por abandonada (el worker se cayó)
+IDEMPOTENCIA_EN_CURSO_MAX_SEGUNDOS = float(os.getenv("IDEMPOTENCIA_EN_CURSO_MAX_SEGUNDOS", "60"))
+IDEMPOTENCIA_SONDEO_SEGUNDOS = 0.1
+
+# (respuesta, acciones tras el commit o None)
+Operacion = Callable[[], Awaitable[tuple[dict, Optional[Callable[[], Awaitable[None]]]]]]
+
+CABECERA_REPETIDA = "Idempotent-Replayed"
+
+
+class _Guardada(NamedTuple):
+    ruta: str
+    huella: str
+    estado: int
+    cuerpo: bytes
+    expira: float
+
+
+def huella_peticion(ruta: str, payload) -> str:
+    contenido = json.dumps(payload, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(f"{ruta}\n{contenido}".encode()).hexdigest()
+
+
+class Idempotencia:
+    def __init__(self, ttl_horas: float, max_claves: int):
+        self.ttl = timedelta(hours=ttl_horas)
+        self.max_claves = max_claves
+        self._guardadas: "OrderedDict[tuple, _Guardada]" = OrderedDict()
+        self._en_curso: dict[tuple, tuple[str, str, asyncio.Future]] = {}
+        self.ejecutadas = 0
+        self.repetidas = 0
+        self.conflictos = 0
+
+    async def ejecutar(
+        self,
+        db: AsyncSession,
+        id_usuario: int,
+        clave: Optional[str],
+        ruta: str,
+        payload,
+        operacion: Operacion,
+        estado: int = 200,
+    ):
+        """
+        Ejecuta `operacion()` una sola vez por (usuario, clave) y responde su dict con `estado`
+        (el mismo status_code de la ruta). Sin clave se ejecuta tal cual y se confirma.
+        Se guardan las respuestas 2xx y los HTTPException 4xx; un 5xx o un error inesperado
+        antes del commit libera la clave para que el reintento vuelva a ejecutarse.
+        """
+        if not clave:
+            resultado, tras_confirmar = await operacion()
+            await db.commit()
+            await self._tras_confirmar(tras_confirmar)
+            return resultado
+
+        llave = (id_usuario, clave)
+        huella = huella_peticion(ruta, payload)
+        limite = time.monotonic() + IDEMPOTENCIA_ESPERA_SEGUNDOS
+        while True:
+            guardada = self._guardadas.get(llave)
+            if guardada is not None and guardada.expira > time.monotonic():
+                self._guardadas.move_to_end(llave)
+                return self._repetir(guardada.ruta, guardada.huella, guardada.estado, guardada.cuerpo, ruta, huella)
+
+            en_curso = self._en_curso.get(llave)
+            if en_curso is not None:
+                self._comprobar(en_curso[0], en_curso[1], ruta, huella)
+                resultado = await asyncio.shield(en_curso[2])
+                if resultado is None:  # la original falló sin respuesta: se reintenta desde cero
+                    continue
+                return self._repetir(en_curso[0], en_curso[1], *resultado, ruta, huella)
+
+            futuro = asyncio.get_running_loop().create_future()
+            self._en_curso[llave] = (ruta, huella, futuro)
+            try:
+                return await self._reclamar_y_ejecutar(db, id_usuario, clave, ruta, huella, operacion, estado, futuro, limite)
+            finally:
+                self._en_curso.pop(llave, None)
+                if not futuro.done():
+                    futuro.set_result(None)
+
+    async def _reclamar_y_ejecutar(self, db, id_usuario, clave, ruta, huella, operacion, estado, futuro, limite):
+        llave = (id_usuario, clave)
+        while True:
+            reclamada_en = await crud.reclamar_clave_idempotencia(
+                db, id_usuario=id_usuario, clave=clave, ruta=ruta, huella=huella, ttl=self.ttl,
+                en_curso_max=timedelta(seconds=IDEMPOTENCIA_EN_CURSO_MAX_SEGUNDOS),
+            )
+            if reclamada_en is not None:
+                break
+            # Otra petición (quizá en otro worker) tiene la clave: esperamos su respuesta
+            while True:
+                fila = await crud.get_clave_idempotencia(db, id_usuario=id_usuario, clave=clave)
+                if fila is None:  # la original falló y liberó la clave
+                    break
+                if fila.estado is not None:
+                    cuerpo = fila.respuesta.encode()
+                    self._guardar(llave, fila.ruta, fila.huella, fila.estado, cuerpo)
+                    futuro.set_result((fila.estado, cuerpo))
+                    return self._repetir(fila.ruta, fila.huella, fila.estado, cuerpo, ruta, huella)
+                self._comprobar(fila.ruta, fila.huella, ruta, huella)
+                if time.monotonic() > limite:
+                    self.conflictos += 1
+                    raise HTTPException(status_code=409, detail="Hay una petición con esta Idempotency-Key en curso, reintenta en unos segundos")
+                await asyncio.sleep(IDEMPOTENCIA_SONDEO_SEGUNDOS)
+
+        self.ejecutadas += 1
+        try:
+            resultado, tras_confirmar = await operacion()
+            cuerpo = dumps(resultado)
+            # Este commit confirma a la vez la operación y su respuesta
+            if not await self._guardar_en_bd(db, llave, ruta, huella, estado, cuerpo, futuro, reclamada_en):
+                # Se tardó más de IDEMPOTENCIA_EN_CURSO_MAX_SEGUNDOS y otra petición retomó la clave:
+                # esta operación se deshizo y vale la de la otra
+                self.conflictos += 1
+                raise HTTPException(status_code=409, detail="Hay una petición con esta Idempotency-Key en curso, reintenta en unos segundos")
+        except HTTPException as exc:
+            if exc.status_code >= 500:
+                await self._liberar(db, id_usuario, clave)
+                raise
+            cuerpo = dumps({"detail": exc.detail})
+            await db.rollback()
+            await self._guardar_en_bd(db, llave, ruta, huella, exc.status_code, cuerpo, futuro, reclamada_en)
+            raise
+        except BaseException:
+            # Si el commit llegó a hacerse la clave ya tiene respuesta y _liberar no la borra
+            await self._liberar(db, id_usuario, clave)
+            raise
+
+        await self._tras_confirmar(tras_confirmar)
+        return Response(cuerpo, status_code=estado, media_type="application/json")
+
+    @staticmethod
+    async def _tras_confirmar(tras_confirmar):
+        if tras_confirmar is None:
+            return
+        try:
+            await tras_confirmar()
+        except Exception as exc:
+            # La operación ya está confirmada: las cachés se ponen al día al vencer su TTL
+            print(f"Error después de confirmar la operación: {exc!r}")
+
+    async def _guardar_en_bd(self, db, llave, ruta, huella, estado, cuerpo, futuro, reclamada_en) -> bool:
+        guardada = await crud.guardar_respuesta_idempotencia(
+            db, id_usuario=llave[0], clave=llave[1], estado=estado, respuesta=cuerpo.decode(), reclamada_en=reclamada_en,
+        )
+        if guardada:
+            self._guardar(llave, ruta, huella, estado, cuerpo)
+            futuro.set_result((estado, cuerpo))
+        return guardada
+
+    @staticmethod
+    async def _liberar(db, id_usuario, clave):
+        try:
+            await db.rollback()
+            await crud.liberar_clave_idempotencia(db, id_usuario=id_usuario, clave=clave)
+        except Exception as exc:
+            # Si no se puede borrar, la clave queda abandonada y se retoma pasados IDEMPOTENCIA_EN_CURSO_MAX_SEGUNDOS
+            print(f"No se pudo liberar la Idempotency-Key {clave!r}: {exc!r}")
+
+    def _guardar(self, llave, ruta, huella, estado, cuerpo):
+        self._guardadas[llave] = _Guardada(ruta, huella, estado, cuerpo, time.monotonic() + self.ttl.total_seconds())
+        self._guardadas.move_to_end(llave)
+        while len(self._guardadas) > self.max_claves:
+            self._guardadas.popitem(last=False)
+
+    @staticmethod
+    def _comprobar(ruta_guardada, huella_guardada, ruta, huella):
+        if ruta_guardada != ruta:
+            raise HTTPException(status_code=422, detail="La Idempotency-Key ya se usó en otro endpoint")
+        if huella_guardada != huella:
+            raise HTTPException(status_code=422, detail="La Idempotency-Key ya se usó con otro cuerpo de petición")
+
+    def _repetir(self, ruta_guardada, huella_guardada, estado, cuerpo, ruta, huella):
+        self._comprobar(ruta_guardada, huella_guardada, ruta, huella)
+        self.repetidas += 1
+        if estado >= 400:
+            raise HTTPException(status_code=estado, detail=loads(cuerpo)["detail"], headers={CABECERA_REPETIDA: "true"})
+        return Response(cuerpo, status_code=estado, media_type="application/json", headers={CABECERA_REPETIDA: "true"})
+
+    def stats(self) -> dict:
+        return {
+            "claves_en_memoria": len(self._guardadas),
+            "en_curso": len(self._en_curso),
+            "ejecutadas": self.ejecutadas,
+            "repetidas": self.repetidas,
+            "conflictos": self.conflictos,
+        }
+
+
+idempotencia = Idempotencia(IDEMPOTENCIA_TTL_HORAS, IDEMPOTENCIA_CACHE_MAX)
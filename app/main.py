@@ -1,20 +1,49 @@
+import asyncio
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import engine
-from app.models import Base
+from app.database import engine, pool_status, read_engine
+from app.migraciones import asegurar_esquema
 from app.routers import api_v1
+from app.utils.security import get_pwd_context, password_pool
+from app.security.jwt_handler import get_jose
+from app.cache import busquedas_cache, calendario_cache
+from app.cache.compartida import segmento_compartido
+from app.metricas import MetricasMiddleware, metricas
+from app.asientos_en_vivo import difusor_asientos
+from app.idempotencia import idempotencia
+from app.pagos import procesador_pagos
+from app.replica import LeerEscriturasMiddleware, replica
+from app.tasks import recargar_grafo_rutas, start_background_tasks, stop_background_tasks
 from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
+
+def precargar_autenticacion():
+    get_jose()
+    get_pwd_context()
+
+def _informar_precarga(futuro: asyncio.Future):
+    # Un fallo al importar jose/passlib no debe pasar inadvertido (el primer login lo repetiría)
+    if not futuro.cancelled() and futuro.exception() is not None:
+        print(f"Precarga de autenticación falló: {futuro.exception()!r}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Al iniciar: Conectar y crear tablas
+    # Al iniciar: conectar y verificar el esquema (una consulta si ya está al día, sin DDL)
     print("Iniciando aplicación y conectando a la base de datos...")
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all) # Descomentar solo para pruebas
-        await conn.run_sync(Base.metadata.create_all)
-    print("Tablas creadas/verificadas.")
+    version = await asegurar_esquema(engine)
+    print(f"Esquema v{version} verificado.")
+    print(f"Grafo de rutas cargado ({await recargar_grafo_rutas()} vuelos).")
+    # jose y passlib se importan en un hilo aparte: no retrasan el arranque ni el primer login
+    precarga = asyncio.get_running_loop().run_in_executor(None, precargar_autenticacion)
+    precarga.add_done_callback(_informar_precarga)
+    tareas = start_background_tasks()
     yield
     # Al apagar: (opcional)
+    await stop_background_tasks(tareas)
+    await asyncio.gather(precarga, return_exceptions=True)  # el hilo de la precarga termina antes que el pool
+    password_pool.shutdown()
     print("Aplicación apagándose.")
 
 app = FastAPI(
@@ -36,6 +65,12 @@ app.add_middleware(
     allow_headers=["*"],         # Permite todos los encabezados (incluyendo Authorization)
 )
 
+# Latencia por ruta, consultas y tiempo de BD por petición (ver /metrics)
+app.add_middleware(MetricasMiddleware)
+
+# Con réplica de lectura: tras una escritura, las lecturas del usuario van un rato a la primaria
+app.add_middleware(LeerEscriturasMiddleware)
+
 # Incluir todos los routers de /v1
 app.include_router(api_v1)
 
@@ -45,4 +80,50 @@ def read_root():
 
 @app.get("/qwert")
 def read_root():
-    return {"mensaje": "flujo CI/CD 100% funcioanl OSTOS yea jajaj YEAH", "status": "200"}
\ No newline at end of file
+    return {"mensaje": "flujo CI/CD 100% funcioanl OSTOS yea jajaj YEAH", "status": "200"}
+
+@app.get("/health")
+async def health():
+    # Usado por el HEALTHCHECK del Dockerfile; reporta además el estado del pool
+    try:
+        async with engine.connect() as conn:
+            await asyncio.wait_for(conn.execute(text("SELECT 1")), timeout=5)
+        db_ok = True
+    except Exception:
+        db_ok = False
+
+    return JSONResponse(
+        status_code=200 if db_ok else 503,
+        content={"status": "ok" if db_ok else "degradado", "db": db_ok, "pool": pool_status()}
+    )
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # Formato de texto de Prometheus: latencias, consultas por ruta, pool de BD, hashing y cachés de búsqueda
+    indicadores = {}
+    for nombre, valor in pool_status().items():
+        if isinstance(valor, (int, float)):
+            indicadores[f"flyblue_db_pool_{nombre}"] = {"": valor}
+    if read_engine is not None:
+        for nombre, valor in pool_status(read_engine).items():
+            if isinstance(valor, (int, float)):
+                indicadores[f"flyblue_db_replica_pool_{nombre}"] = {"": valor}
+    for nombre, valor in password_pool.stats().items():
+        if isinstance(valor, (int, float)):
+            indicadores[f"flyblue_password_pool_{nombre}"] = {"": valor}
+    for nombre, valor in busquedas_cache.stats().items():
+        if isinstance(valor, (int, float)):
+            indicadores[f"flyblue_busqueda_cache_{nombre}"] = {"": valor}
+    if segmento_compartido() is not None:
+        for nombre, valor in segmento_compartido().stats().items():
+            indicadores[f"flyblue_cache_compartida_{nombre}"] = {"": valor}
+    for nombre, valor in calendario_cache.stats().items():
+        indicadores[f"flyblue_calendario_cache_{nombre}"] = {"": valor}
+    for nombre, valor in difusor_asientos.stats().items():
+        indicadores[f"flyblue_asientos_stream_{nombre}"] = {"": valor}
+    for nombre, valor in idempotencia.stats().items():
+        indicadores[f"flyblue_idempotencia_{nombre}"] = {"": valor}
+    for nombre, valor in procesador_pagos.stats().items():
+        indicadores[f"flyblue_pagos_{nombre}"] = {"": valor}
+    for nombre, valor in replica.stats().items():
+        indicadores[f"flyblue_replica_{nombre}"] = {"": valor}
+    return PlainTextResponse(metricas.renderizar(indicadores), media_type="text/plain; version=0.0.4")
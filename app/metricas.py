@@ -0,0 +1,332 @@
+import functools
+import logging
+import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+# --- Instrumentación de latencia y base de datos por petición ---
+# El middleware mide cada petición por plantilla de ruta (/v1/vuelos/{id_vuelo}, no la URL real)
+# y código de estado; los eventos del engine suman consultas y tiempo de BD a la petición en curso
+# a través de un ContextVar, y el pool mide cuánto se esperó por una conexión libre.
+
+METRICAS_SERVER_TIMING = os.getenv("METRICAS_SERVER_TIMING", "false").lower() in ("1", "true", "si", "yes")
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS_CONSULTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BUCKETS_POOL = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# Presupuesto de consultas: por petición (0 = sin límite) y repeticiones de la misma sentencia
+# a partir de las cuales se reporta un posible N+1. En modo estricto (tests, benchmarks) las
+# violaciones de los presupuestos declarados con presupuesto_consultas() lanzan PresupuestoExcedido.
+PRESUPUESTO_CONSULTAS_PETICION = int(os.getenv("PRESUPUESTO_CONSULTAS_PETICION", "10"))
+PRESUPUESTO_UMBRAL_REPETICIONES = int(os.getenv("PRESUPUESTO_UMBRAL_REPETICIONES", "3"))
+PRESUPUESTO_CONSULTAS_ESTRICTO = os.getenv("PRESUPUESTO_CONSULTAS_ESTRICTO", "false").lower() in ("1", "true", "si", "yes")
+
+logger = logging.getLogger("flyblue.consultas")
+
+RUTA_DESCONOCIDA = "sin_ruta"  # 404 y similares: no usamos la URL cruda para no disparar la cardinalidad
+
+
+class Histograma:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.cuentas = [0] * len(buckets)
+        self.suma = 0.0
+        self.total = 0
+
+    def observar(self, valor: float):
+        self.suma += valor
+        self.total += 1
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                self.cuentas[i] += 1
+                break
+
+    def lineas(self, nombre: str, etiquetas: str) -> list:
+        sep = "," if etiquetas else ""
+        lineas = []
+        acumulado = 0
+        for limite, cuenta in zip(self.buckets, self.cuentas):
+            acumulado += cuenta
+            lineas.append(f'{nombre}_bucket{{{etiquetas}{sep}le="{limite}"}} {acumulado}')
+        lineas.append(f'{nombre}_bucket{{{etiquetas}{sep}le="+Inf"}} {self.total}')
+        sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+        lineas.append(f"{nombre}_sum{sufijo} {self.suma}")
+        lineas.append(f"{nombre}_count{sufijo} {self.total}")
+        return lineas
+
+
+@dataclass
+class MedicionPeticion:
+    consultas: int = 0
+    db_segundos: float = 0.0
+    pool_espera_segundos: float = 0.0
+
+
+_peticion_actual: ContextVar[Optional[MedicionPeticion]] = ContextVar("peticion_actual", default=None)
+
+
+class RegistroMetricas:
+    def __init__(self):
+        self.latencia: dict[tuple, Histograma] = {}       # (metodo, ruta, estado)
+        self.consultas: dict[tuple, Histograma] = {}      # (metodo, ruta)
+        self.db_segundos: dict[tuple, float] = {}         # (metodo, ruta)
+        self.pool_espera = Histograma(BUCKETS_POOL)
+        self.consultas_fuera_de_peticion = 0              # tareas de fondo, arranque, etc.
+        self.db_segundos_fuera_de_peticion = 0.0
+        self.violaciones_presupuesto: Counter = Counter()  # nombre -> veces
+
+    def registrar_peticion(self, metodo: str, ruta: str, estado: int, duracion: float, medicion: MedicionPeticion):
+        clave = (metodo, ruta, str(estado))
+        if clave not in self.latencia:
+            self.latencia[clave] = Histograma(BUCKETS_LATENCIA)
+        self.latencia[clave].observar(duracion)
+
+        clave_ruta = (metodo, ruta)
+        if clave_ruta not in self.consultas:
+            self.consultas[clave_ruta] = Histograma(BUCKETS_CONSULTAS)
+        self.consultas[clave_ruta].observar(medicion.consultas)
+        self.db_segundos[clave_ruta] = self.db_segundos.get(clave_ruta, 0.0) + medicion.db_segundos
+
+    def registrar_consulta(self, duracion: float):
+        medicion = _peticion_actual.get()
+        if medicion is None:
+            self.consultas_fuera_de_peticion += 1
+            self.db_segundos_fuera_de_peticion += duracion
+        else:
+            medicion.consultas += 1
+            medicion.db_segundos += duracion
+
+    def registrar_espera_pool(self, duracion: float):
+        self.pool_espera.observar(duracion)
+        medicion = _peticion_actual.get()
+        if medicion is not None:
+            medicion.pool_espera_segundos += duracion
+
+    def renderizar(self, indicadores: Optional[dict] = None) -> str:
+        """Formato de texto de Prometheus. `indicadores` son gauges extra: {nombre: {etiquetas_str: valor}}."""
+        lineas = [
+            "# HELP flyblue_http_request_duration_seconds Latencia por ruta y estado",
+            "# TYPE flyblue_http_request_duration_seconds histogram",
+        ]
+        for (metodo, ruta, estado), h in sorted(self.latencia.items()):
+            lineas += h.lineas("flyblue_http_request_duration_seconds",
+                               f'metodo="{metodo}",ruta="{ruta}",estado="{estado}"')
+
+        lineas += [
+            "# HELP flyblue_http_db_consultas Consultas SQL por petición",
+            "# TYPE flyblue_http_db_consultas histogram",
+        ]
+        for (metodo, ruta), h in sorted(self.consultas.items()):
+            lineas += h.lineas("flyblue_http_db_consultas", f'metodo="{metodo}",ruta="{ruta}"')
+
+        lineas += [
+            "# HELP flyblue_http_db_segundos_total Tiempo acumulado en la base de datos por ruta",
+            "# TYPE flyblue_http_db_segundos_total counter",
+        ]
+        for (metodo, ruta), segundos in sorted(self.db_segundos.items()):
+            lineas.append(f'flyblue_http_db_segundos_total{{metodo="{metodo}",ruta="{ruta}"}} {segundos}')
+
+        lineas += [
+            "# HELP flyblue_db_pool_espera_segundos Espera para obtener una conexión del pool",
+            "# TYPE flyblue_db_pool_espera_segundos histogram",
+        ]
+        lineas += self.pool_espera.lineas("flyblue_db_pool_espera_segundos", "")
+
+        lineas += [
+            "# TYPE flyblue_db_consultas_fuera_de_peticion_total counter",
+            f"flyblue_db_consultas_fuera_de_peticion_total {self.consultas_fuera_de_peticion}",
+            "# TYPE flyblue_db_segundos_fuera_de_peticion_total counter",
+            f"flyblue_db_segundos_fuera_de_peticion_total {self.db_segundos_fuera_de_peticion}",
+        ]
+
+        lineas += [
+            "# HELP flyblue_presupuesto_consultas_violaciones_total Presupuestos de consultas excedidos o N+1 detectados",
+            "# TYPE flyblue_presupuesto_consultas_violaciones_total counter",
+        ]
+        for nombre, veces in sorted(self.violaciones_presupuesto.items()):
+            lineas.append(f'flyblue_presupuesto_consultas_violaciones_total{{nombre="{nombre}"}} {veces}')
+
+        for nombre, series in (indicadores or {}).items():
+            lineas.append(f"# TYPE {nombre} gauge")
+            for etiquetas, valor in series.items():
+                sufijo = f"{{{etiquetas}}}" if etiquetas else ""
+                lineas.append(f"{nombre}{sufijo} {float(valor)}")
+        return "\n".join(lineas) + "\n"
+
+
+metricas = RegistroMetricas()
+
+
+# --- Presupuesto de consultas ---
+
+class PresupuestoExcedido(AssertionError):
+    pass
+
+
+# Presupuestos abiertos en el contexto actual (tupla: cada tarea hereda una copia inmutable)
+_presupuestos_activos: ContextVar[tuple] = ContextVar("presupuestos_activos", default=())
+
+
+class presupuesto_consultas:
+    """
+    Cuenta las sentencias SQL ejecutadas dentro del bloque y reporta si se pasa de `maximo`
+    o si una misma sentencia se repite (patrón N+1). Se usa como context manager:
+
+        with presupuesto_consultas(2, "detalle de vuelo"):
+            ...
+
+    o como decorador de funciones async de crud: @presupuesto_consultas(1)
+    """
+
+    def __init__(self, maximo: Optional[int], nombre: Optional[str] = None, estricto: Optional[bool] = None):
+        self.maximo = maximo
+        self.nombre = nombre
+        self.estricto = PRESUPUESTO_CONSULTAS_ESTRICTO if estricto is None else estricto
+        self.sentencias: Counter = Counter()
+        self.total = 0
+        self._token = None
+
+    def registrar(self, sentencia: str):
+        self.total += 1
+        self.sentencias[sentencia] += 1
+
+    def problemas(self) -> list:
+        problemas = []
+        if self.maximo and self.total > self.maximo:
+            problemas.append(f"{self.total} consultas (presupuesto {self.maximo})")
+        for sentencia, veces in self.sentencias.most_common():
+            if veces < PRESUPUESTO_UMBRAL_REPETICIONES:
+                break
+            problemas.append(f"posible N+1, {veces}x: {' '.join(sentencia.split())[:160]}")
+        return problemas
+
+    def verificar(self):
+        problemas = self.problemas()
+        if not problemas:
+            return
+        metricas.violaciones_presupuesto[self.nombre] += 1
+        logger.warning("Presupuesto de consultas en %s: %s", self.nombre, "; ".join(problemas))
+        if self.estricto:
+            raise PresupuestoExcedido(f"{self.nombre}: {'; '.join(problemas)}")
+
+    def __enter__(self):
+        self.sentencias.clear()
+        self.total = 0
+        self._token = _presupuestos_activos.set(_presupuestos_activos.get() + (self,))
+        return self
+
+    def __exit__(self, tipo_exc, exc, tb):
+        _presupuestos_activos.reset(self._token)
+        if tipo_exc is None:
+            self.verificar()
+        return False
+
+    def __call__(self, funcion):
+        nombre = self.nombre or funcion.__qualname__
+
+        @functools.wraps(funcion)
+        async def envoltura(*args, **kwargs):
+            # una instancia nueva por llamada: la misma función puede correr en paralelo
+            with presupuesto_consultas(self.maximo, nombre, self.estricto):
+                return await funcion(*args, **kwargs)
+
+        return envoltura
+
+
+# --- Hooks de SQLAlchemy ---
+
+def _antes_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    for presupuesto in _presupuestos_activos.get():
+        presupuesto.registrar(statement)
+    conn.info.setdefault("metricas_inicio", []).append(time.perf_counter())
+
+
+def _despues_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get("metricas_inicio")
+    if inicios:
+        metricas.registrar_consulta(time.perf_counter() - inicios.pop())
+
+
+def _error_al_ejecutar(contexto_excepcion):
+    # after_cursor_execute no se dispara si la consulta falla
+    conn = contexto_excepcion.connection
+    if conn is not None and conn.info.get("metricas_inicio"):
+        metricas.registrar_consulta(time.perf_counter() - conn.info["metricas_inicio"].pop())
+
+
+def instrumentar_engine(engine):
+    sync_engine = engine.sync_engine
+    if getattr(sync_engine, "_metricas_instrumentado", False):
+        return
+    event.listen(sync_engine, "before_cursor_execute", _antes_de_ejecutar)
+    event.listen(sync_engine, "after_cursor_execute", _despues_de_ejecutar)
+    event.listen(sync_engine, "handle_error", _error_al_ejecutar)
+    sync_engine._metricas_instrumentado = True
+
+
+class PoolCronometrado(AsyncAdaptedQueuePool):
+    """Pool asíncrono que mide la espera hasta entregar una conexión (incluye abrirla si hace falta)."""
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metricas.registrar_espera_pool(time.perf_counter() - inicio)
+
+
+# --- Middleware ---
+
+class MetricasMiddleware:
+    """Middleware ASGI puro (sin BaseHTTPMiddleware, que agrega una tarea por petición)."""
+
+    def __init__(self, app, server_timing: bool = METRICAS_SERVER_TIMING):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        medicion = MedicionPeticion()
+        token = _peticion_actual.set(medicion)
+        presupuesto = presupuesto_consultas(PRESUPUESTO_CONSULTAS_PETICION, estricto=False).__enter__()
+        inicio = time.perf_counter()
+        estado = 500
+
+        async def send_medido(mensaje):
+            nonlocal estado
+            if mensaje["type"] == "http.response.start":
+                estado = mensaje["status"]
+                if self.server_timing:
+                    mensaje["headers"] = list(mensaje.get("headers", [])) + [
+                        (b"server-timing", self._server_timing(medicion, time.perf_counter() - inicio))
+                    ]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, send_medido)
+        finally:
+            duracion = time.perf_counter() - inicio
+            _peticion_actual.reset(token)
+            ruta = scope.get("route")
+            plantilla = getattr(ruta, "path_format", None) or getattr(ruta, "path", None) or RUTA_DESCONOCIDA
+            metricas.registrar_peticion(scope["method"], plantilla, estado, duracion, medicion)
+            presupuesto.nombre = f"{scope['method']} {plantilla}"
+            presupuesto.__exit__(None, None, None)
+
+    @staticmethod
+    def _server_timing(medicion: MedicionPeticion, total: float) -> bytes:
+        return (
+            f'db;dur={medicion.db_segundos * 1000:.2f};desc="{medicion.consultas} consultas", '
+            f"pool;dur={medicion.pool_espera_segundos * 1000:.2f}, "
+            f"app;dur={total * 1000:.2f}"
+        ).encode("latin-1")
@@ -0,0 +1,236 @@
+# app/migraciones.py
+# Migraciones versionadas del esquema.
+#
+# Cada migración es (versión, descripción, [sentencias SQL]) y nunca se modifica
+# una vez publicada: los cambios nuevos se agregan al final con la versión siguiente.
+# La versión aplicada se guarda en la tabla schema_version (una sola fila).
+# La migración 0 es el esquema base: create_all de app.models, solo sobre una base sin
+# versión. Por eso una tabla nueva en models.py también necesita su migración.
+#
+# Al arrancar (asegurar_esquema) una sola consulta lee la versión; si está al día no se
+# ejecuta DDL ni se toma el lock, que es lo normal en cada reinicio y en cada worker nuevo.
+#
+# Los índices sobre tablas que ya tienen datos se crean con CREATE INDEX CONCURRENTLY: no
+# bloquean las escrituras mientras se construyen, pero Postgres no los admite dentro de una
+# transacción, así que se ejecutan aparte (ver aplicar_migraciones). Los índices de tablas
+# creadas en la misma migración van normales, dentro de la transacción.
+#
+# Ejecutar a mano:  python -m app.migraciones
+import asyncio
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+# Clave del advisory lock de Postgres que serializa las migraciones entre workers
+MIGRACIONES_LOCK_ID = 4_827_310_001
+# Cada cuánto reintenta el lock un worker que espera a que otro termine de migrar (segundos)
+MIGRACIONES_ESPERA_LOCK = 0.5
+
+MIGRACIONES = [
+    (1, "columnas token_version (usuario) y tipo_aeronave (vuelo)", [
+        "ALTER TABLE usuario ADD COLUMN IF NOT EXISTS token_version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE vuelo ADD COLUMN IF NOT EXISTS tipo_aeronave VARCHAR(20)",
+    ]),
+    (2, "índices de búsqueda de vuelos, mapa de asientos y reservas", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_vuelo_ruta_fecha ON vuelo (id_origen, id_destino, fecha_salida)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_vuelo_fecha_salida ON vuelo (fecha_salida, id_vuelo)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_asiento_vuelo ON asiento (id_vuelo, fila, columna)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_asiento_vuelo_disponible ON asiento (id_vuelo, fila, columna) "
+        "WHERE disponible",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reserva_usuario ON reserva (id_usuario)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_reserva_vuelo ON reserva (id_vuelo)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_pago_reserva ON pago (id_reserva)",
+    ]),
+    (3, "tabla catalogo_version para invalidar cachés de catálogos", [
+        "CREATE TABLE IF NOT EXISTS catalogo_version ("
+        " nombre VARCHAR(30) PRIMARY KEY,"
+        " version INTEGER NOT NULL DEFAULT 0)",
+        "INSERT INTO catalogo_version (nombre, version) VALUES ('ciudades', 0), ('equipajes', 0) "
+        "ON CONFLICT (nombre) DO NOTHING",
+    ]),
+    (4, "retenciones temporales de asientos", [
+        "ALTER TABLE asiento ADD COLUMN IF NOT EXISTS retenido_hasta TIMESTAMP",
+        "ALTER TABLE asiento ADD COLUMN IF NOT EXISTS retenido_por INTEGER "
+        "REFERENCES usuario (id_usuario) ON DELETE SET NULL",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_asiento_retenido_hasta ON asiento (retenido_hasta) "
+        "WHERE retenido_hasta IS NOT NULL",
+    ]),
+    (5, "mapa de bits de disponibilidad de asientos por vuelo", [
+        "ALTER TABLE vuelo ADD COLUMN IF NOT EXISTS mapa_asientos BIT VARYING",
+        "ALTER TABLE vuelo ADD COLUMN IF NOT EXISTS mapa_columnas VARCHAR(10)",
+        "ALTER TABLE vuelo ADD COLUMN IF NOT EXISTS mapa_version INTEGER NOT NULL DEFAULT 0",
+        "UPDATE vuelo v SET mapa_asientos = m.mapa, mapa_columnas = m.columnas "
+        "FROM (SELECT id_vuelo,"
+        " string_agg(CASE WHEN disponible THEN '1' ELSE '0' END, '' ORDER BY fila, columna)::varbit AS mapa,"
+        " string_agg(DISTINCT columna, '' ORDER BY columna) AS columnas"
+        " FROM asiento GROUP BY id_vuelo) m "
+        "WHERE v.id_vuelo = m.id_vuelo AND v.mapa_asientos IS NULL",
+    ]),
+    (6, "tabla clave_idempotencia para reintentos de reservas y pagos", [
+        "CREATE TABLE IF NOT EXISTS clave_idempotencia ("
+        " id_usuario INTEGER NOT NULL REFERENCES usuario (id_usuario) ON DELETE CASCADE,"
+        " clave VARCHAR(100) NOT NULL,"
+        " ruta VARCHAR(100) NOT NULL,"
+        " huella VARCHAR(64) NOT NULL,"
+        " estado INTEGER,"
+        " respuesta TEXT,"
+        " creada_en TIMESTAMP NOT NULL,"
+        " expira_en TIMESTAMP NOT NULL,"
+        " PRIMARY KEY (id_usuario, clave))",
+        "CREATE INDEX IF NOT EXISTS ix_clave_idempotencia_expira_en ON clave_idempotencia (expira_en)",
+    ]),
+    (7, "cola trabajo_pago para cobrar los pagos fuera de la petición", [
+        "CREATE TABLE IF NOT EXISTS trabajo_pago ("
+        " id_trabajo SERIAL PRIMARY KEY,"
+        " id_reserva INTEGER NOT NULL REFERENCES reserva (id_reserva) ON DELETE CASCADE,"
+        " id_usuario INTEGER NOT NULL REFERENCES usuario (id_usuario) ON DELETE CASCADE,"
+        " monto DECIMAL(10, 2) NOT NULL,"
+        " estado VARCHAR(20) NOT NULL DEFAULT 'pendiente'"
+        " CHECK (estado IN ('pendiente', 'procesando', 'pagado', 'fallido')),"
+        " intentos INTEGER NOT NULL DEFAULT 0,"
+        " disponible_en TIMESTAMP NOT NULL,"
+        " ultimo_error TEXT,"
+        " referencia VARCHAR(100),"
+        " id_pago INTEGER REFERENCES pago (id_pago) ON DELETE SET NULL,"
+        " creado_en TIMESTAMP NOT NULL,"
+        " actualizado_en TIMESTAMP NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_trabajo_pago_id_trabajo ON trabajo_pago (id_trabajo)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_trabajo_pago_reserva_activo ON trabajo_pago (id_reserva) "
+        "WHERE estado IN ('pendiente', 'procesando')",
+        "CREATE INDEX IF NOT EXISTS ix_trabajo_pago_disponible_en ON trabajo_pago (disponible_en) "
+        "WHERE estado IN ('pendiente', 'procesando')",
+    ]),
+    (8, "vuelo.cambiado_en para reconciliar solo los vuelos con cambios recientes", [
+        "ALTER TABLE vuelo ADD COLUMN IF NOT EXISTS cambiado_en TIMESTAMP",
+    ]),
+    (9, "índice de retenciones por usuario", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_asiento_retenido_por ON asiento (retenido_por) "
+        "WHERE retenido_por IS NOT NULL",
+    ]),
+]
+
+VERSION_ACTUAL = MIGRACIONES[-1][0]
+
+_INDICE_CONCURRENTE = re.compile(r"CREATE (?:UNIQUE )?INDEX CONCURRENTLY IF NOT EXISTS (\w+)", re.IGNORECASE)
+
+
+async def get_schema_version(conn: AsyncConnection) -> int:
+    result = await conn.execute(text("SELECT version FROM schema_version WHERE id = 1"))
+    return result.scalar_one_or_none() or 0
+
+
+async def leer_version_esquema(conn: AsyncConnection) -> int:
+    """Versión aplicada, o 0 si schema_version todavía no existe (base nueva)."""
+    try:
+        return await get_schema_version(conn)
+    except ProgrammingError:
+        await conn.rollback()
+        return 0
+
+
+async def asegurar_esquema(engine: AsyncEngine) -> int:
+    """
+    Deja el esquema en VERSION_ACTUAL. Con el esquema al día cuesta una consulta; si no,
+    aplicar_migraciones toma el advisory lock y vuelve a leer la versión, así que los
+    workers que esperaban el lock encuentran el trabajo hecho y no repiten DDL.
+    """
+    from app.database import wait_for_database
+
+    version = await wait_for_database(leer_version_esquema)
+    if version > VERSION_ACTUAL:
+        print(f"El esquema (v{version}) es más nuevo que este código (v{VERSION_ACTUAL}); se continúa sin migrar.")
+    if version >= VERSION_ACTUAL:
+        return version
+    return await aplicar_migraciones(engine)
+
+
+async def _registrar_version(conn: AsyncConnection, numero: int):
+    await conn.execute(
+        text(
+            "INSERT INTO schema_version (id, version, aplicado_en) VALUES (1, :version, now()) "
+            "ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version, aplicado_en = EXCLUDED.aplicado_en"
+        ),
+        {"version": numero},
+    )
+
+
+async def _crear_indice_concurrente(conn: AsyncConnection, sentencia: str):
+    """
+    CREATE INDEX CONCURRENTLY en una conexión en autocommit. Si un intento anterior se cortó,
+    el índice quedó inválido y IF NOT EXISTS lo saltaría: se borra y se vuelve a crear.
+    """
+    nombre = _INDICE_CONCURRENTE.match(sentencia).group(1)
+    result = await conn.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:nombre)"), {"nombre": nombre}
+    )
+    if result.scalar_one_or_none() is False:
+        print(f"Índice {nombre} inválido (creación interrumpida): se vuelve a crear")
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {nombre}"))
+    await conn.execute(text(sentencia))
+
+
+async def aplicar_migraciones(engine: AsyncEngine) -> int:
+    """
+    Aplica las migraciones pendientes. Toma un advisory lock de sesión para que, si varios
+    workers arrancan a la vez, solo uno ejecute DDL y los demás esperen y encuentren el esquema
+    al día. Cada migración corre en su transacción, salvo los CREATE INDEX CONCURRENTLY, que van
+    después en autocommit; la versión se registra al final, así que si algo falla a mitad la
+    migración se repite entera (por eso todas sus sentencias son IF NOT EXISTS).
+    Devuelve la versión final del esquema.
+    """
+    async with engine.connect() as autocommit:
+        await autocommit.execution_options(isolation_level="AUTOCOMMIT")
+        # Se reintenta en vez de esperar con pg_advisory_lock: un worker bloqueado en esa consulta
+        # mantiene una foto abierta, y CREATE INDEX CONCURRENTLY espera a que terminen todas
+        lock = text("SELECT pg_try_advisory_lock(:lock_id)")
+        while not (await autocommit.execute(lock, {"lock_id": MIGRACIONES_LOCK_ID})).scalar_one():
+            await asyncio.sleep(MIGRACIONES_ESPERA_LOCK)
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(text(
+                    "CREATE TABLE IF NOT EXISTS schema_version ("
+                    " id INTEGER PRIMARY KEY CHECK (id = 1),"
+                    " version INTEGER NOT NULL,"
+                    " aplicado_en TIMESTAMP NOT NULL DEFAULT now())"
+                ))
+                version = await get_schema_version(conn)
+                if version == 0:
+                    from app.models import Base
+
+                    print("Aplicando migración 0: esquema base (app.models)")
+                    await conn.run_sync(Base.metadata.create_all)
+
+            for numero, descripcion, sentencias in MIGRACIONES:
+                if numero <= version:
+                    continue
+                print(f"Aplicando migración {numero}: {descripcion}")
+                concurrentes = [s for s in sentencias if _INDICE_CONCURRENTE.match(s)]
+                async with engine.begin() as conn:
+                    for sentencia in sentencias:
+                        if sentencia not in concurrentes:
+                            await conn.execute(text(sentencia))
+                    if not concurrentes:
+                        await _registrar_version(conn, numero)
+                if concurrentes:
+                    for sentencia in concurrentes:
+                        await _crear_indice_concurrente(autocommit, sentencia)
+                    async with engine.begin() as conn:
+                        await _registrar_version(conn, numero)
+                version = numero
+            return version
+        finally:
+            await autocommit.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": MIGRACIONES_LOCK_ID})
+
+
+async def main():
+    from app.database import engine
+
+    version = await asegurar_esquema(engine)
+    await engine.dispose()
+    print(f"Esquema en la versión {version}.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
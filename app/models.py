@@ -1,4 +1,5 @@
-from sqlalchemy import (Column,Integer,String,Boolean,DateTime,DECIMAL,ForeignKey,CheckConstraint)
+from sqlalchemy import (Column,Integer,String,Text,Boolean,DateTime,DECIMAL,ForeignKey,CheckConstraint,Index,text)
+from sqlalchemy.dialects.postgresql import BIT
 from sqlalchemy.orm import relationship
 from app.database import Base
 
@@ -12,6 +13,8 @@ class Usuario(Base):
     correo = Column(String(100), unique=True, nullable=False)
     contraseña = Column(String(255), nullable=False)
     rol = Column(String(20), nullable=False)
+    # Se incrementa para revocar todos los tokens emitidos al usuario
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
 
     __table_args__ = (
         CheckConstraint("rol IN ('usuario', 'admin')"),
@@ -45,6 +48,23 @@ class Vuelo(Base):
     precio_base = Column(DECIMAL(10, 2), nullable=False)
     asientos_totales = Column(Integer, nullable=True)
     asientos_disponibles = Column(Integer, nullable=True)
+    tipo_aeronave = Column(String(20), nullable=True)
+    # Mapa compacto de disponibilidad: un bit por asiento (1 = disponible), fila por fila y
+    # dentro de cada fila en el orden de mapa_columnas. Se actualiza en la misma sentencia que
+    # reserva o libera asientos, y mapa_version sube con cada cambio.
+    mapa_asientos = Column(BIT(varying=True), nullable=True)
+    mapa_columnas = Column(String(10), nullable=True)
+    mapa_version = Column(Integer, nullable=False, default=0, server_default="0")
+    # Último cambio de disponibilidad (lo usa la reconciliación periódica para revisar solo esos
+    # vuelos). Sin índice a propósito: cada reserva lo actualiza y un índice impediría los HOT updates.
+    cambiado_en = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # search_vuelos: origen + destino + rango de fecha_salida
+        Index("ix_vuelo_ruta_fecha", "id_origen", "id_destino", "fecha_salida"),
+        # listado paginado ordenado por (fecha_salida, id_vuelo)
+        Index("ix_vuelo_fecha_salida", "fecha_salida", "id_vuelo"),
+    )
 
     origen = relationship("Ciudad", foreign_keys=[id_origen], back_populates="vuelos_origen")
     destino = relationship("Ciudad", foreign_keys=[id_destino], back_populates="vuelos_destino")
@@ -61,9 +81,21 @@ class Asiento(Base):
     fila = Column(Integer, nullable=False)
     columna = Column(String(1), nullable=False)
     disponible = Column(Boolean, default=True)
+    # Retención temporal: el asiento queda no disponible hasta retenido_hasta (UTC)
+    # o hasta que el usuario paga; el barrido de app/tasks.py libera las vencidas
+    retenido_hasta = Column(DateTime, nullable=True)
+    retenido_por = Column(Integer, ForeignKey("usuario.id_usuario", ondelete="SET NULL"), nullable=True)
 
     __table_args__ = (
         CheckConstraint("columna IN ('A', 'B', 'C', 'D', 'E')"),
+        # mapa de asientos de un vuelo
+        Index("ix_asiento_vuelo", "id_vuelo", "fila", "columna"),
+        # parcial: solo asientos libres (conteo de disponibles y "cualquier asiento")
+        Index("ix_asiento_vuelo_disponible", "id_vuelo", "fila", "columna", postgresql_where=text("disponible")),
+        # parcial: solo retenciones activas, lo que recorre el barrido de vencidas
+        Index("ix_asiento_retenido_hasta", "retenido_hasta", postgresql_where=text("retenido_hasta IS NOT NULL")),
+        # parcial: retenciones de cada usuario (límite de retenciones activas por usuario)
+        Index("ix_asiento_retenido_por", "retenido_por", postgresql_where=text("retenido_por IS NOT NULL")),
     )
 
     vuelo = relationship("Vuelo", back_populates="asientos")
@@ -95,6 +127,11 @@ class Reserva(Base):
     id_equipaje = Column(Integer, ForeignKey("equipaje.id_equipaje"))
     total = Column(DECIMAL(10, 2), nullable=False)
 
+    __table_args__ = (
+        Index("ix_reserva_usuario", "id_usuario"),
+        Index("ix_reserva_vuelo", "id_vuelo"),
+    )
+
     usuario = relationship("Usuario", back_populates="reservas")
     vuelo = relationship("Vuelo", back_populates="reservas")
     asiento = relationship("Asiento", back_populates="reservas")
@@ -114,6 +151,69 @@ class Pago(Base):
 
     __table_args__ = (
         CheckConstraint("estado IN ('pagado', 'fallido')"),
+        Index("ix_pago_reserva", "id_reserva"),
     )
 
     reserva = relationship("Reserva", back_populates="pago")
+
+
+# 8️⃣ VERSIÓN DE CATÁLOGOS
+# Se incrementa en la misma transacción que modifica un catálogo (ciudades, equipajes)
+# para que todos los procesos invaliden su caché en memoria.
+class CatalogoVersion(Base):
+    __tablename__ = "catalogo_version"
+
+    nombre = Column(String(30), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# 9️⃣ CLAVES DE IDEMPOTENCIA
+# Respuesta guardada de cada POST de reserva/pago enviado con cabecera Idempotency-Key,
+# para devolverla tal cual si el cliente reintenta. estado es NULL mientras la petición
+# original está en curso. Se borran al pasar expira_en.
+class ClaveIdempotencia(Base):
+    __tablename__ = "clave_idempotencia"
+
+    id_usuario = Column(Integer, ForeignKey("usuario.id_usuario", ondelete="CASCADE"), primary_key=True)
+    clave = Column(String(100), primary_key=True)
+    ruta = Column(String(100), nullable=False)
+    huella = Column(String(64), nullable=False)  # sha256 de la ruta y el cuerpo de la petición
+    estado = Column(Integer, nullable=True)
+    respuesta = Column(Text, nullable=True)
+    creada_en = Column(DateTime, nullable=False)
+    expira_en = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index("ix_clave_idempotencia_expira_en", "expira_en"),
+    )
+
+
+# 🔟 TRABAJOS DE PAGO
+# Cola de cobros pendientes: el endpoint de pago encola y responde 202; los workers de
+# app/pagos.py toman lotes con SKIP LOCKED, cobran en la pasarela y dejan el resultado en
+# pago. Mientras un worker procesa un trabajo, disponible_en es el fin de su plazo: si el
+# worker se cae, el trabajo vuelve a quedar disponible al vencer.
+class TrabajoPago(Base):
+    __tablename__ = "trabajo_pago"
+
+    id_trabajo = Column(Integer, primary_key=True, index=True)
+    id_reserva = Column(Integer, ForeignKey("reserva.id_reserva", ondelete="CASCADE"), nullable=False)
+    id_usuario = Column(Integer, ForeignKey("usuario.id_usuario", ondelete="CASCADE"), nullable=False)
+    monto = Column(DECIMAL(10, 2), nullable=False)
+    estado = Column(String(20), nullable=False, default="pendiente", server_default="pendiente")
+    intentos = Column(Integer, nullable=False, default=0, server_default="0")
+    disponible_en = Column(DateTime, nullable=False)
+    ultimo_error = Column(Text, nullable=True)
+    referencia = Column(String(100), nullable=True)  # id del cobro en la pasarela
+    id_pago = Column(Integer, ForeignKey("pago.id_pago", ondelete="SET NULL"), nullable=True)
+    creado_en = Column(DateTime, nullable=False)
+    actualizado_en = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        CheckConstraint("estado IN ('pendiente', 'procesando', 'pagado', 'fallido')"),
+        # Un solo trabajo activo por reserva
+        Index("ux_trabajo_pago_reserva_activo", "id_reserva", unique=True,
+              postgresql_where=text("estado IN ('pendiente', 'procesando')")),
+        Index("ix_trabajo_pago_disponible_en", "disponible_en",
+              postgresql_where=text("estado IN ('pendiente', 'procesando')")),
+    )
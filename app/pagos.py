@@ -0,0 +1,161 @@
+# app/pagos.py
+# Workers de la cola de pagos (tabla trabajo_pago). POST /v1/cliente/reservas/{id}/pago solo
+# encola y responde 202; estos workers, arrancados desde main.lifespan, toman lotes con
+# SKIP LOCKED, cobran en la pasarela fuera de cualquier transacción (la latencia de la
+# pasarela no retiene conexiones del pool) y registran los resultados del lote en una sentencia.
+# El pago de una retención (POST /v1/cliente/retenciones/{id}/pago) pasa por la misma cola: el
+# asiento sigue retenido hasta el resultado definitivo y se libera si el cobro falla.
+import asyncio
+import os
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Optional
+
+from app import crud
+from app.asientos_en_vivo import difusor_asientos
+from app.cache import invalidar_disponibilidad
+from app.database import AsyncSessionLocal
+from app.pasarela import ERROR, RECHAZADO, Cobro, PasarelaPago, ResultadoCobro, crear_pasarela
+
+PAGOS_WORKERS = int(os.getenv("PAGOS_WORKERS", "2"))
+PAGOS_LOTE = int(os.getenv("PAGOS_LOTE", "50"))
+PAGOS_MAX_INTENTOS = int(os.getenv("PAGOS_MAX_INTENTOS", "5"))
+PAGOS_REINTENTO_BASE_SEGUNDOS = float(os.getenv("PAGOS_REINTENTO_BASE_SEGUNDOS", "2"))
+PAGOS_TIMEOUT_PASARELA_SEGUNDOS = float(os.getenv("PAGOS_TIMEOUT_PASARELA_SEGUNDOS", "30"))
+# Plazo de un lote tomado: si el worker no registra el resultado antes, otro lo retoma.
+# Tiene que superar el timeout de la pasarela.
+PAGOS_PLAZO_SEGUNDOS = float(os.getenv("PAGOS_PLAZO_SEGUNDOS", "120"))
+# Cada cuánto mira la cola un worker ocioso (los pagos encolados en este proceso lo despiertan antes)
+PAGOS_SONDEO_SEGUNDOS = float(os.getenv("PAGOS_SONDEO_SEGUNDOS", "1"))
+
+VENTANA_METRICAS_SEGUNDOS = 60
+
+
+class ProcesadorPagos:
+    def __init__(self, pasarela: Optional[PasarelaPago] = None):
+        self._pasarela = pasarela
+        self._hay_trabajo = asyncio.Event()
+        self._recientes: deque = deque()  # (monotonic, cobros) de los lotes del último minuto
+        self.lotes = 0
+        self.cobros = 0
+        self.aprobados = 0
+        self.rechazados = 0
+        self.reintentos = 0
+        self.fallidos = 0
+        self.descartados = 0
+        self.asientos_liberados = 0
+        self.errores_worker = 0
+        self.segundos_pasarela = 0.0
+
+    @property
+    def pasarela(self) -> PasarelaPago:
+        if self._pasarela is None:
+            self._pasarela = crear_pasarela()
+        return self._pasarela
+
+    def avisar(self):
+        """Despierta a los workers ociosos de este proceso (se llama al encolar)."""
+        self._hay_trabajo.set()
+
+    async def _cobrar(self, cobros: list) -> list:
+        inicio = time.perf_counter()
+        try:
+            resultados = await asyncio.wait_for(self.pasarela.cobrar(cobros), timeout=PAGOS_TIMEOUT_PASARELA_SEGUNDOS)
+            if len(resultados) != len(cobros):
+                raise RuntimeError(f"la pasarela devolvió {len(resultados)} resultados para {len(cobros)} cobros")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            # El reintento usa la misma clave de cobro, así que un cobro hecho sin respuesta no se repite
+            resultados = [ResultadoCobro(ERROR, mensaje=f"Pasarela: {exc!r}")] * len(cobros)
+        self.segundos_pasarela += time.perf_counter() - inicio
+        return resultados
+
+    async def procesar_lote(self, tamano_lote: int = PAGOS_LOTE) -> int:
+        """Toma, cobra y registra un lote. Devuelve cuántos trabajos tomó."""
+        async with AsyncSessionLocal() as db:
+            trabajos = await crud.reclamar_trabajos_pago(
+                db, tamano_lote=tamano_lote, plazo=timedelta(seconds=PAGOS_PLAZO_SEGUNDOS)
+            )
+        if not trabajos:
+            return 0
+
+        cobros = [Cobro(t.id_trabajo, t.id_reserva, t.monto, t.intentos) for t in trabajos]
+        resultados = await self._cobrar(cobros)
+
+        async with AsyncSessionLocal() as db:
+            aplicados = await crud.registrar_resultados_pago(
+                db,
+                resultados=[
+                    (c.id_trabajo, c.intento, r.resultado, r.referencia, r.mensaje)
+                    for c, r in zip(cobros, resultados)
+                ],
+                max_intentos=PAGOS_MAX_INTENTOS,
+                espera_base=timedelta(seconds=PAGOS_REINTENTO_BASE_SEGUNDOS),
+            )
+
+        finales = {fila.id_trabajo: fila.estado for fila in aplicados}
+        liberados = [fila for fila in aplicados if fila.id_asiento_liberado is not None]
+        for fila in liberados:
+            # Retención cuyo cobro falló: el asiento vuelve a estar libre
+            await invalidar_disponibilidad(fila.id_origen, fila.id_destino, fila.fecha_salida)
+            await difusor_asientos.publicar(fila.id_vuelo, [(fila.id_asiento_liberado, True)])
+        self.asientos_liberados += len(liberados)
+        self.lotes += 1
+        self.cobros += len(cobros)
+        self.descartados += len(cobros) - len(finales)
+        for c, r in zip(cobros, resultados):
+            estado = finales.get(c.id_trabajo)
+            if estado == "pagado":
+                self.aprobados += 1
+            elif estado == "pendiente":
+                self.reintentos += 1
+            elif estado == "fallido":
+                self.fallidos += 1
+                if r.resultado == RECHAZADO:
+                    self.rechazados += 1
+        self._recientes.append((time.monotonic(), len(cobros)))
+        return len(trabajos)
+
+    async def trabajar(self):
+        while True:
+            try:
+                tomados = await self.procesar_lote(PAGOS_LOTE)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # Lo tomado queda 'procesando' y se retoma al vencer el plazo
+                self.errores_worker += 1
+                print(f"Worker de pagos falló: {exc!r}")
+                tomados = 0
+            if tomados < PAGOS_LOTE:
+                try:
+                    await asyncio.wait_for(self._hay_trabajo.wait(), timeout=PAGOS_SONDEO_SEGUNDOS)
+                except asyncio.TimeoutError:
+                    pass
+                self._hay_trabajo.clear()
+
+    def iniciar(self, workers: int = PAGOS_WORKERS) -> list:
+        return [asyncio.create_task(self.trabajar()) for _ in range(workers)]
+
+    def stats(self) -> dict:
+        ahora = time.monotonic()
+        while self._recientes and self._recientes[0][0] < ahora - VENTANA_METRICAS_SEGUNDOS:
+            self._recientes.popleft()
+        return {
+            "lotes": self.lotes,
+            "cobros": self.cobros,
+            "aprobados": self.aprobados,
+            "rechazados": self.rechazados,
+            "reintentos": self.reintentos,
+            "fallidos": self.fallidos,
+            "descartados": self.descartados,
+            "asientos_liberados": self.asientos_liberados,
+            "errores_worker": self.errores_worker,
+            "segundos_pasarela": round(self.segundos_pasarela, 3),
+            "cobros_por_segundo": sum(n for _, n in self._recientes) / VENTANA_METRICAS_SEGUNDOS,
+        }
+
+
+procesador_pagos = ProcesadorPagos()
@@ -0,0 +1,96 @@
+# app/pasarela.py
+# Interfaz con la pasarela de pagos que usan los workers de app/pagos.py.
+# PASARELA_PAGOS elige la implementación: "simulada" (por defecto, cobra en local con
+# latencia y fallos configurables) o "modulo:Clase" para cargar una pasarela real.
+import asyncio
+import importlib
+import os
+import random
+from decimal import Decimal
+from typing import NamedTuple, Optional
+
+PASARELA_PAGOS = os.getenv("PASARELA_PAGOS", "simulada")
+PASARELA_SIMULADA_LATENCIA_MS = float(os.getenv("PASARELA_SIMULADA_LATENCIA_MS", "200"))
+# Probabilidad de error transitorio (se reintenta) y de rechazo definitivo (tarjeta denegada)
+PASARELA_SIMULADA_ERRORES = float(os.getenv("PASARELA_SIMULADA_ERRORES", "0"))
+PASARELA_SIMULADA_RECHAZOS = float(os.getenv("PASARELA_SIMULADA_RECHAZOS", "0"))
+
+APROBADO = "aprobado"
+RECHAZADO = "rechazado"
+ERROR = "error"
+
+
+class Cobro(NamedTuple):
+    id_trabajo: int
+    id_reserva: int
+    monto: Decimal
+    intento: int
+
+    @property
+    def clave(self) -> str:
+        # Igual en todos los intentos: la pasarela no cobra dos veces si un reintento llega
+        # después de un cobro que sí se hizo pero cuya respuesta se perdió
+        return f"flyblue-pago-{self.id_trabajo}"
+
+
+class ResultadoCobro(NamedTuple):
+    resultado: str  # APROBADO, RECHAZADO (definitivo) o ERROR (transitorio, se reintenta)
+    referencia: Optional[str] = None
+    mensaje: Optional[str] = None
+
+
+class PasarelaPago:
+    """
+    Una pasarela implementa cobrar_uno(), o cobrar() si su API acepta lotes. cobrar() devuelve
+    un resultado por cobro, en el mismo orden; una excepción en un cobro cuenta como ERROR.
+    """
+
+    nombre = "base"
+
+    async def cobrar(self, cobros: list) -> list:
+        resultados = await asyncio.gather(*(self.cobrar_uno(c) for c in cobros), return_exceptions=True)
+        return [
+            ResultadoCobro(ERROR, mensaje=repr(r)) if isinstance(r, BaseException) else r
+            for r in resultados
+        ]
+
+    async def cobrar_uno(self, cobro: Cobro) -> ResultadoCobro:
+        raise NotImplementedError
+
+
+class PasarelaSimulada(PasarelaPago):
+    nombre = "simulada"
+
+    def __init__(
+        self,
+        latencia_ms: float = PASARELA_SIMULADA_LATENCIA_MS,
+        errores: float = PASARELA_SIMULADA_ERRORES,
+        rechazos: float = PASARELA_SIMULADA_RECHAZOS,
+        semilla: Optional[int] = None,
+    ):
+        self.latencia_ms = latencia_ms
+        self.errores = errores
+        self.rechazos = rechazos
+        self._azar = random.Random(semilla)
+        self.cobrados: dict[str, str] = {}  # clave -> referencia, como haría la pasarela real
+
+    async def cobrar_uno(self, cobro: Cobro) -> ResultadoCobro:
+        await asyncio.sleep(self.latencia_ms / 1000 * self._azar.uniform(0.5, 1.5))
+        if cobro.clave in self.cobrados:
+            return ResultadoCobro(APROBADO, self.cobrados[cobro.clave])
+        tirada = self._azar.random()
+        if tirada < self.errores:
+            return ResultadoCobro(ERROR, mensaje="Pasarela no disponible (simulado)")
+        if tirada < self.errores + self.rechazos:
+            return ResultadoCobro(RECHAZADO, mensaje="Pago rechazado por el emisor (simulado)")
+        referencia = self.cobrados[cobro.clave] = f"sim-{cobro.id_trabajo}-{cobro.intento}"
+        return ResultadoCobro(APROBADO, referencia)
+
+
+def crear_pasarela(nombre: str = PASARELA_PAGOS) -> PasarelaPago:
+    if nombre == "simulada":
+        return PasarelaSimulada()
+    modulo, _, clase = nombre.partition(":")
+    if not clase:
+        raise ValueError(f"PASARELA_PAGOS inválida: {nombre!r} (usa 'simulada' o 'modulo:Clase')")
+    return getattr(importlib.import_module(modulo), clase)()
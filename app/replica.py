@@ -0,0 +1,213 @@
+# app/replica.py
+# Lecturas en la réplica (DATABASE_READ_URL). Los GET pesados usan get_read_db en lugar de
+# get_db: van a la réplica salvo que
+#   - no haya réplica configurada, esté caída o su retraso supere REPLICA_RETRASO_MAX_SEGUNDOS
+#     (lo mide vigilar() cada REPLICA_SONDEO_SEGUNDOS comparando el LSN de ambas), o
+#   - el usuario haya escrito hace menos de LECTURA_PRIMARIA_TRAS_ESCRITURA_SEGUNDOS, para que
+#     lea lo que acaba de escribir. La marca es la cookie flyblue_primaria_hasta (sirve en
+#     cualquier worker) y, para clientes sin cookies, una marca por usuario en este proceso.
+# En todos esos casos la lectura se hace en la primaria, nunca falla por la réplica.
+# Las cachés compartidas (búsquedas, calendario) se llenan siempre desde la primaria: un resultado
+# de la réplica puede ser anterior a la última invalidación y quedaría guardado con la generación
+# nueva todo el TTL. Ver sesion_para_cache y lectura_tras_escritura.
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import Depends, Request
+from sqlalchemy import text
+
+from app.database import AsyncSessionLectura, AsyncSessionLocal, engine, read_engine
+from app.security import Principal
+from app.security.dependencies import get_current_user
+
+REPLICA_RETRASO_MAX_SEGUNDOS = float(os.getenv("REPLICA_RETRASO_MAX_SEGUNDOS", "2"))
+REPLICA_SONDEO_SEGUNDOS = float(os.getenv("REPLICA_SONDEO_SEGUNDOS", "1"))
+# Tiene que superar REPLICA_RETRASO_MAX_SEGUNDOS + REPLICA_SONDEO_SEGUNDOS para garantizar
+# que el usuario lea sus propias escrituras
+LECTURA_PRIMARIA_TRAS_ESCRITURA_SEGUNDOS = float(os.getenv("LECTURA_PRIMARIA_TRAS_ESCRITURA_SEGUNDOS", "5"))
+
+COOKIE_PRIMARIA = "flyblue_primaria_hasta"
+METODOS_LECTURA = {"GET", "HEAD", "OPTIONS"}
+
+CONSULTA_LSN_PRIMARIA = text("SELECT pg_current_wal_lsn()::text")
+# En una base que no es standby (p. ej. dos bases locales para pruebas) no hay retraso
+CONSULTA_RETRASO_REPLICA = text(
+    "SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn()::text, "
+    "extract(epoch FROM now() - pg_last_xact_replay_timestamp())"
+)
+
+
+def lsn_a_entero(lsn: Optional[str]) -> int:
+    if not lsn:
+        return 0
+    alto, _, bajo = lsn.partition("/")
+    return (int(alto, 16) << 32) | int(bajo, 16)
+
+
+class EstadoReplica:
+    def __init__(self, configurada: bool):
+        self.configurada = configurada
+        self.disponible = False  # hasta el primer sondeo se lee en la primaria
+        self.retraso_segundos: Optional[float] = None
+        self.ultimo_error: Optional[str] = None
+        self._escrituras: dict[int, float] = {}  # id_usuario -> monotonic hasta el que lee en la primaria
+        self.lecturas_replica = 0
+        self.lecturas_primaria_tras_escritura = 0
+        self.lecturas_primaria_sin_replica = 0
+        self.llenados_cache_en_primaria = 0
+        self.caidas = 0
+
+    def usable(self) -> bool:
+        return (
+            self.configurada and self.disponible
+            and self.retraso_segundos is not None and self.retraso_segundos <= REPLICA_RETRASO_MAX_SEGUNDOS
+        )
+
+    def marcar_caida(self, exc: BaseException):
+        if self.disponible:
+            self.caidas += 1
+            print(f"Réplica no disponible, las lecturas pasan a la primaria: {exc!r}")
+        self.disponible = False
+        self.ultimo_error = repr(exc)
+
+    # --- Leer lo propio ---
+
+    def registrar_escritura(self, id_usuario: int):
+        ahora = time.monotonic()
+        self._escrituras[id_usuario] = ahora + LECTURA_PRIMARIA_TRAS_ESCRITURA_SEGUNDOS
+        if len(self._escrituras) > 10000:
+            self._escrituras = {u: hasta for u, hasta in self._escrituras.items() if hasta > ahora}
+
+    def escribio_hace_poco(self, request: Request, id_usuario: int) -> bool:
+        hasta = self._escrituras.get(id_usuario)
+        if hasta is not None and hasta > time.monotonic():
+            return True
+        try:
+            return float(request.cookies.get(COOKIE_PRIMARIA, 0)) > time.time()
+        except ValueError:
+            return False
+
+    # --- Sondeo del retraso ---
+
+    async def medir_retraso(self) -> float:
+        # Primero la primaria: si la réplica ya reprodujo ese LSN, está al día
+        async with engine.connect() as conn:
+            lsn_primaria = lsn_a_entero((await conn.execute(CONSULTA_LSN_PRIMARIA)).scalar_one())
+        async with read_engine.connect() as conn:
+            en_recuperacion, lsn_replica, segundos = (await conn.execute(CONSULTA_RETRASO_REPLICA)).one()
+        if not en_recuperacion or lsn_a_entero(lsn_replica) >= lsn_primaria:
+            return 0.0
+        # Va atrasada: el tiempo desde la última transacción reproducida es una cota del retraso
+        return float(segundos) if segundos is not None else float("inf")
+
+    async def vigilar(self):
+        while True:
+            try:
+                self.retraso_segundos = await asyncio.wait_for(self.medir_retraso(), timeout=REPLICA_SONDEO_SEGUNDOS * 5)
+                self.disponible = True
+                self.ultimo_error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                self.marcar_caida(exc)
+            await asyncio.sleep(REPLICA_SONDEO_SEGUNDOS)
+
+    def stats(self) -> dict:
+        return {
+            "configurada": int(self.configurada),
+            "disponible": int(self.disponible),
+            "retraso_segundos": self.retraso_segundos if self.retraso_segundos is not None else -1,
+            "lecturas_replica": self.lecturas_replica,
+            "lecturas_primaria_tras_escritura": self.lecturas_primaria_tras_escritura,
+            "lecturas_primaria_sin_replica": self.lecturas_primaria_sin_replica,
+            "llenados_cache_en_primaria": self.llenados_cache_en_primaria,
+            "caidas": self.caidas,
+        }
+
+
+replica = EstadoReplica(configurada=read_engine is not None)
+
+
+async def get_read_db(request: Request, current_user: Principal = Depends(get_current_user)):
+    """
+    Como get_db, pero para endpoints de solo lectura: la sesión es de la réplica cuando se puede.
+    """
+    session = AsyncSessionLocal()
+    session.info["lectura"] = "primaria"
+    if not replica.configurada:
+        pass
+    elif not replica.usable():
+        replica.lecturas_primaria_sin_replica += 1
+    elif replica.escribio_hace_poco(request, current_user.id_usuario):
+        replica.lecturas_primaria_tras_escritura += 1
+        session.info["lectura"] = "tras_escritura"
+    else:
+        lectura = AsyncSessionLectura()
+        try:
+            # Se toma la conexión ya: si la réplica no responde todavía se puede cambiar de base
+            await lectura.connection()
+            session = lectura
+            session.info["lectura"] = "replica"
+            replica.lecturas_replica += 1
+        except Exception as exc:
+            await lectura.close()
+            replica.marcar_caida(exc)
+            replica.lecturas_primaria_sin_replica += 1
+
+    async with session:
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+
+
+def lectura_tras_escritura(db) -> bool:
+    """El usuario escribió hace poco: no debe leer de las cachés, que otro pudo llenar antes de su escritura."""
+    return db.info.get("lectura") == "tras_escritura"
+
+
+@asynccontextmanager
+async def sesion_para_cache(db, cachear: bool = True):
+    """
+    Sesión con la que cargar un resultado que se va a guardar en una caché compartida: la misma
+    si es de la primaria (o si no se va a guardar), una de la primaria si `db` es de la réplica.
+    """
+    if not cachear or db.info.get("lectura") != "replica":
+        yield db
+        return
+    replica.llenados_cache_en_primaria += 1
+    async with AsyncSessionLocal() as primaria:
+        yield primaria
+
+
+class LeerEscriturasMiddleware:
+    """
+    Tras una escritura correcta (método distinto de GET/HEAD/OPTIONS y estado < 400) marca al
+    usuario para que sus lecturas de los próximos segundos vayan a la primaria. Solo actúa con
+    réplica configurada; el usuario lo deja get_current_user en request.state.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replica.configurada or scope["method"] in METODOS_LECTURA:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_marcado(mensaje):
+            if mensaje["type"] == "http.response.start" and mensaje["status"] < 400:
+                id_usuario = scope.get("state", {}).get("id_usuario")
+                if id_usuario is not None:
+                    replica.registrar_escritura(id_usuario)
+                segundos = math.ceil(LECTURA_PRIMARIA_TRAS_ESCRITURA_SEGUNDOS)
+                cookie = f"{COOKIE_PRIMARIA}={math.ceil(time.time()) + segundos}; Max-Age={segundos}; Path=/; HttpOnly; SameSite=Lax"
+                mensaje["headers"] = list(mensaje.get("headers", [])) + [(b"set-cookie", cookie.encode("latin-1"))]
+            await send(mensaje)
+
+        await self.app(scope, receive, send_marcado)
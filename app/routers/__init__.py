@@ -1,12 +1,21 @@
-from fastapi import APIRouter, Query, Depends, HTTPException
+from asyncpg import BitString
+from fastapi import APIRouter, Query, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import get_db
-from app.models import Usuario, Vuelo, Asiento, Ciudad, Equipaje
-from app.schemas import VueloResponse, AsientosResponse, EquipajeResponse, CiudadResponse, VueloBusquedaResponse
-from app.security import require_user
-from datetime import datetime
+from app.database import AsyncSessionLocal, get_db
+from app.replica import get_read_db, lectura_tras_escritura, sesion_para_cache
+from app.models import Vuelo, Asiento, Ciudad, Equipaje
+from app.schemas import VueloResponse, AsientosResponse, MapaAsientosResponse, EquipajeResponse, CiudadResponse, VueloBusquedaResponse, DiaCalendarioResponse, ItinerariosResponse, Itinerario, TramoItinerario
+from app.security import Principal, require_user
+from base64 import b64encode
+from datetime import date, datetime, timedelta
 from app import crud
-from typing import Optional, List
+from app.cache import busquedas_cache, calendario_cache, catalogos, etag_coincide
+from app.utils.respuestas import RespuestaJSONRapida, filas_a_dicts
+from app.utils.paginacion import CABECERA_CURSOR, PAGINA_MAXIMA, PAGINA_POR_DEFECTO, decode_cursor, encode_cursor, limitar_pagina
+from app.asientos_en_vivo import difusor_asientos
+from app.grafo_rutas import ITINERARIOS_MAX_ESCALAS, ITINERARIOS_PRESUPUESTO_MAX_MS, ITINERARIOS_PRESUPUESTO_MS, grafo_rutas
+from typing import Literal, Optional, List
 
 from app.routers import admin, cliente, auth
 
@@ -19,14 +28,44 @@ api_v1.include_router(auth.router)
 
 # --- Endpoints Públicos (requieren autenticación de usuario) ---
 
+CALENDARIO_MAX_DIAS = 93
+
+# Debe declararse antes de /vuelos/{id_vuelo} para que "calendario" no se tome como id
+@api_v1.get("/vuelos/calendario", response_model=List[DiaCalendarioResponse])
+async def calendario_tarifas(
+        origen: int = Query(..., description="ID de la ciudad de origen"),
+        destino: int = Query(..., description="ID de la ciudad de destino"),
+        desde: date = Query(..., description="Primer día (YYYY-MM-DD)"),
+        hasta: date = Query(..., description="Último día, inclusive (YYYY-MM-DD)"),
+        db: AsyncSession = Depends(get_read_db),
+        current_user: Principal = Depends(require_user)
+):
+    # Precio mínimo, número de vuelos y asientos libres por día para una vista mensual
+    if hasta < desde:
+        raise HTTPException(status_code=400, detail="'hasta' debe ser posterior o igual a 'desde'")
+    if (hasta - desde).days + 1 > CALENDARIO_MAX_DIAS:
+        raise HTTPException(status_code=400, detail=f"El rango no puede superar {CALENDARIO_MAX_DIAS} días")
+
+    async def cargar(inicio: date, fin: date):
+        async with sesion_para_cache(db) as sesion:
+            return await crud.get_calendario_tarifas(sesion, origen_id=origen, destino_id=destino, desde=inicio, hasta=fin)
+
+    dias = await calendario_cache.obtener(origen, destino, desde, hasta, cargar, refrescar=lectura_tras_escritura(db))
+    return [DiaCalendarioResponse(**d._asdict()) for d in dias]
+
 @api_v1.get("/vuelos/{id_vuelo}", response_model=VueloResponse)
-async def obtener_vuelo_por_id(id_vuelo: int, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
+async def obtener_vuelo_por_id(id_vuelo: int, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
     vuelo = await crud.get_vuelo_by_id(db, vuelo_id=id_vuelo)
     if not vuelo:
         raise HTTPException(status_code=404, detail="Vuelo no encontrado")
 
-    asientos_totales = await crud.count_total_asientos(db, id_vuelo=id_vuelo)
-    asientos_disponibles = await crud.count_asientos_disponibles(db, id_vuelo=id_vuelo)
+    # Los contadores se mantienen en la tabla vuelo; solo los vuelos anteriores
+    # a la reconciliación inicial pueden tenerlos vacíos.
+    asientos_totales = vuelo.asientos_totales
+    asientos_disponibles = vuelo.asientos_disponibles
+    if asientos_totales is None or asientos_disponibles is None:
+        asientos_totales = await crud.count_total_asientos(db, id_vuelo=id_vuelo)
+        asientos_disponibles = await crud.count_asientos_disponibles(db, id_vuelo=id_vuelo)
 
     return VueloResponse(
         id=vuelo.id_vuelo,
@@ -41,56 +80,174 @@ async def obtener_vuelo_por_id(id_vuelo: int, db: AsyncSession = Depends(get_db)
     )
 
 @api_v1.get("/vuelos/{id_vuelo}/asientos", response_model=AsientosResponse)
-async def obtener_asientos_por_id_vuelo(id_vuelo: int, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
-    vuelo = await crud.get_vuelo_by_id(db, vuelo_id=id_vuelo)
-    if not vuelo:
+async def obtener_asientos_por_id_vuelo(id_vuelo: int, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
+    asientos = await crud.get_asientos_by_vuelo_id(db, vuelo_id=id_vuelo)
+    # Todo vuelo tiene asientos: solo si no hay filas comprobamos si el vuelo existe
+    if not asientos and not await crud.get_vuelo_by_id(db, vuelo_id=id_vuelo):
         raise HTTPException(status_code=404, detail="Vuelo no encontrado")
 
-    asientos = await crud.get_asientos_by_vuelo_id(db, vuelo_id=id_vuelo)
-    return AsientosResponse(asientos=asientos)
+    return RespuestaJSONRapida({"asientos": filas_a_dicts(asientos)})
+
+@api_v1.get("/vuelos/{id_vuelo}/asientos/mapa", response_model=MapaAsientosResponse)
+async def obtener_mapa_asientos(id_vuelo: int, request: Request, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
+    # Forma compacta del mapa: disponibilidad como bitset en base64 (13 bytes para 20x5) y la versión
+    # del mapa, que también es el ETag (If-None-Match con la misma versión devuelve 304)
+    fila = await crud.get_mapa_asientos(db, vuelo_id=id_vuelo)
+    if fila is None:
+        raise HTTPException(status_code=404, detail="Vuelo no encontrado")
+
+    mapa, columnas, version = fila
+    if mapa is None:
+        # Vuelo creado sin mapa (lo completa la reconciliación): se arma desde los asientos
+        asientos = await crud.get_asientos_by_vuelo_id(db, vuelo_id=id_vuelo)
+        columnas = "".join(sorted({a.columna for a in asientos}))
+        mapa = BitString("".join("1" if a.disponible else "0" for a in asientos))
+
+    etag = f'"mapa-{id_vuelo}-{version}"'
+    cabeceras = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_coincide(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cabeceras)
+    return RespuestaJSONRapida({
+        "id_vuelo": id_vuelo,
+        "version": version,
+        "filas": len(mapa) // len(columnas) if columnas else 0,
+        "columnas": columnas or "",
+        "disponibles": b64encode(mapa.bytes).decode(),
+    }, headers=cabeceras)
+
+@api_v1.get("/vuelos/{id_vuelo}/asientos/stream")
+async def stream_asientos_vuelo(id_vuelo: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user)):
+    # Server-sent events: un evento "mapa" con todos los asientos y luego eventos "cambios"
+    # con los asientos que se reservan, retienen o liberan (reemplaza el polling del mapa).
+    # La sesión de la autenticación se cierra ya: el stream no debe retener una conexión del pool.
+    await db.close()
+
+    async def cargar():
+        async with AsyncSessionLocal() as sesion:
+            return filas_a_dicts(await crud.get_asientos_by_vuelo_id(sesion, vuelo_id=id_vuelo))
+
+    cola = await difusor_asientos.suscribir(id_vuelo, cargar)
+    if cola is None:
+        raise HTTPException(status_code=404, detail="Vuelo no encontrado")
+
+    return StreamingResponse(
+        difusor_asientos.eventos(id_vuelo, cola),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _respuesta_catalogo(datos: list, etag: str, request: Request):
+    cabeceras = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_coincide(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cabeceras)
+    return JSONResponse(content=datos, headers=cabeceras)
 
 @api_v1.get("/equipajes", response_model=list[EquipajeResponse])
-async def obtener_equipajes(db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
-    equipajes = await crud.get_all_equipajes(db)
+async def obtener_equipajes(request: Request, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
+    equipajes, etag = await catalogos["equipajes"].obtener(db)
     if not equipajes:
         raise HTTPException(status_code=404, detail="Equipaje no encontrado")
-    return equipajes
+    return _respuesta_catalogo(equipajes, etag, request)
 
 @api_v1.get("/ciudades", response_model=list[CiudadResponse])
-async def obtener_ciudades(db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
-    ciudades = await crud.get_all_ciudades(db)
+async def obtener_ciudades(request: Request, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
+    ciudades, etag = await catalogos["ciudades"].obtener(db)
     if not ciudades:
         raise HTTPException(status_code=404, detail="No se encontraron ciudades")
-    return ciudades
+    return _respuesta_catalogo(ciudades, etag, request)
 
 @api_v1.get("/vuelos", response_model=List[VueloBusquedaResponse])
 async def buscar_vuelos(
         origen: Optional[int] = Query(None, description="ID de la ciudad de origen"),
         destino: Optional[int] = Query(None, description="ID de la ciudad de destino"),
         fecha: Optional[datetime] = Query(None, description="Fecha de salida (YYYY-MM-DD)"), # Sugiero usar 'date' si solo buscas por día
-        db: AsyncSession = Depends(get_db),
-        current_user: Usuario = Depends(require_user)
+        limite: int = Query(PAGINA_POR_DEFECTO, ge=1, le=PAGINA_MAXIMA, description="Vuelos por página"),
+        cursor: Optional[str] = Query(None, description=f"Cursor de la cabecera {CABECERA_CURSOR} de la página anterior"),
+        db: AsyncSession = Depends(get_read_db),
+        current_user: Principal = Depends(require_user)
+):
+    despues_de = decode_cursor(cursor, (datetime, int)) if cursor else None
+    limite = limitar_pagina(limite)
+
+    resultado, clave_cache = await busquedas_cache.obtener(
+        origen, destino, fecha, limite, cursor, refrescar=lectura_tras_escritura(db)
+    )
+    if resultado is None:
+        # Pedimos una fila extra para saber si hay otra página
+        async with sesion_para_cache(db, cachear=busquedas_cache.activa) as sesion:
+            vuelos = await crud.search_vuelos(
+                sesion,
+                origen_id=origen,
+                destino_id=destino,
+                fecha=fecha,
+                limite=limite + 1,
+                despues_de=despues_de
+            )
+        siguiente_cursor = None
+        if len(vuelos) > limite:
+            vuelos = vuelos[:limite]
+            siguiente_cursor = encode_cursor(vuelos[-1].fecha_salida, vuelos[-1].id_vuelo)
+
+        resultado = {"vuelos": filas_a_dicts(vuelos), "cursor": siguiente_cursor}
+        await busquedas_cache.guardar(clave_cache, resultado)
+
+    cabeceras = {CABECERA_CURSOR: resultado["cursor"]} if resultado["cursor"] else None
+    return RespuestaJSONRapida(resultado["vuelos"], headers=cabeceras)
+
+@api_v1.get("/itinerarios", response_model=ItinerariosResponse)
+async def buscar_itinerarios(
+        origen: int = Query(..., description="ID de la ciudad de origen"),
+        destino: int = Query(..., description="ID de la ciudad de destino"),
+        fecha: datetime = Query(..., description="Día de salida del primer tramo (YYYY-MM-DD)"),
+        max_escalas: int = Query(ITINERARIOS_MAX_ESCALAS, ge=0, le=ITINERARIOS_MAX_ESCALAS),
+        criterio: Literal["llegada", "precio"] = Query("llegada", description="Ordenar por llegada más temprana o menor precio"),
+        limite: int = Query(10, ge=1, le=50),
+        presupuesto_ms: int = Query(ITINERARIOS_PRESUPUESTO_MS, ge=1, le=ITINERARIOS_PRESUPUESTO_MAX_MS,
+                                    description="Tiempo máximo de búsqueda; si se agota se devuelve lo encontrado"),
+        current_user: Principal = Depends(require_user)
 ):
-    
-    
-    vuelos = await crud.search_vuelos(
-        db, 
-        origen_id=origen, 
-        destino_id=destino, 
-        fecha=fecha
+    # Itinerarios directos y con escalas desde el grafo de rutas en memoria (sin consultas a la BD)
+    if origen == destino:
+        raise HTTPException(status_code=400, detail="El origen y el destino deben ser distintos")
+
+    desde = datetime.combine(fecha.date(), datetime.min.time())
+    resultado = grafo_rutas.buscar(
+        origen, destino, desde, desde + timedelta(days=1) - timedelta(microseconds=1),
+        max_escalas=max_escalas, criterio=criterio, limite=limite, presupuesto_ms=presupuesto_ms,
     )
-    return vuelos
+
+    itinerarios = []
+    for ruta in resultado.itinerarios:
+        itinerarios.append(Itinerario(
+            escalas=len(ruta) - 1,
+            fecha_salida=ruta[0].salida,
+            fecha_llegada=ruta[-1].llegada,
+            duracion_minutos=int((ruta[-1].llegada - ruta[0].salida).total_seconds() // 60),
+            precio_total=sum(t.precio for t in ruta),
+            tramos=[
+                TramoItinerario(
+                    id_vuelo=t.id_vuelo, codigo=t.codigo, origen=t.codigo_origen, destino=t.codigo_destino,
+                    fecha_salida=t.salida, fecha_llegada=t.llegada, precio_base=t.precio,
+                )
+                for t in ruta
+            ],
+        ))
+    return ItinerariosResponse(itinerarios=itinerarios, completo=resultado.completo)
 
 @api_v1.get("/asientos", response_model=AsientosResponse)
 async def obtener_asientos_vuelo(
-    
-    db: AsyncSession = Depends(get_db),
-    current_user: Usuario = Depends(require_user)
+    limite: int = Query(PAGINA_POR_DEFECTO, ge=1, le=PAGINA_MAXIMA, description="Asientos por página"),
+    cursor: Optional[str] = Query(None, description=f"Cursor de la cabecera {CABECERA_CURSOR} de la página anterior"),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: Principal = Depends(require_user)
 ):
-    
-    
-    result = await crud.get_asientos(db)
-    
+    despues_de, = decode_cursor(cursor, (int,)) if cursor else (None,)
+    limite = limitar_pagina(limite)
+
+    result = await crud.get_asientos(db, limite=limite + 1, despues_de=despues_de)
+    cabeceras = None
+    if len(result) > limite:
+        result = result[:limite]
+        cabeceras = {CABECERA_CURSOR: encode_cursor(result[-1].id_asiento)}
 
-    
-    return {"asientos": result}
\ No newline at end of file
+    return RespuestaJSONRapida({"asientos": filas_a_dicts(result)}, headers=cabeceras)
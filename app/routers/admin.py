@@ -1,10 +1,17 @@
+from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.database import get_db
-from app.models import Usuario
-from app.schemas import CiudadCreate, EquipajeCreate, VueloCreate
-from app.security import require_admin
-from app import crud, models
+from app.database import AsyncSessionLocal, get_db
+from app.schemas import CiudadCreate, EquipajeCreate, VueloCreate, VueloLoteCreate
+from app.security import Principal, require_admin, revocation_cache
+from app import crud
+from app.cache import busquedas_cache, catalogos, invalidar_disponibilidad
+from app.aeronaves import TIPO_AERONAVE_POR_DEFECTO, get_layout
+from app.grafo_rutas import Tramo, grafo_rutas
+from app.tasks import reconciliar_contadores
+from app.utils.respuestas import dumps
+from app.utils.security import password_pool
 
 router = APIRouter(
     prefix="/admin",
@@ -12,8 +19,9 @@ router = APIRouter(
 )
 
 @router.post("/ciudades")
-async def crear_ciudad(ciudad: CiudadCreate, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_admin)):
+async def crear_ciudad(ciudad: CiudadCreate, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_admin)):
     nueva_ciudad = await crud.create_ciudad(db, ciudad=ciudad)
+    catalogos["ciudades"].invalidar()
     return {
         "message": "Ciudad creada exitosamente",
         "id_ciudad": nueva_ciudad.id_ciudad,
@@ -22,8 +30,9 @@ async def crear_ciudad(ciudad: CiudadCreate, db: AsyncSession = Depends(get_db),
     }
 
 @router.post("/equipajes")
-async def crear_equipaje(equipaje: EquipajeCreate, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_admin)):
+async def crear_equipaje(equipaje: EquipajeCreate, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_admin)):
     nuevo_equipaje = await crud.create_equipaje(db, equipaje=equipaje)
+    catalogos["equipajes"].invalidar()
     return {
         "message": "Equipaje creado exitosamente",
         "id_equipaje": nuevo_equipaje.id_equipaje,
@@ -33,63 +42,128 @@ async def crear_equipaje(equipaje: EquipajeCreate, db: AsyncSession = Depends(ge
         "precio": float(nuevo_equipaje.precio),
     }
 
+@router.post("/usuarios/{id_usuario}/revocar-sesiones")
+async def revocar_sesiones(id_usuario: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_admin)):
+    nueva_version = await crud.revoke_user_tokens(db, user_id=id_usuario)
+    if nueva_version is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+
+    # Actualizamos la caché local para que el cambio aplique de inmediato en este proceso
+    revocation_cache.set(id_usuario, nueva_version)
+    return {
+        "message": "Sesiones del usuario revocadas exitosamente",
+        "id_usuario": id_usuario,
+        "token_version": nueva_version
+    }
+
+def _preparar_vuelo(vuelo: VueloCreate, ciudades: dict) -> dict:
+    ciudad_origen = ciudades.get(vuelo.id_origen)
+    ciudad_destino = ciudades.get(vuelo.id_destino)
+    if not ciudad_origen or not ciudad_destino:
+        raise HTTPException(status_code=404, detail="Ciudad de origen o destino no encontrada")
+
+    if get_layout(vuelo.tipo_aeronave) is None:
+        raise HTTPException(status_code=400, detail=f"Tipo de aeronave no soportado: {vuelo.tipo_aeronave}")
+
+    # Código de vuelo: ORIGEN-DESTINO-AAAAMMDD
+    codigo = f"{ciudad_origen.codigo}-{ciudad_destino.codigo}-{vuelo.fecha_salida.strftime('%Y%m%d')}"
+
+    return {
+        "codigo": codigo,
+        "id_origen": vuelo.id_origen,
+        "id_destino": vuelo.id_destino,
+        "fecha_salida": vuelo.fecha_salida.replace(tzinfo=None),
+        "fecha_llegada": vuelo.fecha_llegada.replace(tzinfo=None),
+        "precio_base": vuelo.precio_base,
+        "tipo_aeronave": vuelo.tipo_aeronave or TIPO_AERONAVE_POR_DEFECTO,
+    }
+
+def _agregar_al_grafo(creados, filas: list[dict], ciudades: dict):
+    # create_vuelos_con_asientos devuelve los vuelos en el mismo orden que las filas
+    grafo_rutas.agregar([
+        Tramo(
+            salida=f["fecha_salida"], id_vuelo=v.id_vuelo, codigo=v.codigo,
+            id_origen=f["id_origen"], id_destino=f["id_destino"], llegada=f["fecha_llegada"],
+            precio=float(v.precio_base),
+            codigo_origen=ciudades[f["id_origen"]].codigo, codigo_destino=ciudades[f["id_destino"]].codigo,
+        )
+        for v, f in zip(creados, filas)
+    ])
+
+async def _invalidar_busquedas(filas: list[dict]):
+    rutas = {(f["id_origen"], f["id_destino"], f["fecha_salida"].date()) for f in filas}
+    for id_origen, id_destino, dia in rutas:
+        await invalidar_disponibilidad(id_origen, id_destino, datetime.combine(dia, datetime.min.time()))
+
 @router.post("/vuelos")
 async def crear_vuelo(
     vuelo: VueloCreate, 
     db: AsyncSession = Depends(get_db), 
-    current_user: Usuario = Depends(require_admin)
+    current_user: Principal = Depends(require_admin)
 ):
-    # 1. Validar ciudades
-    ciudad_origen = await crud.get_ciudad_by_id(db, ciudad_id=vuelo.id_origen)
-    ciudad_destino = await crud.get_ciudad_by_id(db, ciudad_id=vuelo.id_destino)
-    
-    if not ciudad_origen or not ciudad_destino:
-        raise HTTPException(status_code=404, detail="Ciudad de origen o destino no encontrada")
-
-    # 2. Generar código de vuelo
-    codigo = f"{ciudad_origen.codigo}-{ciudad_destino.codigo}-{vuelo.fecha_salida.strftime('%Y%m%d')}"
+    # 1. Validar ciudades (una sola consulta)
+    ciudades = await crud.get_ciudades_by_ids(db, [vuelo.id_origen, vuelo.id_destino])
 
-    # 3. Crear instancia del Vuelo
-    nuevo_vuelo = models.Vuelo(
-        codigo=codigo,
-        id_origen=vuelo.id_origen,
-        id_destino=vuelo.id_destino,
-        fecha_salida=vuelo.fecha_salida.replace(tzinfo=None),
-        fecha_llegada=vuelo.fecha_llegada.replace(tzinfo=None),
-        precio_base=vuelo.precio_base
-    )
-    
-    db.add(nuevo_vuelo)
-    
-    # ⚠️ IMPORTANTE: Usamos flush() para que la BD asigne el id_vuelo 
-    # sin cerrar la transacción todavía.
-    await db.flush() 
-
-    # 4. Generar los 60 asientos (12 filas x 5 columnas)
-    asientos_lista = []
-    columnas_validas = ['A', 'B', 'C', 'D', 'E']
-    total_filas = 20  # 20 * 5 = 100 asientos
-
-    for numero_fila in range(1, total_filas + 1):
-        for letra_columna in columnas_validas:
-            nuevo_asiento = models.Asiento(
-                id_vuelo=nuevo_vuelo.id_vuelo, # Usamos el ID recién generado
-                fila=numero_fila,
-                columna=letra_columna,
-                disponible=True
-            )
-            asientos_lista.append(nuevo_asiento)
-
-    # 5. Añadir todos los asientos a la sesión de golpe
-    db.add_all(asientos_lista)
-
-    # 6. Confirmar todo (Vuelo + 60 Asientos) en una sola transacción
-    await db.commit()
-    await db.refresh(nuevo_vuelo)
+    # 2. Crear el vuelo y generar sus asientos según el layout de la aeronave
+    #    (INSERT ... SELECT generate_series en la misma transacción)
+    fila = _preparar_vuelo(vuelo, ciudades)
+    nuevo_vuelo, = await crud.create_vuelos_con_asientos(db, [fila])
+    await _invalidar_busquedas([fila])
+    _agregar_al_grafo([nuevo_vuelo], [fila], ciudades)
 
     return {
-        "message": f"Vuelo creado exitosamente con {len(asientos_lista)} asientos.",
+        "message": f"Vuelo creado exitosamente con {nuevo_vuelo.asientos_totales} asientos.",
         "id_vuelo": nuevo_vuelo.id_vuelo,
         "codigo": nuevo_vuelo.codigo,
         "precio_base": float(nuevo_vuelo.precio_base)
-    }
\ No newline at end of file
+    }
+
+@router.post("/vuelos/lote")
+async def crear_vuelos_lote(
+    lote: VueloLoteCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(require_admin)
+):
+    ciudad_ids = {v.id_origen for v in lote.vuelos} | {v.id_destino for v in lote.vuelos}
+    ciudades = await crud.get_ciudades_by_ids(db, ciudad_ids)
+
+    # Si algún vuelo es inválido no se crea ninguno
+    filas = [_preparar_vuelo(vuelo, ciudades) for vuelo in lote.vuelos]
+    creados = await crud.create_vuelos_con_asientos(db, filas)
+    await _invalidar_busquedas(filas)
+    _agregar_al_grafo(creados, filas, ciudades)
+
+    return {
+        "message": f"{len(creados)} vuelos creados exitosamente con {sum(v.asientos_totales for v in creados)} asientos.",
+        "vuelos": [
+            {"id_vuelo": v.id_vuelo, "codigo": v.codigo, "asientos_totales": v.asientos_totales}
+            for v in creados
+        ]
+    }
+
+@router.post("/mantenimiento/reconciliar-asientos")
+async def reconciliar_asientos(db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_admin)):
+    corregidos = await reconciliar_contadores(db)
+    return {"message": f"Contadores corregidos en {len(corregidos)} vuelos", "vuelos": corregidos}
+
+async def _exportar_ndjson(generar_lotes):
+    # Sesión propia: vive mientras dura el streaming, con un cursor del lado del servidor
+    async with AsyncSessionLocal() as db:
+        async for lote in generar_lotes(db):
+            yield b"".join(dumps(dict(fila._mapping)) + b"\n" for fila in lote)
+
+@router.get("/exportar/asientos")
+async def exportar_asientos(current_user: Principal = Depends(require_admin)):
+    return StreamingResponse(_exportar_ndjson(crud.stream_asientos), media_type="application/x-ndjson")
+
+@router.get("/exportar/vuelos")
+async def exportar_vuelos(current_user: Principal = Depends(require_admin)):
+    return StreamingResponse(_exportar_ndjson(crud.stream_vuelos), media_type="application/x-ndjson")
+
+@router.get("/metricas/busqueda-cache")
+async def metricas_busqueda_cache(current_user: Principal = Depends(require_admin)):
+    return busquedas_cache.stats()
+
+@router.get("/metricas/password-pool")
+async def metricas_password_pool(current_user: Principal = Depends(require_admin)):
+    return password_pool.stats()
\ No newline at end of file
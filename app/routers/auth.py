@@ -1,9 +1,8 @@
 from fastapi import APIRouter, HTTPException, Depends
 from app.database import get_db
-from app.utils.security import verify_password
+from app.utils.security import verify_password_async
 from app.schemas import UsuarioCreate, UsuarioResponse, LoginRequest, LoginResponse
-from app.models import Usuario
-from app.security import create_access_token, require_user
+from app.security import Principal, build_token_claims, create_access_token, require_user
 from sqlalchemy.ext.asyncio import AsyncSession
 from app import crud
 
@@ -17,6 +16,8 @@ async def registrar_usuario(usuario: UsuarioCreate, db: AsyncSession = Depends(g
     existente = await crud.get_user_by_email(db, email=usuario.correo)
     if existente:
         raise HTTPException(status_code=400, detail="El correo ya está registrado")
+    # Se cierra la transacción de la lectura: la conexión vuelve al pool mientras se calcula el hash
+    await db.commit()
 
     await crud.create_user(db, usuario=usuario)
     return {"message": "Usuario registrado exitosamente"}
@@ -26,11 +27,13 @@ async def login(request: LoginRequest, db: AsyncSession = Depends(get_db)):
     usuario = await crud.get_user_by_email(db, email=request.correo)
     if not usuario:
         raise HTTPException(status_code=404, detail="Correo no registrado")
+    # Sin transacción abierta durante bcrypt (cola del pool + cálculo): la conexión vuelve al pool
+    await db.commit()
 
-    if not verify_password(request.contraseña, usuario.contraseña):
+    if not await verify_password_async(request.contraseña, usuario.contraseña):
         raise HTTPException(status_code=401, detail="Contraseña incorrecta")
 
-    access_token = create_access_token(data={"sub": str(usuario.id_usuario), "rol": usuario.rol})
+    access_token = create_access_token(data=build_token_claims(usuario))
 
     return {
         "id_usuario": usuario.id_usuario,
@@ -40,7 +43,7 @@ async def login(request: LoginRequest, db: AsyncSession = Depends(get_db)):
     }
 
 @router.get("/me", response_model=UsuarioResponse)
-async def get_current_user_profile(current_user: Usuario = Depends(require_user)):
+async def get_current_user_profile(current_user: Principal = Depends(require_user)):
     return {
         "id_usuario": current_user.id_usuario,
         "nombre": current_user.nombre,
@@ -1,42 +1,117 @@
-from fastapi import APIRouter, HTTPException, Depends
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Depends, Header
 from app.database import get_db
-from app.schemas import ReservaRequest, ReservaResponse
-from app.models import Usuario
-from app.security import require_user
+from app.replica import get_read_db
+from app.schemas import ReservaLoteRequest, ReservaRequest, ReservaResponse, RetencionPagoRequest, RetencionRequest
+from app.security import Principal, require_user
 from sqlalchemy.ext.asyncio import AsyncSession
 from app import crud
+from app.tasks import RETENCION_MINUTOS, RETENCIONES_MAX_POR_USUARIO
+from app.cache import invalidar_disponibilidad
+from app.asientos_en_vivo import difusor_asientos
+from app.idempotencia import idempotencia
+from app.pagos import procesador_pagos
+from app.utils.respuestas import RespuestaJSONRapida
 
 router = APIRouter(
     prefix="/cliente",
     tags=["cliente"]
 )
 
+# Cabecera opcional en los POST de reservas y pagos: un reintento con la misma clave devuelve
+# la respuesta de la primera petición en vez de reservar o cobrar otra vez (ver app/idempotencia.py)
+ClaveIdempotencia = Header(None, alias="Idempotency-Key", min_length=1, max_length=100)
+
 @router.post("/reservas")
-async def crear_reserva(reserva: ReservaRequest, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
+async def crear_reserva(reserva: ReservaRequest, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user),
+                        idempotency_key: Optional[str] = ClaveIdempotencia):
     # Verificar que el usuario solo pueda crear reservas para sí mismo
     if current_user.rol != "admin" and current_user.id_usuario != reserva.id_usuario:
         raise HTTPException(status_code=403, detail="No puedes crear reservas para otro usuario")
 
-    vuelo = await crud.get_vuelo_by_id(db, vuelo_id=reserva.id_vuelo)
-    if not vuelo:
+    return await idempotencia.ejecutar(
+        db, current_user.id_usuario, idempotency_key, "/cliente/reservas", reserva.model_dump(mode="json"),
+        lambda: _crear_reserva(reserva, db),
+    )
+
+async def _crear_reserva(reserva: ReservaRequest, db: AsyncSession):
+
+    # Validación de vuelo/equipaje y reclamo del asiento en una sola sentencia (el commit lo hace idempotencia)
+    resultado = await crud.create_reserva(db, reserva=reserva, confirmar=False)
+
+    if resultado.precio_base is None:
         raise HTTPException(status_code=404, detail="Vuelo no encontrado")
 
-    asiento = await crud.get_asiento_by_id(db, asiento_id=reserva.id_asiento)
-    if not asiento or not asiento.disponible:
-        raise HTTPException(status_code=400, detail="Asiento no disponible")
+    if not resultado.equipaje_existe:
+        raise HTTPException(status_code=404, detail="Equipaje no encontrado")
+
+    if resultado.id_reserva is None:
+        raise HTTPException(status_code=409, detail="Asiento no disponible")
+
+    # Tras el commit la disponibilidad del vuelo cambió: invalidamos las búsquedas y el calendario
+    # de su ruta y día y avisamos a quienes miran el mapa de asientos
+    async def tras_confirmar():
+        await invalidar_disponibilidad(resultado.id_origen, resultado.id_destino, resultado.fecha_salida)
+        await difusor_asientos.publicar(reserva.id_vuelo, [(resultado.id_asiento, False)])
+
+    return {
+        "message": "reserva creada exitosamente",
+        "id_reserva": resultado.id_reserva,
+        "id_asiento": resultado.id_asiento,
+        "total": float(resultado.total)
+    }, tras_confirmar
+
+@router.post("/reservas/lote")
+async def crear_reservas_lote(lote: ReservaLoteRequest, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user),
+                              idempotency_key: Optional[str] = ClaveIdempotencia):
+    # Reserva de grupo: o se reservan todos los asientos o ninguno
+    if current_user.rol != "admin" and current_user.id_usuario != lote.id_usuario:
+        raise HTTPException(status_code=403, detail="No puedes crear reservas para otro usuario")
+
+    ids_asiento = [p.id_asiento for p in lote.pasajeros if p.id_asiento is not None]
+    if len(ids_asiento) != len(set(ids_asiento)):
+        raise HTTPException(status_code=400, detail="Hay asientos repetidos en la solicitud")
+
+    return await idempotencia.ejecutar(
+        db, current_user.id_usuario, idempotency_key, "/cliente/reservas/lote", lote.model_dump(mode="json"),
+        lambda: _crear_reservas_lote(lote, ids_asiento, db),
+    )
+
+async def _crear_reservas_lote(lote: ReservaLoteRequest, ids_asiento: list, db: AsyncSession):
+
+    resultado = await crud.create_reservas_lote(db, lote=lote, confirmar=False)
+
+    if resultado.precio_base is None:
+        raise HTTPException(status_code=404, detail="Vuelo no encontrado")
 
-    equipaje = await crud.get_equipaje_by_id(db, equipaje_id=reserva.id_equipaje)
-    if not equipaje:
+    if not resultado.equipajes_ok:
         raise HTTPException(status_code=404, detail="Equipaje no encontrado")
 
-    total = float(vuelo.precio_base) + float(equipaje.precio)
+    if not resultado.id_reserva:
+        no_disponibles = sorted(set(ids_asiento) - set(resultado.asientos_bloqueados or []))
+        if no_disponibles:
+            raise HTTPException(status_code=409, detail=f"Asientos no disponibles: {no_disponibles}")
+        raise HTTPException(status_code=409, detail="No hay suficientes asientos libres en el vuelo")
 
-    nueva_reserva = await crud.create_reserva(db, reserva=reserva, total=total)
+    async def tras_confirmar():
+        await invalidar_disponibilidad(resultado.id_origen, resultado.id_destino, resultado.fecha_salida)
+        await difusor_asientos.publicar(lote.id_vuelo, [(id_asiento, False) for id_asiento in resultado.id_asiento])
 
-    return {"message": "reserva creada exitosamente", "id_reserva": nueva_reserva.id_reserva}
+    reservas = [
+        {"id_reserva": id_reserva, "id_asiento": id_asiento, "id_equipaje": id_equipaje, "total": float(total)}
+        for id_reserva, id_asiento, id_equipaje, total in zip(
+            resultado.id_reserva, resultado.id_asiento, resultado.id_equipaje, resultado.total
+        )
+    ]
+    return {
+        "message": f"{len(reservas)} reservas creadas exitosamente",
+        "id_vuelo": lote.id_vuelo,
+        "reservas": reservas,
+        "total": sum(r["total"] for r in reservas),
+    }, tras_confirmar
 
 @router.get("/reservas/{id_usuario}", response_model=list[ReservaResponse])
-async def obtener_reservas(id_usuario: int, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
+async def obtener_reservas(id_usuario: int, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
     if current_user.rol != "admin" and current_user.id_usuario != id_usuario:
         raise HTTPException(status_code=403, detail="No puedes ver reservas de otro usuario")
 
@@ -44,28 +119,139 @@ async def obtener_reservas(id_usuario: int, db: AsyncSession = Depends(get_db),
     if not reservas_db:
         raise HTTPException(status_code=404, detail="No se encontraron reservas para este usuario")
 
-    # Formatear la respuesta
-    reservas = []
-    for r in reservas_db:
-        vuelo_str = f"{r.vuelo.origen.codigo}-{r.vuelo.destino.codigo}-{r.vuelo.fecha_salida.strftime('%Y-%m-%d %H:%M')}"
-        reservas.append(
-            ReservaResponse(
-                id_reserva=r.id_reserva,
-                vuelo=vuelo_str,
-                fecha_salida=r.vuelo.fecha_salida,
-                total=float(r.total)
-            )
-        )
-    return reservas
+    # Formatear la respuesta (filas planas, sin validar de nuevo contra response_model)
+    return RespuestaJSONRapida([
+        {
+            "id_reserva": r.id_reserva,
+            "vuelo": f"{r.codigo_origen}-{r.codigo_destino}-{r.fecha_salida.strftime('%Y-%m-%d %H:%M')}",
+            "fecha_salida": r.fecha_salida,
+            "total": r.total,
+        }
+        for r in reservas_db
+    ])
 
-@router.post("/reservas/{reserva_id}/pago")
-async def procesar_pago(reserva_id: int, db: AsyncSession = Depends(get_db), current_user: Usuario = Depends(require_user)):
-    reserva = await crud.get_reserva_by_id_and_user(db, reserva_id=reserva_id, usuario_id=current_user.id_usuario)
-    if not reserva:
+@router.post("/reservas/{reserva_id}/pago", status_code=202)
+async def procesar_pago(reserva_id: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user),
+                        idempotency_key: Optional[str] = ClaveIdempotencia):
+    # El cobro lo hacen los workers de app/pagos.py: aquí solo se encola y se devuelve dónde consultarlo
+    return await idempotencia.ejecutar(
+        db, current_user.id_usuario, idempotency_key, f"/cliente/reservas/{reserva_id}/pago", None,
+        lambda: _procesar_pago(reserva_id, current_user.id_usuario, db), estado=202,
+    )
+
+async def _procesar_pago(reserva_id: int, id_usuario: int, db: AsyncSession):
+    resultado = await crud.encolar_pago(db, reserva_id=reserva_id, usuario_id=id_usuario, confirmar=False)
+    if not resultado.reserva_existe:
         raise HTTPException(status_code=404, detail="Reserva no encontrada o no pertenece al usuario")
 
-    if reserva.pago:
+    if resultado.pagada:
         raise HTTPException(status_code=400, detail="El pago ya ha sido registrado para esta reserva")
 
-    pago = await crud.create_pago(db, reserva=reserva)
-    return {"message": f"Pago procesado exitosamente para la reserva {reserva_id}", "id_pago": pago.id_pago}
\ No newline at end of file
+    async def tras_confirmar():
+        if resultado.creado:
+            procesador_pagos.avisar()
+
+    return {
+        "message": f"Pago en proceso para la reserva {reserva_id}",
+        "id_trabajo": resultado.id_trabajo,
+        "estado": "pendiente" if resultado.creado else "en_proceso",
+        "url_estado": f"/v1/cliente/pagos/{resultado.id_trabajo}",
+    }, tras_confirmar
+
+@router.get("/pagos/{id_trabajo}")
+async def estado_pago(id_trabajo: int, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(require_user)):
+    trabajo = await crud.get_trabajo_pago(db, id_trabajo=id_trabajo, usuario_id=current_user.id_usuario)
+    if trabajo is None:
+        raise HTTPException(status_code=404, detail="Pago no encontrado o no pertenece al usuario")
+
+    return {
+        "id_trabajo": trabajo.id_trabajo,
+        "id_reserva": trabajo.id_reserva,
+        "monto": float(trabajo.monto),
+        "estado": trabajo.estado,  # pendiente, procesando, pagado o fallido
+        "intentos": trabajo.intentos,
+        "id_pago": trabajo.id_pago,
+        "error": trabajo.ultimo_error if trabajo.estado == "fallido" else None,
+        "actualizado_en": trabajo.actualizado_en,
+    }
+
+# --- Retenciones temporales de asientos ---
+
+@router.post("/retenciones")
+async def retener_asiento(retencion: RetencionRequest, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user)):
+    # Reserva el asiento por RETENCION_MINUTOS mientras el cliente paga; si no paga, el barrido lo libera
+    resultado = await crud.create_retencion(
+        db,
+        id_usuario=current_user.id_usuario,
+        id_vuelo=retencion.id_vuelo,
+        id_asiento=retencion.id_asiento,
+        minutos=RETENCION_MINUTOS,
+        max_activas=RETENCIONES_MAX_POR_USUARIO,
+    )
+    if resultado.id_origen is None:
+        raise HTTPException(status_code=404, detail="Vuelo no encontrado")
+
+    if not resultado.dentro_del_limite:
+        raise HTTPException(
+            status_code=429,
+            detail=f"Límite de {RETENCIONES_MAX_POR_USUARIO} retenciones activas alcanzado: paga o cancela alguna",
+        )
+
+    if resultado.id_asiento is None:
+        raise HTTPException(status_code=409, detail="Asiento no disponible")
+
+    await invalidar_disponibilidad(resultado.id_origen, resultado.id_destino, resultado.fecha_salida)
+    await difusor_asientos.publicar(retencion.id_vuelo, [(resultado.id_asiento, False)])
+    return {
+        "message": "Asiento retenido",
+        "id_asiento": resultado.id_asiento,
+        "retenido_hasta": resultado.retenido_hasta,
+    }
+
+@router.post("/retenciones/{id_asiento}/pago", status_code=202)
+async def pagar_retencion(id_asiento: int, pago: RetencionPagoRequest, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user),
+                          idempotency_key: Optional[str] = ClaveIdempotencia):
+    return await idempotencia.ejecutar(
+        db, current_user.id_usuario, idempotency_key, f"/cliente/retenciones/{id_asiento}/pago", pago.model_dump(mode="json"),
+        lambda: _pagar_retencion(id_asiento, pago, current_user.id_usuario, db), estado=202,
+    )
+
+async def _pagar_retencion(id_asiento: int, pago: RetencionPagoRequest, id_usuario: int, db: AsyncSession):
+    # Convierte la retención en reserva y encola su cobro (misma sentencia); el asiento sigue
+    # retenido hasta que los workers de pagos lo cobran, y se libera si el cobro falla
+    resultado = await crud.confirmar_retencion(
+        db, id_usuario=id_usuario, id_asiento=id_asiento, id_equipaje=pago.id_equipaje, confirmar=False
+    )
+    if resultado.en_pago:
+        raise HTTPException(status_code=409, detail="El pago de esta retención ya está en proceso")
+
+    if resultado.retenido_hasta is None:
+        raise HTTPException(status_code=404, detail="No tienes una retención sobre este asiento")
+
+    if not resultado.equipaje_existe:
+        raise HTTPException(status_code=404, detail="Equipaje no encontrado")
+
+    if resultado.id_reserva is None:
+        raise HTTPException(status_code=410, detail="La retención venció, vuelve a seleccionar el asiento")
+
+    async def tras_confirmar():
+        procesador_pagos.avisar()
+
+    return {
+        "message": f"Pago en proceso para la reserva {resultado.id_reserva}",
+        "id_reserva": resultado.id_reserva,
+        "id_trabajo": resultado.id_trabajo,
+        "estado": "pendiente",
+        "total": float(resultado.total),
+        "url_estado": f"/v1/cliente/pagos/{resultado.id_trabajo}",
+    }, tras_confirmar
+
+@router.delete("/retenciones/{id_asiento}")
+async def cancelar_retencion(id_asiento: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(require_user)):
+    vuelo = await crud.cancelar_retencion(db, id_usuario=current_user.id_usuario, id_asiento=id_asiento)
+    if vuelo is None:
+        raise HTTPException(status_code=404, detail="No tienes una retención sobre este asiento")
+
+    await invalidar_disponibilidad(vuelo.id_origen, vuelo.id_destino, vuelo.fecha_salida)
+    await difusor_asientos.publicar(vuelo.id_vuelo, [(id_asiento, True)])
+    return {"message": "Retención cancelada", "id_asiento": id_asiento}
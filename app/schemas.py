@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from datetime import datetime
+from pydantic import BaseModel, EmailStr, Field
+from datetime import date, datetime
+from typing import Optional
 
 class VueloResponse(BaseModel):
     id: int
@@ -47,6 +48,42 @@ class VueloBusquedaResponse(BaseModel):
     precio_base: float
     model_config = {"from_attributes": True}
 
+class MapaAsientosResponse(BaseModel):
+    id_vuelo: int
+    version: int
+    filas: int
+    columnas: str
+    # base64 de un bit por asiento (1 = disponible), fila por fila en el orden de `columnas`;
+    # el primer asiento es el bit más significativo del primer byte
+    disponibles: str
+
+class DiaCalendarioResponse(BaseModel):
+    fecha: date
+    precio_minimo: Optional[float]
+    vuelos: int
+    asientos_disponibles: int
+
+class TramoItinerario(BaseModel):
+    id_vuelo: int
+    codigo: str
+    origen: str
+    destino: str
+    fecha_salida: datetime
+    fecha_llegada: datetime
+    precio_base: float
+
+class Itinerario(BaseModel):
+    escalas: int
+    fecha_salida: datetime
+    fecha_llegada: datetime
+    duracion_minutos: int
+    precio_total: float
+    tramos: list[TramoItinerario]
+
+class ItinerariosResponse(BaseModel):
+    itinerarios: list[Itinerario]
+    completo: bool  # False si la búsqueda se cortó por el presupuesto de tiempo
+
 class UsuarioBase(BaseModel):
     correo: EmailStr
 
@@ -73,10 +110,26 @@ class LoginResponse(BaseModel):
 class ReservaRequest(BaseModel):
     id_usuario: int
     id_vuelo: int
-    id_asiento: int
+    id_asiento: Optional[int] = None  # None = cualquier asiento libre
     id_equipaje: int
     model_config = {"from_attributes": True}
 
+class PasajeroReserva(BaseModel):
+    id_asiento: Optional[int] = None  # None = cualquier asiento libre
+    id_equipaje: int
+
+class ReservaLoteRequest(BaseModel):
+    id_usuario: int
+    id_vuelo: int
+    pasajeros: list[PasajeroReserva] = Field(..., min_length=1, max_length=50)
+
+class RetencionRequest(BaseModel):
+    id_vuelo: int
+    id_asiento: Optional[int] = None  # None = cualquier asiento libre
+
+class RetencionPagoRequest(BaseModel):
+    id_equipaje: int
+
 class ReservaResponse(BaseModel):
     id_reserva: int
     vuelo: str
@@ -99,4 +152,8 @@ class VueloCreate(BaseModel):
     id_destino: int
     fecha_salida: datetime
     fecha_llegada: datetime
-    precio_base: float
\ No newline at end of file
+    precio_base: float
+    tipo_aeronave: Optional[str] = None  # None = layout "estandar"
+
+class VueloLoteCreate(BaseModel):
+    vuelos: list[VueloCreate] = Field(..., min_length=1, max_length=5000)
\ No newline at end of file
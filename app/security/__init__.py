@@ -1,4 +1,16 @@
-from .jwt_handler import create_access_token, verify_token
+from .jwt_handler import create_access_token, decode_token, verify_token
+from .principal import Principal, build_token_claims
+from .revocation import revocation_cache
 from .dependencies import get_current_user, require_admin, require_user
 
-__all__ = ["create_access_token", "verify_token", "get_current_user", "require_admin", "require_user"]
\ No newline at end of file
+__all__ = [
+    "create_access_token",
+    "decode_token",
+    "verify_token",
+    "Principal",
+    "build_token_claims",
+    "revocation_cache",
+    "get_current_user",
+    "require_admin",
+    "require_user",
+]
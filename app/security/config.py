@@ -1,10 +1,19 @@
 import os
 from dotenv import load_dotenv
 
-import os
-from dotenv import load_dotenv
-
 load_dotenv()
 
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "flyblue_secret_key_2024")
-ALGORITHM = "HS256"
\ No newline at end of file
+ALGORITHM = "HS256"
+
+# Duración de los tokens de acceso (minutos)
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+
+# Modo de autenticación:
+#   "stateless" -> el usuario se arma con los claims del token (sin SELECT por request)
+#   "db"        -> se consulta la tabla usuario en cada request (comportamiento anterior)
+AUTH_MODE = os.getenv("AUTH_MODE", "stateless")
+
+# Caché local del estado de revocación (token_version por usuario)
+REVOCATION_CACHE_TTL = int(os.getenv("REVOCATION_CACHE_TTL", "30"))
+REVOCATION_CACHE_SIZE = int(os.getenv("REVOCATION_CACHE_SIZE", "10000"))
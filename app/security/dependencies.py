@@ -1,39 +1,66 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.database import get_db
-from app.models import Usuario
-from app.security.jwt_handler import verify_token
+from app.security.config import AUTH_MODE
+from app.security.jwt_handler import decode_token
+from app.security.principal import Principal
+from app.security.revocation import get_token_version
 from app import crud
 
 security = HTTPBearer()
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)):
-    
-    # 1. user_id_str ES UN STRING (ej: "1")
-    user_id_str = verify_token(credentials.credentials)
-    
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_db)) -> Principal:
+
+    # 1. payload["sub"] ES UN STRING (ej: "1")
+    payload = decode_token(credentials.credentials)
+
     try:
         # 2. Convertir el ID a entero:
-        user_id_int = int(user_id_str)
+        user_id_int = int(payload["sub"])
     except ValueError:
         # Si el token tiene un 'sub' que no es un número:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token inválido (ID de usuario no válido)"
         )
+    # Para LeerEscriturasMiddleware (app/replica.py): marca al usuario tras una escritura
+    request.state.id_usuario = user_id_int
+
+    token_version = payload.get("ver")
 
-    # 3. Pasamos el ID entero a la función del CRUD
+    # 3a. Modo sin estado: el principal sale de los claims. La sesión de BD no
+    #     abre conexión salvo que la caché de revocación no tenga al usuario.
+    if AUTH_MODE == "stateless" and token_version is not None:
+        version_actual = await get_token_version(db, user_id=user_id_int)
+        if version_actual is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="Usuario no encontrado"
+            )
+        if version_actual != token_version:
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Token revocado"
+            )
+        return Principal.from_claims(payload)
+
+    # 3b. Modo BD (o tokens antiguos sin 'ver'): consultamos el usuario
     user = await crud.get_user_by_id(db, user_id=user_id_int)
-    
+
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Usuario no encontrado"
         )
-    return user
+    if token_version is not None and token_version != user.token_version:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token revocado"
+        )
+    return Principal.from_usuario(user)
 
-async def require_admin(current_user: Usuario = Depends(get_current_user)):
+async def require_admin(current_user: Principal = Depends(get_current_user)):
     if current_user.rol != "admin":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -41,5 +68,5 @@ async def require_admin(current_user: Usuario = Depends(get_current_user)):
         )
     return current_user
 
-async def require_user(current_user: Usuario = Depends(get_current_user)):
-    return current_user
\ No newline at end of file
+async def require_user(current_user: Principal = Depends(get_current_user)):
+    return current_user
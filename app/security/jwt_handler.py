@@ -1,24 +1,38 @@
 from datetime import datetime, timedelta
-from jose import JWTError, jwt
+from functools import lru_cache
+from typing import Optional
 from fastapi import HTTPException, status
-from app.security.config import SECRET_KEY, ALGORITHM
+from app.security.config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
 
-def create_access_token(data: dict):
+@lru_cache(maxsize=None)
+def get_jose():
+    # jose carga todos sus backends (rsa, ecdsa...) al importarse: se difiere hasta el primer token
+    from jose import JWTError, jwt
+    return jwt, JWTError
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
+    ahora = datetime.utcnow()
+    expire = ahora + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
+    to_encode.update({"iat": ahora, "exp": expire})
+    jwt, _ = get_jose()
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
-def verify_token(token: str):
+def decode_token(token: str) -> dict:
+    jwt, JWTError = get_jose()
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: int = payload.get("sub")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Token inválido"
-            )
-        return user_id
     except JWTError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Token inválido"
-        )
\ No newline at end of file
+        )
+    if payload.get("sub") is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token inválido"
+        )
+    return payload
+
+def verify_token(token: str):
+    return decode_token(token)["sub"]
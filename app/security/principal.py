@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    Usuario autenticado tal como lo ven los routers.
+    Expone los mismos atributos que models.Usuario que usan los endpoints
+    (id_usuario, nombre, correo, rol), pero se puede construir a partir de
+    los claims del token sin consultar la base de datos.
+    """
+    id_usuario: int
+    nombre: str
+    correo: str
+    rol: str
+    token_version: int = 0
+
+    @classmethod
+    def from_claims(cls, payload: dict) -> "Principal":
+        return cls(
+            id_usuario=int(payload["sub"]),
+            nombre=payload.get("nombre", ""),
+            correo=payload.get("correo", ""),
+            rol=payload.get("rol", "usuario"),
+            token_version=int(payload.get("ver", 0)),
+        )
+
+    @classmethod
+    def from_usuario(cls, usuario) -> "Principal":
+        return cls(
+            id_usuario=usuario.id_usuario,
+            nombre=usuario.nombre,
+            correo=usuario.correo,
+            rol=usuario.rol,
+            token_version=usuario.token_version or 0,
+        )
+
+
+def build_token_claims(usuario) -> dict:
+    """Claims que se firman en el token de acceso de un usuario."""
+    return {
+        "sub": str(usuario.id_usuario),
+        "rol": usuario.rol,
+        "nombre": usuario.nombre,
+        "correo": usuario.correo,
+        "ver": usuario.token_version or 0,
+    }
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import crud
+from app.security.config import REVOCATION_CACHE_TTL, REVOCATION_CACHE_SIZE
+
+
+class RevocationCache:
+    """
+    Caché LRU con TTL de token_version por usuario.
+    Solo se consulta la BD cuando la entrada no existe o ya expiró, así que
+    un token revocado en otro proceso deja de ser válido como máximo tras `ttl` segundos.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[int, tuple[int, float]]" = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id: int) -> Optional[int]:
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                return None
+            version, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return version
+
+    def set(self, user_id: int, version: int):
+        with self._lock:
+            self._data[user_id] = (version, time.monotonic() + self.ttl)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+revocation_cache = RevocationCache(maxsize=REVOCATION_CACHE_SIZE, ttl=REVOCATION_CACHE_TTL)
+
+
+async def get_token_version(db: AsyncSession, user_id: int) -> Optional[int]:
+    """Devuelve el token_version vigente del usuario, o None si el usuario no existe."""
+    version = revocation_cache.get(user_id)
+    if version is None:
+        version = await crud.get_token_version(db, user_id=user_id)
+        if version is None:
+            return None
+        revocation_cache.set(user_id, version)
+    return version
@@ -0,0 +1,189 @@
+# app/tasks.py
+# Tareas en segundo plano que se arrancan desde main.lifespan
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+from app import crud
+from app.asientos_en_vivo import ASIENTOS_STREAM_NOTIFY, difusor_asientos
+from app.cache import invalidar_disponibilidad
+from app.database import AsyncSessionLocal, conectar_directo
+from app.grafo_rutas import Tramo, grafo_rutas
+from app.pagos import PAGOS_WORKERS, procesador_pagos
+from app.replica import replica
+
+# Cada cuánto se reconcilian los contadores de asientos de los vuelos (0 = desactivado)
+RECONCILIACION_INTERVALO = float(os.getenv("RECONCILIACION_INTERVALO", "300"))
+# Vuelos por transacción de la reconciliación (sus filas quedan bloqueadas mientras se cuentan)
+RECONCILIACION_LOTE = int(os.getenv("RECONCILIACION_LOTE", "500"))
+# Las pasadas incrementales miran también este margen hacia atrás (transacciones que empezaron
+# antes de la pasada anterior y confirmaron después)
+RECONCILIACION_MARGEN = timedelta(seconds=60)
+# Clave del advisory lock que elige al único worker que reconcilia
+RECONCILIACION_LOCK_ID = 4_827_310_002
+
+# Cada cuánto se reconstruye el grafo de rutas desde la BD (recoge vuelos creados por otros
+# workers y descarta los que ya salieron; 0 = solo al arrancar)
+GRAFO_RUTAS_RECARGA_SEGUNDOS = float(os.getenv("GRAFO_RUTAS_RECARGA_SEGUNDOS", "300"))
+
+
+# Retenciones de asientos: duración, cada cuánto se liberan las vencidas (0 = desactivado)
+# y cuántas se liberan por sentencia
+RETENCION_MINUTOS = int(os.getenv("RETENCION_MINUTOS", "10"))
+# Retenciones vigentes que puede tener un usuario a la vez (una cuenta no puede vaciar un vuelo)
+RETENCIONES_MAX_POR_USUARIO = int(os.getenv("RETENCIONES_MAX_POR_USUARIO", "9"))
+RETENCIONES_BARRIDO_SEGUNDOS = float(os.getenv("RETENCIONES_BARRIDO_SEGUNDOS", "30"))
+RETENCIONES_LOTE = int(os.getenv("RETENCIONES_LOTE", "1000"))
+
+# Cada cuánto se borran las Idempotency-Key vencidas (0 = desactivado) y cuántas por sentencia
+IDEMPOTENCIA_LIMPIEZA_SEGUNDOS = float(os.getenv("IDEMPOTENCIA_LIMPIEZA_SEGUNDOS", "600"))
+IDEMPOTENCIA_LIMPIEZA_LOTE = int(os.getenv("IDEMPOTENCIA_LIMPIEZA_LOTE", "5000"))
+
+
+async def reconciliar_contadores(db, cambiados_desde: datetime | None = None,
+                                 tamano_lote: int = RECONCILIACION_LOTE) -> list:
+    """Reconcilia por lotes de vuelos (una transacción corta por lote). Devuelve los id_vuelo corregidos."""
+    corregidos = []
+    despues_de = 0
+    while despues_de is not None:
+        despues_de, lote = await crud.reconcile_contadores_vuelo(
+            db, cambiados_desde=cambiados_desde, despues_de=despues_de, limite=tamano_lote
+        )
+        corregidos.extend(lote)
+    return corregidos
+
+
+async def reconciliar_contadores_periodicamente(intervalo: float = RECONCILIACION_INTERVALO):
+    """
+    Corrige la deriva entre vuelo.asientos_disponibles y la tabla asiento.
+
+    Con varios workers reconcilia uno solo: el que consigue el advisory lock de sesión, que se
+    queda en una conexión propia mientras el worker viva; los demás lo reintentan cada intervalo
+    por si ese worker muere. Al tomar el lock se hace una pasada completa (que además rellena los
+    vuelos creados antes de que existieran los contadores); las siguientes revisan solo los
+    vuelos con cambiado_en posterior a la pasada anterior.
+    """
+    conexion = None
+    cambiados_desde = None
+    try:
+        while True:
+            try:
+                if conexion is None:
+                    conexion = await conectar_directo("flyblue-reconciliacion")
+                    if not await conexion.fetchval("SELECT pg_try_advisory_lock($1)", RECONCILIACION_LOCK_ID):
+                        await conexion.close()
+                        conexion = None
+                if conexion is not None:
+                    # Reloj de la BD, el mismo con el que las reservas escriben cambiado_en
+                    inicio = await conexion.fetchval("SELECT timezone('UTC', now())")
+                    async with AsyncSessionLocal() as db:
+                        corregidos = await reconciliar_contadores(db, cambiados_desde)
+                    cambiados_desde = inicio - RECONCILIACION_MARGEN
+                    if corregidos:
+                        print(f"Reconciliación de asientos: {len(corregidos)} vuelos corregidos.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Reconciliación de asientos falló: {exc!r}")
+                if conexion is not None and conexion.is_closed():
+                    # Se perdió el lock junto con la conexión: al recuperarlo, pasada completa
+                    conexion = None
+                    cambiados_desde = None
+            await asyncio.sleep(intervalo)
+    finally:
+        if conexion is not None:
+            await conexion.close()
+
+
+async def liberar_retenciones_vencidas(tamano_lote: int = RETENCIONES_LOTE) -> int:
+    """Libera las retenciones vencidas por lotes (una transacción corta por lote)."""
+    total = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            vuelos = await crud.liberar_retenciones_vencidas(db, tamano_lote=tamano_lote)
+        liberados = sum(v.liberados for v in vuelos)
+        total += liberados
+        for vuelo in vuelos:
+            await invalidar_disponibilidad(vuelo.id_origen, vuelo.id_destino, vuelo.fecha_salida)
+            await difusor_asientos.publicar(vuelo.id_vuelo, [(id_asiento, True) for id_asiento in vuelo.asientos])
+        if liberados < tamano_lote:
+            return total
+
+
+async def barrer_retenciones_periodicamente(intervalo: float = RETENCIONES_BARRIDO_SEGUNDOS):
+    while True:
+        try:
+            liberados = await liberar_retenciones_vencidas()
+            if liberados:
+                print(f"Retenciones vencidas liberadas: {liberados} asientos.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            print(f"Barrido de retenciones falló: {exc!r}")
+        await asyncio.sleep(intervalo)
+
+
+async def limpiar_claves_idempotencia_periodicamente(intervalo: float = IDEMPOTENCIA_LIMPIEZA_SEGUNDOS):
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            total = 0
+            while True:
+                async with AsyncSessionLocal() as db:
+                    borradas = await crud.limpiar_claves_idempotencia(db, tamano_lote=IDEMPOTENCIA_LIMPIEZA_LOTE)
+                total += borradas
+                if borradas < IDEMPOTENCIA_LIMPIEZA_LOTE:
+                    break
+            if total:
+                print(f"Idempotency-Key vencidas borradas: {total}.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            print(f"Limpieza de Idempotency-Key falló: {exc!r}")
+
+
+async def recargar_grafo_rutas():
+    async with AsyncSessionLocal() as db:
+        filas = await crud.get_tramos_vuelo(db, desde=datetime.utcnow())
+    grafo_rutas.cargar([Tramo(*fila[:6], float(fila[6]), *fila[7:]) for fila in filas])
+    return grafo_rutas.total_tramos
+
+
+async def recargar_grafo_rutas_periodicamente(intervalo: float = GRAFO_RUTAS_RECARGA_SEGUNDOS):
+    # La carga inicial se hace en main.lifespan antes de aceptar peticiones
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await recargar_grafo_rutas()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            print(f"Recarga del grafo de rutas falló: {exc!r}")
+
+
+def start_background_tasks() -> list:
+    tareas = []
+    if RECONCILIACION_INTERVALO > 0:
+        tareas.append(asyncio.create_task(reconciliar_contadores_periodicamente()))
+    if RETENCIONES_BARRIDO_SEGUNDOS > 0:
+        tareas.append(asyncio.create_task(barrer_retenciones_periodicamente()))
+    if IDEMPOTENCIA_LIMPIEZA_SEGUNDOS > 0:
+        tareas.append(asyncio.create_task(limpiar_claves_idempotencia_periodicamente()))
+    if GRAFO_RUTAS_RECARGA_SEGUNDOS > 0:
+        tareas.append(asyncio.create_task(recargar_grafo_rutas_periodicamente()))
+    if PAGOS_WORKERS > 0:
+        # Workers de la cola de pagos (cobran en la pasarela fuera de las peticiones)
+        tareas.extend(procesador_pagos.iniciar(PAGOS_WORKERS))
+    if ASIENTOS_STREAM_NOTIFY:
+        # Cambios de asientos entre workers para los streams del mapa de asientos
+        tareas.append(asyncio.create_task(difusor_asientos.escuchar(lambda: conectar_directo("flyblue-asientos"))))
+    if replica.configurada:
+        # Retraso de la réplica de lectura; sin sondeo las lecturas se quedan en la primaria
+        tareas.append(asyncio.create_task(replica.vigilar()))
+    return tareas
+
+
+async def stop_background_tasks(tareas: list):
+    for tarea in tareas:
+        tarea.cancel()
+    await asyncio.gather(*tareas, return_exceptions=True)
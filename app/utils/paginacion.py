@@ -0,0 +1,43 @@
+# app/utils/paginacion.py
+# Cursores opacos para paginación keyset
+import base64
+import json
+import os
+from datetime import datetime
+
+from fastapi import HTTPException, status
+
+# Tamaño de página por defecto y máximo permitido por el servidor
+PAGINA_POR_DEFECTO = int(os.getenv("PAGINA_POR_DEFECTO", "100"))
+PAGINA_MAXIMA = int(os.getenv("PAGINA_MAXIMA", "1000"))
+
+# Cabecera donde se devuelve el cursor de la siguiente página
+CABECERA_CURSOR = "X-Siguiente-Cursor"
+
+
+def encode_cursor(*valores) -> str:
+    """Codifica la clave de la última fila devuelta (ej: (fecha_salida, id_vuelo))."""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in valores]
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, tipos: tuple) -> tuple:
+    """Decodifica un cursor y convierte cada valor al tipo esperado (int, datetime, ...)."""
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        if len(valores) != len(tipos):
+            raise ValueError("longitud inesperada")
+        return tuple(
+            datetime.fromisoformat(v) if tipo is datetime else tipo(v)
+            for v, tipo in zip(valores, tipos)
+        )
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Cursor inválido"
+        )
+
+
+def limitar_pagina(limite: int) -> int:
+    return max(1, min(limite or PAGINA_POR_DEFECTO, PAGINA_MAXIMA))
@@ -0,0 +1,50 @@
+# app/utils/respuestas.py
+# Respuesta JSON rápida para listados grandes: se construye con dicts planos a partir
+# de filas de columnas (sin objetos ORM ni validación Pydantic) y se codifica con orjson.
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:  # sin orjson se usa el json estándar (más lento, misma salida)
+    orjson = None
+
+
+def _default(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    if isinstance(valor, Decimal):
+        return float(valor)
+    raise TypeError(f"Tipo no serializable: {type(valor)}")
+
+
+def dumps(contenido) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(contenido, default=_default)
+    return json.dumps(contenido, ensure_ascii=False, separators=(",", ":"), default=_default).encode()
+
+
+def loads(datos):
+    return orjson.loads(datos) if orjson is not None else json.loads(datos)
+
+
+def filas_a_dicts(filas) -> list:
+    """Convierte filas de SQLAlchemy (select de columnas) en dicts por nombre de columna."""
+    if not filas:
+        return []
+    claves = filas[0]._fields
+    return [dict(zip(claves, fila)) for fila in filas]
+
+
+class RespuestaJSONRapida(Response):
+    """
+    Se devuelve directamente desde la ruta, así FastAPI no vuelve a validar el contenido
+    contra response_model (que queda solo para la documentación de OpenAPI).
+    """
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -1,6 +1,25 @@
-from passlib.context import CryptContext
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from fastapi import HTTPException, status
+
+
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    # passlib se importa al primer hash/verify y no en el arranque del proceso
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+# Pool para bcrypt: "thread" (bcrypt libera el GIL) o "process"
+PASSWORD_POOL_KIND = os.getenv("PASSWORD_POOL_KIND", "thread")
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Cuántas operaciones pueden esperar en cola además de las que se están ejecutando
+PASSWORD_POOL_MAX_QUEUE = int(os.getenv("PASSWORD_POOL_MAX_QUEUE", "32"))
 
 def hash_password(password: str) -> str:
     if not isinstance(password, str):
@@ -9,8 +28,93 @@ def hash_password(password: str) -> str:
     if password == "":
         raise ValueError("La contraseña no puede estar vacía.")
     
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def verify_password(password: str, hashed_password: str):
-    return pwd_context.verify(password, hashed_password)
\ No newline at end of file
+    return get_pwd_context().verify(password, hashed_password)
+
+
+class PasswordHashPool:
+    """
+    Ejecuta hash/verify de bcrypt fuera del event loop en un pool acotado.
+    Si hay más de `workers + max_queue` operaciones en curso se rechaza la
+    petición con 503 en lugar de acumular trabajo.
+    """
+
+    def __init__(self, kind: str, workers: int, max_queue: int):
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Optional[Executor] = None
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self.in_flight >= self.workers + self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servicio de autenticación saturado, intenta de nuevo",
+                headers={"Retry-After": "1"}
+            )
+
+        self.in_flight += 1
+        self.submitted += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        inicio = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self.total_seconds += time.perf_counter() - inicio
+
+    def stats(self) -> dict:
+        ocupados = min(self.in_flight, self.workers)
+        return {
+            "tipo": self.kind,
+            "workers": self.workers,
+            "max_cola": self.max_queue,
+            "en_curso": self.in_flight,
+            "en_cola": max(0, self.in_flight - self.workers),
+            "utilizacion": ocupados / self.workers if self.workers else 0.0,
+            "max_en_curso": self.max_in_flight,
+            "enviadas": self.submitted,
+            "completadas": self.completed,
+            "rechazadas": self.rejected,
+            "tiempo_medio_ms": (self.total_seconds / self.completed * 1000) if self.completed else 0.0,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_pool = PasswordHashPool(
+    kind=PASSWORD_POOL_KIND,
+    workers=PASSWORD_POOL_WORKERS,
+    max_queue=PASSWORD_POOL_MAX_QUEUE,
+)
+
+
+async def hash_password_async(password: str) -> str:
+    return await password_pool.run(hash_password, password)
+
+
+async def verify_password_async(password: str, hashed_password: str) -> bool:
+    return await password_pool.run(verify_password, password, hashed_password)
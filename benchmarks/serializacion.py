@@ -0,0 +1,140 @@
+"""
+Microbenchmark de serialización de listados grandes (filas/s), sin base de datos.
+
+Antes: objetos ORM -> AsientosResponse(asientos=...) en la ruta -> FastAPI valida de nuevo
+contra response_model -> json estándar (lo que hacía /v1/vuelos/{id}/asientos y /v1/asientos).
+Después: filas de columnas -> dicts planos -> RespuestaJSONRapida (orjson si está instalado).
+Además compara, para el mapa de un vuelo, el JSON completo (/v1/vuelos/{id}/asientos) con el
+mapa de bits en base64 (/v1/vuelos/{id}/asientos/mapa): bytes por respuesta y mapas/s.
+
+No abre conexiones, pero importar app.models requiere DATABASE_URL definida.
+
+Uso:
+    python -m benchmarks.serializacion --filas 10000 100000
+"""
+import argparse
+import json
+import time
+from base64 import b64encode
+from datetime import datetime, timedelta
+
+from asyncpg import BitString
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlalchemy.engine import Row
+from sqlalchemy.engine.result import SimpleResultMetaData
+
+from app import models
+from app.schemas import AsientosResponse, VueloBusquedaResponse
+from app.utils import respuestas
+from app.utils.respuestas import RespuestaJSONRapida, filas_a_dicts
+
+
+def _filas(columnas: tuple, datos: list):
+    # Filas reales de SQLAlchemy (Row con _fields), como las que devuelve result.all()
+    meta = SimpleResultMetaData(columnas)
+    return [Row(meta, meta._processors, meta._key_to_index, d) for d in datos]
+
+
+def datos_asientos(n: int):
+    tuplas = [(i, i // 100 + 1, i % 20 + 1, "ABCDE"[i % 5], i % 3 != 0) for i in range(n)]
+    orm = [models.Asiento(id_asiento=a, id_vuelo=v, fila=f, columna=c, disponible=d) for a, v, f, c, d in tuplas]
+    return orm, _filas(("id_asiento", "id_vuelo", "fila", "columna", "disponible"), tuplas)
+
+
+def datos_vuelos(n: int):
+    base = datetime(2026, 11, 1, 6)
+    tuplas = [(i, f"BOG-MDE-{i}", base + timedelta(hours=i), base + timedelta(hours=i + 2), 100.0 + i % 400) for i in range(n)]
+    orm = [models.Vuelo(id_vuelo=i, codigo=c, fecha_salida=s, fecha_llegada=l, precio_base=p) for i, c, s, l, p in tuplas]
+    return orm, _filas(("id_vuelo", "codigo", "fecha_salida", "fecha_llegada", "precio_base"), tuplas)
+
+
+def _render_starlette(contenido) -> bytes:
+    # JSONResponse.render de Starlette
+    return json.dumps(contenido, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def antes_asientos(orm):
+    modelo = AsientosResponse(asientos=orm)                        # validación en la ruta
+    validado = TypeAdapter(AsientosResponse).validate_python(modelo)  # response_model de FastAPI
+    return _render_starlette(jsonable_encoder(validado))
+
+
+def despues_asientos(filas):
+    return RespuestaJSONRapida({"asientos": filas_a_dicts(filas)}).body
+
+
+def antes_vuelos(orm):
+    # buscar_vuelos: model_validate + model_dump(mode="json") por vuelo y JSONResponse
+    return _render_starlette([VueloBusquedaResponse.model_validate(v).model_dump(mode="json") for v in orm])
+
+
+def despues_vuelos(filas):
+    return RespuestaJSONRapida(filas_a_dicts(filas)).body
+
+
+def mapa_json(filas):
+    return RespuestaJSONRapida({"asientos": filas_a_dicts(filas)}).body
+
+
+def mapa_bits(fila_vuelo):
+    mapa, columnas, version = fila_vuelo
+    return RespuestaJSONRapida({
+        "id_vuelo": 1,
+        "version": version,
+        "filas": len(mapa) // len(columnas),
+        "columnas": columnas,
+        "disponibles": b64encode(mapa.bytes).decode(),
+    }).body
+
+
+def comparar_mapa(repeticiones: int, veces: int = 20_000):
+    _, filas = datos_asientos(100)  # un vuelo estándar 20x5
+    fila_vuelo = (BitString("".join("1" if f.disponible else "0" for f in filas)), "ABCDE", 7)
+    resultados = []
+    for funcion, datos in ((mapa_json, filas), (mapa_bits, fila_vuelo)):
+        mejor = float("inf")
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            for _ in range(veces):
+                funcion(datos)
+            mejor = min(mejor, time.perf_counter() - inicio)
+        resultados.append((len(funcion(datos)), veces / mejor))
+    (bytes_json, r_json), (bytes_bits, r_bits) = resultados
+    print(f"\nMapa de un vuelo (100 asientos): JSON {bytes_json} B, {r_json:,.0f} mapas/s | "
+          f"bits {bytes_bits} B, {r_bits:,.0f} mapas/s | {bytes_json / bytes_bits:.0f}x menos bytes, "
+          f"{r_bits / r_json:.1f}x más rápido")
+
+
+def medir(funcion, datos, n: int, repeticiones: int) -> float:
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion(datos)
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return n / mejor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Codificador JSON: {'orjson' if respuestas.orjson is not None else 'json estándar'}")
+    print(f"{'listado':<12}{'filas':>9}{'antes filas/s':>16}{'después filas/s':>18}{'mejora':>9}")
+    for n in args.filas:
+        for nombre, generar, antes, despues in (
+            ("asientos", datos_asientos, antes_asientos, despues_asientos),
+            ("vuelos", datos_vuelos, antes_vuelos, despues_vuelos),
+        ):
+            orm, filas = generar(n)
+            assert json.loads(antes(orm)) == json.loads(despues(filas)), "las salidas no coinciden"
+            r_antes = medir(antes, orm, n, args.repeticiones)
+            r_despues = medir(despues, filas, n, args.repeticiones)
+            print(f"{nombre:<12}{n:>9}{r_antes:>16,.0f}{r_despues:>18,.0f}{r_despues / r_antes:>8.1f}x")
+    comparar_mapa(args.repeticiones)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# gunicorn.conf.py
+# Modo producción: gunicorn como gestor de procesos y workers de uvicorn (ver readme, "Varios workers").
+#   gunicorn -c gunicorn.conf.py app.main:app
+# Reinicio ordenado de los workers:  kill -HUP <pid del maestro>  (con preload no recarga el código)
+# Desplegar código nuevo sin cortar:  kill -USR2 <maestro>  y, cuando el nuevo responde, kill -QUIT <maestro viejo>
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# Cada worker tiene su propio pool de BD (DB_POOL_SIZE + DB_MAX_OVERFLOW conexiones, más las
+# conexiones propias de LISTEN y la reconciliación): el total crece con los workers, así que el
+# valor por defecto es fijo y chico. No se usa os.cpu_count(): en un contenedor devuelve los CPU
+# del host y con el perfil prod se pasaría de max_connections de Postgres (ver readme).
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# La app se importa una vez en el maestro y los workers nacen por fork: comparten las páginas
+# del código y el segmento de app/cache/compartida.py, y cada worker arranca sin importar nada
+preload_app = True
+
+# Al reiniciar o parar, cada worker deja de aceptar conexiones y termina lo que tiene en curso
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+timeout = int(os.getenv("WORKER_TIMEOUT", "60"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+# Reciclar cada worker tras N peticiones (0 = nunca); el jitter evita que se reinicien todos juntos
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+
+accesslog = os.getenv("ACCESS_LOG", "-") or None
+
+
+def when_ready(server):
+    # Presupuesto de conexiones a Postgres (compárese con max_connections)
+    from app.asientos_en_vivo import ASIENTOS_STREAM_NOTIFY
+    from app.database import DB_SETTINGS, read_engine
+    from app.tasks import RECONCILIACION_INTERVALO
+
+    pool = DB_SETTINGS["pool_size"] + DB_SETTINGS["max_overflow"]
+    propias = int(ASIENTOS_STREAM_NOTIFY) + int(RECONCILIACION_INTERVALO > 0)
+    mensaje = f"{workers} workers x ({pool} del pool + {propias} propias) = hasta {workers * (pool + propias)} conexiones a la primaria"
+    if read_engine is not None:
+        mensaje += f" y {workers * pool} a la réplica"
+    server.log.info(mensaje)
+
+
+def post_fork(server, worker):
+    # El pool del engine viene copiado del maestro: cada worker abre sus propias conexiones
+    from app.database import engine, read_engine
+
+    for motor in (engine, read_engine):
+        if motor is not None:
+            motor.sync_engine.dispose(close=False)